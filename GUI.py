@@ -214,6 +214,8 @@ class GUI:
         AOLButton(command_panel, text="People Here", command=lambda: self.handle_command("who")).pack(fill=X, padx=5, pady=3)
         AOLButton(command_panel, text="Daily Sonnet", command=lambda: self.handle_command("poem")).pack(fill=X, padx=5, pady=3)
         AOLButton(command_panel, text="Get Specific Sonnet", command=self.show_poem_dialog).pack(fill=X, padx=5, pady=3)
+        AOLButton(command_panel, text="Sonnet Concordance", command=self.show_concordance_dialog).pack(fill=X, padx=5, pady=3)
+        AOLButton(command_panel, text="Find Rhymes", command=self.show_rhyme_dialog).pack(fill=X, padx=5, pady=3)
         AOLButton(command_panel, text="Get Time", command=lambda: self.handle_command("time")).pack(fill=X, padx=5, pady=3)
         
         search_btn = AOLButton(command_panel, text="Find...", command=self.show_search_dialog)
@@ -293,15 +295,61 @@ class GUI:
         search_dialog = Toplevel(self.Window)
         search_dialog.title("Keyword Search")
         search_dialog.configure(bg=self.panel_color)
-        search_dialog.geometry("300x150")
+        search_dialog.geometry("300x270")
         search_dialog.resizable(False, False)
         search_dialog.transient(self.Window) # Keep dialog on top of the main window.
 
-        Label(search_dialog, text="Find text in chat:", font=("Arial", 10), bg=self.panel_color, fg=self.aol_text_on_grey).pack(pady=10)
+        Label(search_dialog, text="Find text in chat:", font=("Arial", 10), bg=self.panel_color, fg=self.aol_text_on_grey).pack(pady=(10, 0))
+        Label(search_dialog, text='e.g. love AND death, "summer\'s day", -hate', font=("Arial", 8), bg=self.panel_color, fg=self.aol_text_on_grey).pack(pady=(0, 5))
         
         search_entry = Entry(search_dialog, font=("Arial", 10), width=30, relief=SUNKEN, borderwidth=1)
         search_entry.pack(pady=5)
         search_entry.focus()
+
+        # Suggestions for the word being typed, filled in by proc() from the server's replies.
+        self.search_suggestions = Listbox(search_dialog, font=("Arial", 9), height=5, width=30, relief=SUNKEN, borderwidth=1)
+        self.search_suggestions.pack(pady=(0, 5))
+        pending = [None] # after() id of the next suggestion request.
+
+        def last_word():
+            # The word under completion, without query syntax around it.
+            text = search_entry.get()
+            if not text or text[-1].isspace():
+                return ""
+            word = text.split()[-1].lstrip('-("')
+            return "" if word in ("AND", "OR", "NOT") or '*' in word or '?' in word else word
+
+        def request_suggestions():
+            pending[0] = None
+            word = last_word()
+            if len(word) < 2: # The server suggests nothing for less (indexer.COMPLETE_MIN_PREFIX).
+                self.search_suggestions.delete(0, END)
+            elif not self.my_msg: # Don't clobber a command the user just issued.
+                self.my_msg = f"/complete {word}"
+
+        def on_key(event):
+            # Ask once typing pauses rather than on every key.
+            if event.keysym in ("Return", "Up", "Down", "Escape"):
+                return
+            if pending[0] is not None:
+                search_dialog.after_cancel(pending[0])
+            pending[0] = search_dialog.after(200, request_suggestions)
+
+        def use_suggestion(event=None):
+            selection = self.search_suggestions.curselection()
+            if not selection:
+                return
+            word = last_word()
+            text = search_entry.get()
+            search_entry.delete(0, END)
+            search_entry.insert(0, text[:len(text) - len(word)] + self.search_suggestions.get(selection[0]) + " ")
+            self.search_suggestions.delete(0, END)
+            search_entry.focus()
+
+        search_entry.bind("<KeyRelease>", on_key)
+        search_entry.bind("<Return>", lambda event: perform_search())
+        self.search_suggestions.bind("<Double-Button-1>", use_suggestion)
+        self.search_suggestions.bind("<Return>", use_suggestion)
         
         def perform_search():
             term = search_entry.get()
@@ -338,6 +386,69 @@ class GUI:
         
         AOLButton(poem_dialog, text="Get Sonnet", command=submit_specific_sonnet).pack(pady=10)
 
+    def show_concordance_dialog(self):
+        """Displays a dialog for a keyword-in-context listing of a word in the sonnets."""
+        concordance_dialog = Toplevel(self.Window)
+        concordance_dialog.title("Sonnet Concordance")
+        concordance_dialog.configure(bg=self.panel_color)
+        concordance_dialog.geometry("300x200")
+        concordance_dialog.resizable(False, False)
+        concordance_dialog.transient(self.Window)
+
+        Label(concordance_dialog, text="Word to look up in the sonnets:", font=("Arial", 10), bg=self.panel_color, fg=self.aol_text_on_grey).pack(pady=(10, 5))
+
+        word_entry = Entry(concordance_dialog, font=("Arial", 10), width=20, relief=SUNKEN, borderwidth=1)
+        word_entry.pack(pady=5)
+        word_entry.focus()
+
+        width_frame = Frame(concordance_dialog, bg=self.panel_color)
+        width_frame.pack(pady=5)
+        Label(width_frame, text="Words of context:", font=("Arial", 10), bg=self.panel_color, fg=self.aol_text_on_grey).pack(side=LEFT)
+        width_box = Spinbox(width_frame, from_=1, to=20, width=3, font=("Arial", 10))
+        width_box.delete(0, END)
+        width_box.insert(0, "5")
+        width_box.pack(side=LEFT, padx=5)
+
+        def submit_concordance():
+            word = word_entry.get().strip()
+            width = width_box.get().strip()
+            if len(word.split()) != 1:
+                messagebox.showwarning("Input Needed", "Please enter a single word.", parent=concordance_dialog)
+            elif not width.isdigit():
+                messagebox.showerror("Invalid Number", "Please enter how many words of context to show.", parent=concordance_dialog)
+            else:
+                self.my_msg = f"/concordance {word} {width}" # ClientSM command for the concordance.
+                concordance_dialog.destroy()
+
+        word_entry.bind("<Return>", lambda event: submit_concordance())
+        AOLButton(concordance_dialog, text="Look Up", command=submit_concordance).pack(pady=10)
+
+    def show_rhyme_dialog(self):
+        """Displays a dialog for finding sonnet lines that rhyme with a word."""
+        rhyme_dialog = Toplevel(self.Window)
+        rhyme_dialog.title("Find Rhymes")
+        rhyme_dialog.configure(bg=self.panel_color)
+        rhyme_dialog.geometry("300x160")
+        rhyme_dialog.resizable(False, False)
+        rhyme_dialog.transient(self.Window)
+
+        Label(rhyme_dialog, text="Find sonnet lines that rhyme with:", font=("Arial", 10), bg=self.panel_color, fg=self.aol_text_on_grey).pack(pady=10)
+
+        rhyme_entry = Entry(rhyme_dialog, font=("Arial", 10), width=20, relief=SUNKEN, borderwidth=1)
+        rhyme_entry.pack(pady=5)
+        rhyme_entry.focus()
+
+        def submit_rhyme():
+            word = rhyme_entry.get().strip()
+            if len(word.split()) == 1:
+                self.my_msg = f"/rhyme {word}" # ClientSM command for rhymes.
+                rhyme_dialog.destroy()
+            else:
+                messagebox.showwarning("Input Needed", "Please enter a single word.", parent=rhyme_dialog)
+
+        rhyme_entry.bind("<Return>", lambda event: submit_rhyme())
+        AOLButton(rhyme_dialog, text="Find Rhymes", command=submit_rhyme).pack(pady=10)
+
     def show_set_pfp_dialog(self):
         """Displays a dialog for setting the user's profile picture URL."""
         pfp_dialog = Toplevel(self.Window)
@@ -488,7 +599,8 @@ class GUI:
             
             command_this_client_sent = self.my_msg # Capture user's command/message.
 
-            if self.socket in read:
+            # A frame may already be buffered from an earlier read even when the socket is idle.
+            if self.socket in read or self.sm.decoder.has_frame():
                 peer_msg_json = self.recv() # Receive message if available.
 
             # Process if there's a user message or a message from the server.
@@ -536,6 +648,18 @@ class GUI:
                         except (json.JSONDecodeError, Exception) as e:
                             display_text_for_gui = "\nSYSTEM: Error processing game over message.\n\n"
 
+                    elif sm_output_string.startswith("COMPLETIONS_STRUCT:"):
+                        # Suggestions for the search dialog; dropped if it was closed meanwhile.
+                        try:
+                            completions = json.loads(sm_output_string.replace("COMPLETIONS_STRUCT:", "", 1))
+                            if hasattr(self, 'search_suggestions') and self.search_suggestions.winfo_exists():
+                                self.search_suggestions.delete(0, END)
+                                for word in completions["results"]:
+                                    self.search_suggestions.insert(END, word)
+                        except (json.JSONDecodeError, KeyError):
+                            pass
+                        display_text_for_gui = ""
+
                     elif "OPEN_TTT" in sm_output_string:
                         # Server or client initiated TTT, open the game window.
                         try:
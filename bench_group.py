@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+# Microbenchmark for chat_group.Group.
+# Measures the per-operation cost of connect/disconnect/list_me as the number
+# of online members and active groups grows. With the member -> group reverse
+# index the cost should stay flat from 1k to 100k members.
+#
+# Usage: python bench_group.py [--sizes 1000 10000 100000] [--ops 20000]
+#==============================================================================
+
+import argparse
+import random
+import time
+import chat_group as grp
+
+def build(n_members, group_size):
+    # Logs in n_members users and puts them in groups of group_size.
+    g = grp.Group()
+    names = ['user%d' % i for i in range(n_members)]
+    for name in names:
+        g.join(name)
+    for i in range(0, n_members - group_size + 1, group_size):
+        for peer in names[i + 1:i + group_size]:
+            g.connect(peer, names[i])
+    return g, names
+
+def bench(n_members, n_ops, group_size):
+    g, names = build(n_members, group_size)
+    rng = random.Random(n_members)
+    pairs = [(rng.choice(names), rng.choice(names)) for _ in range(n_ops)]
+
+    t = time.perf_counter()
+    for me, peer in pairs:
+        if me != peer:
+            g.connect(me, peer)
+    connect_us = (time.perf_counter() - t) / n_ops * 1e6
+
+    t = time.perf_counter()
+    for me, _ in pairs:
+        g.list_me(me)
+    list_us = (time.perf_counter() - t) / n_ops * 1e6
+
+    t = time.perf_counter()
+    for me, _ in pairs:
+        g.disconnect(me)
+    disconnect_us = (time.perf_counter() - t) / n_ops * 1e6
+
+    # Login/logout storm: leave and rejoin.
+    t = time.perf_counter()
+    for me, _ in pairs:
+        g.leave(me)
+        g.join(me)
+    storm_us = (time.perf_counter() - t) / n_ops * 1e6
+    return len(g.chat_grps), connect_us, list_us, disconnect_us, storm_us
+
+def main():
+    parser = argparse.ArgumentParser(description='chat_group.Group microbenchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='numbers of online members')
+    parser.add_argument('--ops', type=int, default=20000, help='operations timed per size')
+    parser.add_argument('--group-size', type=int, default=4, help='members per pre-built group')
+    args = parser.parse_args()
+
+    print(f"{'members':>9} {'groups':>8} {'connect':>10} {'list_me':>10} {'disconnect':>11} {'leave+join':>11}  (us/op)")
+    for n in args.sizes:
+        groups, c, l, d, s = bench(n, args.ops, args.group_size)
+        print(f"{n:>9} {groups:>8} {c:>10.2f} {l:>10.2f} {d:>11.2f} {s:>11.2f}")
+
+if __name__ == "__main__":
+    main()
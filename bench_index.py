@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+# Memory benchmark for the chat history storage in indexer.py.
+# Builds the same lines three ways and reports the bytes held per message
+# (measured with tracemalloc), the cost of a term lookup and of a search
+# (lookup plus fetching every matching line):
+#   baseline  - the original Index: a list of str plus a dict of word ->
+#               list of int line numbers;
+#   store     - MessageStore: packed UTF-8 buffer + offsets, array('Q')
+#               postings under interned words (live chat);
+#   segment   - a loaded Segment: packed texts and a sorted, packed term
+#               dictionary with delta encoded postings (sealed history).
+# Corpora: the lines of AllSonnets.txt and a synthetic chat log with a
+# Zipf-distributed vocabulary.
+#
+# Usage: python bench_index.py [--messages 50000] [--vocab 20000] [--poems AllSonnets.txt]
+#==============================================================================
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+import indexer
+
+class BaselineIndex:
+    # The dict-of-lists layout indexer.Index used originally.
+    def __init__(self):
+        self.msgs = []
+        self.index = {}
+
+    def add_msg_and_index(self, m):
+        self.msgs.append(m)
+        l = len(self.msgs) - 1
+        for wd in m.split():
+            if wd not in self.index:
+                self.index[wd] = [l,]
+            else:
+                self.index[wd].append(l)
+
+    def lookup(self, term):
+        return self.index.get(term, ())
+
+    def get(self, n):
+        return self.msgs[n]
+
+def poem_lines(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [l.rstrip().rstrip('\x00') for l in f]
+
+def chat_lines(n, vocab_size, seed):
+    # "[hh:mm AM] userN: ..." lines, 3-20 words from a Zipf(1.1) vocabulary.
+    rng = random.Random(seed)
+    vocab = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 9))) for _ in range(vocab_size)]
+    weights = [1 / (rank + 1) ** 1.1 for rank in range(vocab_size)]
+    lines = []
+    for i in range(n):
+        words = rng.choices(vocab, weights, k=rng.randint(3, 20))
+        lines.append(f"[{rng.randint(1, 12):02d}:{rng.randint(0, 59):02d} {rng.choice('AP')}M] user{rng.randint(0, 499)}: " + ' '.join(words))
+    return lines
+
+def measured(build):
+    # Returns (object built, bytes it holds).
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = build()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return obj, held
+
+def lookup_us(index, terms):
+    t = time.perf_counter()
+    for term in terms:
+        len(index.lookup(term))
+    return (time.perf_counter() - t) / len(terms) * 1e6
+
+def search_us(index, terms):
+    t = time.perf_counter()
+    for term in terms:
+        [index.get(i) for i in index.lookup(term)]
+    return (time.perf_counter() - t) / len(terms) * 1e6
+
+def bench(label, lines, seed):
+    def build_baseline():
+        idx = BaselineIndex()
+        for l in lines:
+            idx.add_msg_and_index(l)
+        return idx
+
+    def build_store():
+        store = indexer.MessageStore()
+        for l in lines:
+            store.add(l)
+        return store
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = indexer.Segment.write(directory, 0, lines).path
+        def build_segment():
+            seg = indexer.Segment.open(path)
+            seg.load()
+            return seg
+        baseline, baseline_bytes = measured(build_baseline)
+        store, store_bytes = measured(build_store)
+        segment, segment_bytes = measured(build_segment)
+        file_bytes = os.path.getsize(path)
+    finally:
+        shutil.rmtree(directory)
+
+    rng = random.Random(seed)
+    words = [wd for l in rng.sample(lines, min(len(lines), 2000)) for wd in l.split()]
+    terms = [rng.choice(words) for _ in range(1000)] if words else ['x']
+    text_bytes = sum(len(l.encode('utf-8')) for l in lines)
+    n = max(len(lines), 1)
+    print(f"\n{label}: {len(lines)} messages, {text_bytes / n:.1f} text bytes/message")
+    print(f"{'layout':<10} {'bytes held':>12} {'bytes/msg':>10} {'vs baseline':>12} {'lookup us':>10} {'search us':>10}")
+    for name, held, index in (("baseline", baseline_bytes, baseline), ("store", store_bytes, store), ("segment", segment_bytes, segment)):
+        print(f"{name:<10} {held:>12} {held / n:>10.1f} {baseline_bytes / max(held, 1):>11.1f}x {lookup_us(index, terms):>10.2f} {search_us(index, terms):>10.2f}")
+    print(f"{'(file)':<10} {file_bytes:>12} {file_bytes / n:>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='indexer memory benchmark')
+    parser.add_argument('--messages', type=int, default=50000, help='synthetic chat messages')
+    parser.add_argument('--vocab', type=int, default=20000, help='synthetic vocabulary size')
+    parser.add_argument('--poems', type=str, default='AllSonnets.txt', help='poem corpus')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    if os.path.exists(args.poems):
+        bench(args.poems, poem_lines(args.poems), args.seed)
+    bench("synthetic chat", chat_lines(args.messages, args.vocab, args.seed), args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,504 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+# Load generator for the chat server.
+# Simulates many users speaking the normal size-prefixed JSON protocol
+# (login, connect, exchange, search, poem, start_ttt/move, ...) from asyncio
+# tasks, optionally spread over several processes, and reports per-action
+# throughput and p50/p99/p999 latency together with the server's CPU and RSS.
+#
+# Request/response actions are timed from send to reply. 'exchange' is timed
+# end to end: the sender stamps the message and every room member that
+# receives it records the delivery latency.
+#
+# Users are put in rooms of --group-size; each room member connects to the
+# room's first user once everyone has logged in. After the measured window
+# every user stays logged in for --timeout more seconds so requests still in
+# flight can complete.
+#
+# Usage:
+#   python bench_load.py --spawn chat_server.py --clients 2000 --duration 30
+#   python bench_load.py --server-pid 1234 --mix exchange=80,search=20
+#   python bench_load.py --spawn "chat_cluster.py --workers 4" --procs 4
+#==============================================================================
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from chat_utils import *
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+try:
+    import resource
+except ImportError: # Not on Windows.
+    resource = None
+
+DEFAULT_MIX = "exchange=55,search=10,poem=10,connect=5,time=5,private_message=5,ttt=10"
+SERVER_FILES = ("AllSonnets.txt", "roman.txt.pk") # What a spawned server needs in its working directory.
+
+# Which reply completes a request. Frames that match the action but are
+# notices for someone else are filtered in LoadClient.on_frame.
+REPLY_ACTION = {
+    "login": "login",
+    "connect": "connect",
+    "search": "search",
+    "poem": "poem",
+    "time": "time",
+    "list": "list",
+    "private_message": "private_message_status",
+    "start_ttt": "open_ttt",
+    "move": "update",
+}
+
+def parse_mix(spec):
+    # "exchange=55,search=10" -> ([actions], [weights])
+    actions, weights = [], []
+    for item in spec.split(','):
+        action, _, weight = item.partition('=')
+        action = action.strip()
+        if action not in REPLY_ACTION and action not in ("exchange", "ttt"):
+            raise SystemExit(f"Unknown action in --mix: {action}")
+        actions.append(action)
+        weights.append(float(weight or 1))
+    return actions, weights
+
+def sonnet_words(path="AllSonnets.txt", limit=2000):
+    # Realistic message text and search terms.
+    words = set()
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                for w in line.split():
+                    if w.isalpha():
+                        words.add(w.lower())
+    except FileNotFoundError:
+        pass
+    return sorted(words)[:limit] or ["love", "summer", "day", "time", "beauty"]
+
+#==============================================================================
+# One simulated user.
+#==============================================================================
+class LoadClient:
+    def __init__(self, idx, name, room, stats, args, words):
+        self.idx = idx
+        self.name = name
+        self.room = room # Names of everyone in this user's room, leader first.
+        self.stats = stats
+        self.args = args
+        self.words = words
+        self.rng = random.Random(idx)
+        self.decoder = FrameDecoder()
+        self.pending = defaultdict(deque) # reply action -> deque of (send time, future)
+        self.reader = None
+        self.writer = None
+
+    def send(self, msg):
+        self.writer.write(encode_frame(json.dumps(msg)))
+        self.stats.sent += 1
+
+    async def request(self, action, msg, label=None):
+        # Sends msg and waits for its reply; the latency is recorded under label.
+        label = label or action
+        future = asyncio.get_running_loop().create_future()
+        entry = (time.monotonic_ns(), future)
+        queue = self.pending[REPLY_ACTION[action]]
+        queue.append(entry)
+        self.send(msg)
+        try:
+            reply = await asyncio.wait_for(future, self.args.timeout)
+        except asyncio.TimeoutError:
+            self.stats.timeouts[label] += 1
+            try:
+                queue.remove(entry) # A late reply must not complete a later request.
+            except ValueError:
+                pass
+            return None
+        self.stats.latency[label].append(time.monotonic_ns() - entry[0])
+        return reply
+
+    def on_frame(self, frame):
+        self.stats.received += 1
+        msg = json.loads(frame)
+        action = msg.get("action")
+        if action == "exchange":
+            stamp = msg.get("message", "").rpartition('@')[2]
+            if stamp.isdigit():
+                self.stats.latency["exchange"].append(time.monotonic_ns() - int(stamp))
+            return
+        if action == "end": # Game over; answers our move if we have one in flight.
+            action = "update" if self.pending["update"] else None
+        elif action == "connect" and msg.get("status") == "request":
+            return # Someone joined our room.
+        elif action == "update" and msg.get("from") != self.name:
+            return # The opponent's move.
+        elif action == "open_ttt" and msg.get("status") == "ok" and msg.get("from") != self.name:
+            return # Someone else started a game with us.
+        queue = self.pending.get(action)
+        if queue:
+            _, future = queue.popleft()
+            if not future.done():
+                future.set_result(msg)
+
+    async def read_loop(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                break
+            self.decoder.feed(data)
+            for frame in self.decoder.frames():
+                self.on_frame(frame)
+
+    async def run(self, start_at, stop_at, actions, weights):
+        host, port = self.args.host, self.args.port
+        try:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+        except OSError:
+            self.stats.errors["connect_socket"] += 1
+            return
+        reader_task = asyncio.create_task(self.read_loop())
+        try:
+            reply = await self.request("login", {"action": "login", "name": self.name})
+            if reply is None or reply.get("status") != "ok":
+                self.stats.errors["login"] += 1
+                return
+            await asyncio.sleep(max(0, (start_at - time.monotonic_ns()) / 1e9))
+            if self.name != self.room[0]:
+                await self.request("connect", {"action": "connect", "target": self.room[0]})
+            while time.monotonic_ns() < stop_at and not reader_task.done():
+                await asyncio.sleep(self.rng.expovariate(self.args.rate))
+                await self.step(self.rng.choices(actions, weights)[0])
+            # Stay logged in until everyone's last request has had its chance
+            # to complete, so early leavers do not break others' games.
+            linger = stop_at + int(self.args.timeout * 1e9) - time.monotonic_ns()
+            await asyncio.sleep(max(0, linger / 1e9))
+        except (OSError, asyncio.IncompleteReadError):
+            self.stats.errors["socket"] += 1
+        finally:
+            reader_task.cancel()
+            self.writer.close()
+
+    async def step(self, action):
+        rng = self.rng
+        others = [n for n in self.room if n != self.name] or [self.name]
+        if action == "exchange":
+            text = ' '.join(rng.choice(self.words) for _ in range(rng.randint(3, 12)))
+            self.send({"action": "exchange", "from": f"[{self.name}]", "message": f"{text} @{time.monotonic_ns()}"})
+        elif action == "search":
+            await self.request("search", {"action": "search", "target": rng.choice(self.words)})
+        elif action == "poem":
+            await self.request("poem", {"action": "poem", "target": str(rng.randint(1, 154))})
+        elif action == "connect":
+            await self.request("connect", {"action": "connect", "target": rng.choice(others)})
+        elif action == "private_message":
+            await self.request("private_message", {"action": "private_message", "to": rng.choice(others), "message": "hi"})
+        elif action == "ttt":
+            # The server keeps a single board, so only the starter moves.
+            opponent = rng.choice(others)
+            if opponent == self.name:
+                return
+            reply = await self.request("start_ttt", {"action": "start_ttt", "target": opponent})
+            if reply is None or reply.get("status") != "ok":
+                return
+            for _ in range(rng.randint(1, 5)):
+                if await self.request("move", {"action": "move", "row": str(rng.randrange(3)), "column": str(rng.randrange(3)), "from": "X"}) is None:
+                    break
+        else:
+            await self.request(action, {"action": action})
+
+class Stats:
+    def __init__(self):
+        self.latency = defaultdict(list) # action -> latencies in ns
+        self.timeouts = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.sent = 0
+        self.received = 0
+        self.client_cpu = [] # CPU seconds used by each client process
+
+    def merge(self, other):
+        for k, v in other.latency.items():
+            self.latency[k].extend(v)
+        for k, v in other.timeouts.items():
+            self.timeouts[k] += v
+        for k, v in other.errors.items():
+            self.errors[k] += v
+        self.sent += other.sent
+        self.received += other.received
+        self.client_cpu.extend(other.client_cpu)
+
+#==============================================================================
+# Worker processes.
+#==============================================================================
+async def run_clients(indices, args, start_at, stop_at):
+    stats = Stats()
+    actions, weights = parse_mix(args.mix)
+    words = sonnet_words()
+    names = [f"{args.prefix}{i}" for i in range(args.clients)]
+    clients = []
+    for i in indices:
+        first = i - i % args.group_size
+        room = names[first:first + args.group_size]
+        clients.append(LoadClient(i, names[i], room, stats, args, words))
+    # Logins are spread over the ramp-up window rather than arriving at once.
+    ramp = max(0, start_at - time.monotonic_ns()) / 1e9 * 0.8
+    tasks = []
+    for n, client in enumerate(clients):
+        tasks.append(asyncio.create_task(client.run(start_at, stop_at, actions, weights)))
+        if ramp and n % 50 == 49:
+            await asyncio.sleep(ramp * 50 / len(clients))
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return stats
+
+def client_process(indices, args, start_at, stop_at):
+    raise_fd_limit()
+    cpu = time.process_time()
+    stats = asyncio.run(run_clients(indices, args, start_at, stop_at))
+    stats.client_cpu.append(time.process_time() - cpu)
+    return stats
+
+def raise_fd_limit():
+    # Thousands of sockets need more than the usual 1024 descriptors.
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+#==============================================================================
+# Server process measurement.
+#==============================================================================
+def proc_tree(pid):
+    # pid and all of its descendants (the cluster server forks workers).
+    if PSUTIL_AVAILABLE:
+        try:
+            root = psutil.Process(pid)
+            return [root.pid] + [p.pid for p in root.children(recursive=True)]
+        except psutil.NoSuchProcess:
+            return []
+    children = defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rpartition(')')[2].split()[1])
+                children[ppid].append(int(entry))
+            except OSError:
+                pass
+    tree, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        tree.append(p)
+        todo.extend(children.get(p, []))
+    return tree
+
+def proc_usage(pid):
+    # (cpu seconds, rss bytes) for one process.
+    if PSUTIL_AVAILABLE:
+        p = psutil.Process(pid)
+        t = p.cpu_times()
+        return t.user + t.system, p.memory_info().rss
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rpartition(')')[2].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu = (int(fields[11]) + int(fields[12])) / ticks
+    rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    return cpu, rss
+
+class ServerSampler(threading.Thread):
+    # Samples the server's CPU and RSS (summed over its process tree) once per interval.
+    def __init__(self, pid, interval=1.0):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = [] # (wall time, cpu seconds, rss bytes)
+        self.stopping = threading.Event()
+
+    def sample(self):
+        cpu = rss = 0
+        for pid in proc_tree(self.pid):
+            try:
+                c, r = proc_usage(pid)
+            except Exception: # Exited between listing and reading.
+                continue
+            cpu += c
+            rss += r
+        self.samples.append((time.monotonic(), cpu, rss))
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.sample()
+            self.stopping.wait(self.interval)
+        self.sample()
+
+    def report(self, start, stop):
+        window = [s for s in self.samples if start <= s[0] <= stop] or self.samples
+        if len(window) < 2:
+            return None
+        rates = [(b[1] - a[1]) / (b[0] - a[0]) * 100 for a, b in zip(window, window[1:]) if b[0] > a[0]]
+        total = (window[-1][1] - window[0][1]) / (window[-1][0] - window[0][0]) * 100
+        return {
+            "cpu_avg_pct": total,
+            "cpu_peak_pct": max(rates),
+            "rss_start_mb": window[0][2] / 2**20,
+            "rss_peak_mb": max(s[2] for s in window) / 2**20,
+            "rss_end_mb": window[-1][2] / 2**20,
+        }
+
+def spawn_server(command, host, port):
+    # Starts the server in a scratch directory so the load users' *.idx files
+    # and game stats do not end up in the repo.
+    here = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix="chat_load_")
+    for fname in SERVER_FILES:
+        os.symlink(os.path.join(here, fname), os.path.join(workdir, fname))
+    argv = shlex.split(command)
+    argv[0] = os.path.join(here, argv[0])
+    # The server logs every request to stdout; errors still reach stderr.
+    proc = subprocess.Popen([sys.executable] + argv, cwd=workdir, stdout=subprocess.DEVNULL,
+                            start_new_session=True)
+    proc.workdir = workdir
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            stop_server(proc)
+            raise SystemExit(f"Server exited with status {proc.returncode}")
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+        except OSError:
+            time.sleep(0.2)
+            continue
+        time.sleep(0.5)
+        if proc.poll() is not None: # Something else owns the port.
+            stop_server(proc)
+            raise SystemExit(f"Server exited with status {proc.returncode}; is another server already on {host}:{port}?")
+        break
+    else:
+        stop_server(proc)
+        raise SystemExit("Server did not start listening within 30s")
+    print(f"Spawned {command} (pid {proc.pid}) in {workdir}")
+    return proc
+
+def stop_server(proc):
+    # Signals the whole process group, which includes cluster workers.
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+            proc.wait(10)
+            break
+        except ProcessLookupError:
+            break
+        except subprocess.TimeoutExpired:
+            pass
+    shutil.rmtree(proc.workdir, ignore_errors=True)
+
+#==============================================================================
+# Report.
+#==============================================================================
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def summarize(stats, duration, elapsed):
+    rows = {}
+    for action in sorted(set(stats.latency) | set(stats.timeouts)):
+        values = sorted(stats.latency.get(action, []))
+        row = {"count": len(values), "per_sec": len(values) / duration, "timeouts": stats.timeouts.get(action, 0)}
+        if values:
+            row.update({q: percentile(values, p) / 1e6 for q, p in (("p50_ms", 0.5), ("p99_ms", 0.99), ("p999_ms", 0.999))})
+            row["max_ms"] = values[-1] / 1e6
+        rows[action] = row
+    return {
+        "actions": rows,
+        "sent_per_sec": stats.sent / duration,
+        "received_per_sec": stats.received / duration,
+        "errors": dict(stats.errors),
+        "client_cpu_pct": [cpu / elapsed * 100 for cpu in stats.client_cpu],
+    }
+
+def print_report(result):
+    print(f"\n{'action':<16} {'count':>9} {'per sec':>9} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9} {'max ms':>9} {'timeouts':>9}")
+    for action, row in result["actions"].items():
+        cols = ' '.join(f"{row.get(k, float('nan')):>9.2f}" for k in ("p50_ms", "p99_ms", "p999_ms", "max_ms"))
+        print(f"{action:<16} {row['count']:>9} {row['per_sec']:>9.1f} {cols} {row['timeouts']:>9}")
+    print(f"\nframes sent/s {result['sent_per_sec']:.1f}   frames received/s {result['received_per_sec']:.1f}")
+    if result["errors"]:
+        print(f"errors: {result['errors']}")
+    client_cpu = result["client_cpu_pct"]
+    print(f"client cpu per process: {', '.join(f'{c:.0f}%' for c in client_cpu)}")
+    if max(client_cpu) > 90:
+        print("warning: the load generator is CPU bound, latencies include client-side queueing; use more --procs")
+    server = result.get("server")
+    if server:
+        print(f"server cpu avg {server['cpu_avg_pct']:.1f}%  peak {server['cpu_peak_pct']:.1f}%   "
+              f"rss start {server['rss_start_mb']:.1f} MB  peak {server['rss_peak_mb']:.1f} MB  end {server['rss_end_mb']:.1f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description='chat server load generator')
+    parser.add_argument('--clients', type=int, default=1000, help='simulated users')
+    parser.add_argument('--procs', type=int, default=1, help='client processes to spread the users over')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of measured traffic')
+    parser.add_argument('--ramp', type=float, default=5, help='seconds over which users log in before traffic starts')
+    parser.add_argument('--rate', type=float, default=1.0, help='mean actions per second per user')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='weighted traffic mix, e.g. exchange=80,search=20 (ttt = start_ttt plus moves)')
+    parser.add_argument('--group-size', type=int, default=4, help='users per chat room')
+    parser.add_argument('--timeout', type=float, default=5, help='seconds to wait for a reply')
+    parser.add_argument('--prefix', default='load', help='user name prefix')
+    parser.add_argument('--host', default=SERVER[0])
+    parser.add_argument('--port', type=int, default=SERVER[1])
+    parser.add_argument('--spawn', metavar='CMD', help='start this server script (e.g. "chat_server_async.py --uvloop") and measure it')
+    parser.add_argument('--server-pid', type=int, help='measure CPU/RSS of an already running server')
+    parser.add_argument('--json', metavar='PATH', help='also write the results as JSON')
+    args = parser.parse_args()
+    parse_mix(args.mix) # Fail early on a bad mix.
+
+    raise_fd_limit() # Before spawning, so the server inherits it too.
+    server_proc = spawn_server(args.spawn, args.host, args.port) if args.spawn else None
+    server_pid = server_proc.pid if server_proc else args.server_pid
+    sampler = ServerSampler(server_pid) if server_pid else None
+    if sampler:
+        sampler.start()
+
+    began = time.monotonic()
+    start_at = time.monotonic_ns() + int(args.ramp * 1e9)
+    stop_at = start_at + int(args.duration * 1e9)
+    shares = [list(range(p, args.clients, args.procs)) for p in range(args.procs)]
+    print(f"{args.clients} users in {args.procs} process(es), {args.ramp:.0f}s ramp-up, {args.duration:.0f}s of traffic...")
+    try:
+        if args.procs == 1:
+            stats = client_process(shares[0], args, start_at, stop_at)
+        else:
+            with multiprocessing.Pool(args.procs) as pool:
+                parts = pool.starmap(client_process, [(share, args, start_at, stop_at) for share in shares])
+            stats = Stats()
+            for part in parts:
+                stats.merge(part)
+    finally:
+        if sampler:
+            sampler.stopping.set()
+            sampler.join()
+        if server_proc:
+            stop_server(server_proc)
+
+    result = summarize(stats, args.duration, time.monotonic() - began)
+    if sampler:
+        result["server"] = sampler.report(start_at / 1e9, stop_at / 1e9)
+    result["config"] = {k: v for k, v in vars(args).items() if k != 'json'}
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=4)
+
+if __name__ == "__main__":
+    main()
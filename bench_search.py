@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+# Query benchmark for indexer.Index.search.
+# Times boolean and phrase queries (see indexer.parse_query) against the
+# sonnets (PIndex) and against a synthetic chat history split over sealed
+# segments, the tail and the session's lines in the shared store. Queries
+# run on positional postings with galloping intersection, so each should
+# stay well under a millisecond; the time to fetch the matching lines is
+# reported apart, as is a BM25-ranked top 10 (Index.search_topk), which
+# reads only the lines it returns.
+#
+# Usage: python bench_search.py [--messages 200000] [--repeat 200] [--poems AllSonnets.txt]
+#==============================================================================
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+import indexer
+
+QUERIES = ['love AND death', '"summer\'s day"', 'love -hate', 'beauty OR truth', '"thou art"',
+           'time AND (love OR beauty) -death']
+
+def chat_lines(n, vocab, seed):
+    # "[hh:mm AM] userN: ..." lines of 3-20 words, Zipf-distributed over vocab.
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) ** 1.1 for rank in range(len(vocab))]
+    return [f"[{rng.randint(1, 12):02d}:{rng.randint(0, 59):02d} {rng.choice('AP')}M] user{rng.randint(0, 99)}: "
+            + ' '.join(rng.choices(vocab, weights, k=rng.randint(3, 20))) for _ in range(n)]
+
+def query_us(past, store, node, repeat):
+    # Microseconds per evaluation of node on the history and the store.
+    t = time.perf_counter()
+    for _ in range(repeat):
+        past.match(node)
+        store.match(node)
+    return (time.perf_counter() - t) / repeat * 1e6
+
+def search_us(index, query, repeat):
+    # Microseconds per Index.search, parsing and fetching the lines included.
+    t = time.perf_counter()
+    for _ in range(repeat):
+        found = index.search(query)
+    return (time.perf_counter() - t) / repeat * 1e6, len(found)
+
+def topk_us(index, query, repeat, k=10):
+    # Microseconds per Index.search_topk for the k best lines.
+    t = time.perf_counter()
+    for _ in range(repeat):
+        index.search_topk(query, k)
+    return (time.perf_counter() - t) / repeat * 1e6
+
+def report(label, index, repeat):
+    print(f"\n{label}: {index.get_msg_size()} lines")
+    print(f"{'query':<36} {'hits':>7} {'match us':>10} {'search us':>10} {'top10 us':>10}")
+    for q in QUERIES:
+        node = indexer.parse_query(q, index.analyzer)
+        match = query_us(index.past, index.store, node, repeat)
+        search, hits = search_us(index, q, repeat)
+        print(f"{q:<36} {hits:>7} {match:>10.1f} {search:>10.1f} {topk_us(index, q, repeat):>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='indexer query benchmark')
+    parser.add_argument('--messages', type=int, default=200000, help='synthetic history lines')
+    parser.add_argument('--repeat', type=int, default=200, help='runs per query')
+    parser.add_argument('--poems', type=str, default='AllSonnets.txt', help='poem corpus')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    if os.path.exists(args.poems) and os.path.exists('roman.txt.pk'):
+        report(args.poems, indexer.PIndex(args.poems), args.repeat)
+
+    # The query words are common enough to match, the rest is filler.
+    rng = random.Random(args.seed)
+    filler = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 9))) for _ in range(20000)]
+    vocab = filler[:50] + ["love", "death", "summer's", "day", "hate", "beauty", "truth", "thou", "art", "time"] + filler[50:]
+    lines = chat_lines(args.messages, vocab, args.seed)
+    directory = tempfile.mkdtemp()
+    try:
+        session = len(lines) // 20 # The last 5% arrive this session.
+        history = indexer.SegmentedHistory.open(os.path.join(directory, 'bench' + indexer.HIST_SUFFIX))
+        history.append(lines[:-session])
+        history.flush()
+        index = indexer.Index('bench', past=history)
+        for l in lines[-session:]:
+            index.add_msg_and_index(l)
+        report(f"synthetic history ({len(history.segments)} segments)", index, args.repeat)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
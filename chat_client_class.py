@@ -48,7 +48,7 @@ class Client:
 
     def recv(self):
         """Receives a message from the client's socket."""
-        return myrecv(self.socket)
+        return self.sm.recv() # Shares the state machine's frame decoder.
 
     def run_chat(self):
         """Starts the chat application execution flow."""
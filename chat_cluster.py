@@ -0,0 +1,423 @@
+
+#==============================================================================
+# Multi-process chat server.
+#
+# The launcher forks N worker processes. Each runs a ClusterServer, which is
+# a chat_server.Server bound to SERVER with SO_REUSEPORT, so the kernel
+# spreads incoming connections across the workers. The launcher process
+# itself becomes the coordinator: every worker keeps one Unix socket
+# connection to it, speaking the same size-prefixed JSON framing as clients.
+#
+# Shared state is replicated through the coordinator:
+#   - presence and Group changes (join/leave/connect/disconnect) made on one
+#     worker are applied on every other worker, so is_member(), list_me()
+#     and 'list' see all users;
+#   - a user logged in elsewhere shows up locally as a RemoteUser stand-in in
+#     logged_name2sock, and anything sent to it (exchange, private_message,
+#     connect notices, game updates) is routed to the worker owning the user;
+#   - tic-tac-toe games live on the worker that started them, and 'move'
+#     actions from players on other workers are forwarded there.
+#
+# Replication is asynchronous: a worker answers its own client first, and the
+# other workers see the change a coordinator round trip later.
+#
+# Each worker journals the history lines of its own users to
+# JOURNAL_FILE.<worker id>; the launcher replays all of them before forking.
+#
+# Usage: python chat_cluster.py [--workers N] [--socket PATH]
+#==============================================================================
+
+import os
+import sys
+import json
+import time
+import asyncio
+import tempfile
+import multiprocessing
+import selectors
+import chat_server
+import chat_journal
+import chat_group as grp
+from chat_utils import *
+
+GROUP_OPS = ("join", "leave", "connect", "disconnect")
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), f"chat_cluster_{CHAT_PORT}.sock")
+
+class RemoteUser:
+    # Stands in for the socket of a user logged in on another worker.
+    # ClusterServer routes anything sent to it through the coordinator.
+    def __init__(self, name, worker):
+        self.name = name
+        self.worker = worker
+
+    def getpeername(self):
+        return f"worker {self.worker}"
+
+    def fileno(self):
+        return -1
+
+class ReplicatedGroup(grp.Group):
+    """
+    Group whose local changes are published to the coordinator.
+    Changes made on other workers arrive through apply() and are not
+    published again.
+    """
+    def __init__(self, publish):
+        super().__init__()
+        self.publish = publish
+        self.applying = False
+
+    def _publish(self, op, *args):
+        if not self.applying:
+            self.publish({"op": op, "args": list(args)})
+
+    def join(self, name):
+        super().join(name)
+        self._publish("join", name)
+
+    def leave(self, name):
+        super().leave(name)
+        self._publish("leave", name)
+
+    def connect(self, me, peer):
+        orphans = super().connect(me, peer)
+        self._publish("connect", me, peer)
+        return orphans
+
+    def disconnect(self, me):
+        super().disconnect(me)
+        self._publish("disconnect", me)
+
+    def apply(self, op, args):
+        """Replays a change that was made on another worker."""
+        self.applying = True
+        try:
+            getattr(self, op)(*args)
+        finally:
+            self.applying = False
+
+#==============================================================================
+# Worker process.
+#==============================================================================
+class ClusterServer(chat_server.Server):
+    def __init__(self, worker_id, coord_path):
+        self.worker_id = worker_id
+        self.remote_users = {} # name -> RemoteUser for users logged in on other workers
+        self.ttt_host = {} # player name -> worker id hosting that player's current game
+        super().__init__()
+        self.group = ReplicatedGroup(self.publish)
+        self.coord_sock = self._connect_coordinator(coord_path)
+        self.coord_conn = chat_server.Connection(self.coord_sock, "coordinator", self.handle_cluster_frame)
+        self.conns[self.coord_sock] = self.coord_conn
+        self.selector.register(self.coord_sock, selectors.EVENT_READ, self.coord_conn)
+        self.publish({"op": "hello", "worker": worker_id})
+
+    def listen(self):
+        # Same as Server.listen, plus SO_REUSEPORT so every worker can bind SERVER.
+        self.server=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server.bind(SERVER)
+        self.server.listen(socket.SOMAXCONN)
+        self.server.setblocking(0)
+        self.selector.register(self.server, selectors.EVENT_READ, None)
+
+    def open_journal(self):
+        # Leftover journals were replayed by the launcher before forking.
+        return chat_journal.Journal(f"{JOURNAL_FILE}.{self.worker_id}")
+
+    def _connect_coordinator(self, path, attempts=50):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        for _ in range(attempts):
+            try:
+                sock.connect(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                time.sleep(0.1)
+        else:
+            raise RuntimeError(f"[Worker {self.worker_id}] Coordinator not reachable at {path}")
+        sock.setblocking(0)
+        return sock
+
+    def publish(self, op):
+        # Sends an op to the coordinator. The coordinator link is never
+        # evicted as a slow consumer, so it bypasses the high-water mark.
+        conn = self.coord_conn
+        data = encode_frame(json.dumps(op))
+        conn.outbound.append(data)
+        conn.out_bytes += len(data)
+        if not conn.want_write:
+            self.pending_flush[conn] = None
+
+    def close_client(self, sock):
+        if sock is self.coord_sock:
+            print(f"[Worker {self.worker_id}] Lost the coordinator, shutting down.")
+            raise SystemExit(1)
+        super().close_client(sock)
+
+    #==========================================================================
+    # Routing to users on other workers.
+    #==========================================================================
+    def _split_by_worker(self, names):
+        # Returns (local names, {worker id: [remote names]}).
+        local, remote = [], {}
+        for name in names:
+            proxy = self.remote_users.get(name)
+            if proxy is None:
+                local.append(name)
+            else:
+                remote.setdefault(proxy.worker, []).append(name)
+        return local, remote
+
+    def send_to(self, sock, msg):
+        if isinstance(sock, RemoteUser):
+            self.publish({"op": "deliver", "worker": sock.worker, "names": [sock.name], "frame": msg})
+        else:
+            super().send_to(sock, msg)
+
+    def broadcast(self, socks, msg):
+        # One deliver op per worker, however many of its users are recipients.
+        local, remote = [], {}
+        for sock in socks:
+            if isinstance(sock, RemoteUser):
+                remote.setdefault(sock.worker, []).append(sock.name)
+            else:
+                local.append(sock)
+        super().broadcast(local, msg)
+        for worker, names in remote.items():
+            self.publish({"op": "deliver", "worker": worker, "names": names, "frame": msg})
+
+    def deliver_chat(self, names, processed_msg, payload, msg_id=None):
+        # Histories live on the worker owning the user, so remote recipients
+        # get the processed line along with the frame.
+        local, remote = self._split_by_worker(names)
+        super().deliver_chat(local, processed_msg, payload, msg_id)
+        for worker, worker_names in remote.items():
+            self.publish({"op": "deliver", "worker": worker, "names": worker_names, "frame": payload, "history": processed_msg})
+
+    def dispatch(self, from_sock, msg):
+        name = self.logged_sock2name.get(from_sock)
+        action = msg.get("action")
+        host = self.ttt_host.get(name)
+        if action == "move" and host is not None and host != self.worker_id and not isinstance(from_sock, RemoteUser):
+            # The board lives on the worker that started the game.
+            self.publish({"op": "action", "worker": host, "from": name, "msg": msg})
+            return
+        super().dispatch(from_sock, msg)
+        if action == "start_ttt" and getattr(self, 'ttt_pairs', {}).get(name) == msg.get("target"):
+            self.ttt_host[name] = self.ttt_host[msg["target"]] = self.worker_id
+            self.publish({"op": "ttt", "players": [name, msg["target"]]})
+        elif action == "set_profile_pic" and name in self.user_profile_info:
+            self.publish({"op": "pfp", "name": name, "url": self.user_profile_info[name]["pfp_url"]})
+
+    def _record_game_result(self, winner_name, loser_name, is_tie=False):
+        super()._record_game_result(winner_name, loser_name, is_tie)
+        players = [p for p in (winner_name, loser_name) if p]
+        self.publish({"op": "stats", "stats": {p: self.game_stats[p] for p in players}})
+
+    #==========================================================================
+    # Ops from the coordinator.
+    #==========================================================================
+    def _add_remote(self, name, worker):
+        proxy = RemoteUser(name, worker)
+        self.remote_users[name] = proxy
+        self.logged_name2sock[name] = proxy
+        self.logged_sock2name[proxy] = name
+        if name not in self.user_profile_info:
+            self.user_profile_info[name] = {"pfp_url": None}
+
+    def _remove_remote(self, name):
+        proxy = self.remote_users.pop(name, None)
+        if proxy is not None:
+            del self.logged_name2sock[name]
+            del self.logged_sock2name[proxy]
+        self.ttt_host.pop(name, None)
+
+    def handle_cluster_frame(self, sock, frame):
+        op = json.loads(frame)
+        kind = op["op"]
+        if kind in GROUP_OPS:
+            if kind == "join":
+                self._add_remote(op["args"][0], op["worker"])
+            self.group.apply(kind, op["args"])
+            if kind == "leave":
+                self._remove_remote(op["args"][0])
+        elif kind == "deliver":
+            local = [n for n in op["names"] if n in self.logged_name2sock and n not in self.remote_users]
+            if op.get("history") is not None:
+                chat_server.Server.deliver_chat(self, local, op["history"], op["frame"])
+            else:
+                chat_server.Server.broadcast(self, [self.logged_name2sock[n] for n in local], op["frame"])
+        elif kind == "action":
+            proxy = self.remote_users.get(op["from"])
+            if proxy is not None:
+                chat_server.Server.dispatch(self, proxy, op["msg"])
+        elif kind == "ttt":
+            for player in op["players"]:
+                self.ttt_host[player] = op["worker"]
+        elif kind == "pfp":
+            self.user_profile_info.setdefault(op["name"], {})["pfp_url"] = op["url"]
+        elif kind == "stats":
+            self.game_stats.update(op["stats"])
+        elif kind == "kick":
+            # Lost a concurrent login race; the coordinator names the real owner.
+            name = op["name"]
+            sock = self.logged_name2sock.get(name)
+            if sock is not None and not isinstance(sock, RemoteUser):
+                print(f"[Worker {self.worker_id}] {name} is already logged in on worker {op['owner']}, closing.")
+                self.close_client(sock)
+            self._add_remote(name, op["owner"])
+            self.group.apply("join", [name])
+        elif kind == "snapshot":
+            for name, worker in op["users"].items():
+                self._add_remote(name, worker)
+                self.group.apply("join", [name])
+            for members in op["groups"]:
+                for member in members[1:]:
+                    self.group.apply("connect", [member, members[0]])
+            for name, url in op["pfp"].items():
+                self.user_profile_info.setdefault(name, {})["pfp_url"] = url
+        else:
+            print(f"[Worker {self.worker_id}] Unknown cluster op: {kind}")
+
+    def run(self):
+        print(f'[Worker {self.worker_id}] pid {os.getpid()} serving {SERVER}')
+        super().run()
+
+#==============================================================================
+# Coordinator (runs in the launcher process).
+#==============================================================================
+class Coordinator:
+    """
+    Owns the authoritative presence map and Group state, and routes ops
+    between workers.
+    """
+    def __init__(self):
+        self.workers = {} # worker id -> StreamWriter
+        self.owner = {} # user name -> worker id
+        self.group = grp.Group()
+        self.pfp = {} # user name -> profile picture URL
+
+    def send(self, worker, op):
+        writer = self.workers.get(worker)
+        if writer is not None:
+            writer.write(encode_frame(json.dumps(op)))
+
+    def send_others(self, origin, op):
+        frame = encode_frame(json.dumps(op)) # Encoded once for every worker.
+        for worker, writer in self.workers.items():
+            if worker != origin:
+                writer.write(frame)
+
+    def route(self, origin, op, frame):
+        kind = op["op"]
+        if kind in ("deliver", "action"): # Addressed to a single worker, forwarded untouched.
+            writer = self.workers.get(op["worker"])
+            if writer is not None:
+                writer.write(encode_frame(frame))
+            return
+        if kind in GROUP_OPS:
+            name = op["args"][0]
+            if kind == "join":
+                if self.owner.get(name, origin) != origin:
+                    self.send(origin, {"op": "kick", "name": name, "owner": self.owner[name]})
+                    return
+                self.owner[name] = origin
+            elif kind == "leave":
+                if self.owner.get(name) != origin: # A kicked duplicate logging out.
+                    return
+                del self.owner[name]
+                self.pfp.pop(name, None)
+            elif name not in self.owner:
+                return
+            getattr(self.group, kind)(*op["args"])
+        elif kind == "pfp":
+            self.pfp[op["name"]] = op["url"]
+        op["worker"] = origin
+        self.send_others(origin, op)
+
+    def snapshot(self):
+        groups = [sorted(members) for members in self.group.chat_grps.values()]
+        return {"op": "snapshot", "users": dict(self.owner), "groups": groups, "pfp": dict(self.pfp)}
+
+    def worker_gone(self, worker):
+        self.workers.pop(worker, None)
+        for name in [n for n, w in self.owner.items() if w == worker]:
+            del self.owner[name]
+            self.pfp.pop(name, None)
+            self.group.leave(name)
+            self.send_others(worker, {"op": "leave", "args": [name], "worker": worker})
+        print(f"[Coordinator] Worker {worker} disconnected.")
+
+    async def handle_worker(self, reader, writer):
+        decoder = FrameDecoder()
+        worker = None
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                decoder.feed(data)
+                for frame in decoder.frames():
+                    op = json.loads(frame)
+                    if op["op"] == "hello":
+                        worker = op["worker"]
+                        self.workers[worker] = writer
+                        writer.write(encode_frame(json.dumps(self.snapshot())))
+                        print(f"[Coordinator] Worker {worker} connected.")
+                    else:
+                        self.route(worker, op, frame)
+        except (OSError, ValueError) as e:
+            print(f"[Coordinator] Dropping worker {worker}: {e}")
+        finally:
+            if worker is not None:
+                self.worker_gone(worker)
+            writer.close()
+
+    async def serve(self, listener):
+        server = await asyncio.start_unix_server(self.handle_worker, sock=listener)
+        async with server:
+            await server.serve_forever()
+
+def run_worker(worker_id, coord_path, listener):
+    listener.close() # Inherited from the launcher; only the coordinator accepts on it.
+    ClusterServer(worker_id, coord_path).run()
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='multi-process chat server')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes')
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET, help='Unix socket path of the coordinator')
+    args = parser.parse_args()
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        sys.exit("SO_REUSEPORT is not available on this platform; use chat_server.py instead.")
+
+    leftovers = chat_journal.leftover_journals(JOURNAL_FILE)
+    if leftovers:
+        recovered = chat_journal.replay(leftovers)
+        if recovered:
+            print(f"[Coordinator] Recovered {recovered} chat lines from {len(leftovers)} journal file(s).")
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(args.socket)
+    listener.listen(args.workers)
+
+    ctx = multiprocessing.get_context('fork')
+    workers = [ctx.Process(target=run_worker, args=(i, args.socket, listener), daemon=True) for i in range(args.workers)]
+    for w in workers:
+        w.start()
+    print(f"[Coordinator] Started {args.workers} workers, coordinating on {args.socket}")
+    try:
+        asyncio.run(Coordinator().serve(listener))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for w in workers:
+            w.terminate()
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,8 @@ S_TALKING = 1
 #
 # Member Fields:
 #   - self.members: A dictionary mapping usernames to their status (S_ALONE or S_TALKING).
-#   - self.chat_grps: A dictionary mapping group IDs to a list of usernames in that group.
+#   - self.chat_grps: A dictionary mapping group IDs to the set of usernames in that group.
+#   - self.member_grp: Reverse index mapping each grouped username to its group ID.
 #   - self.grp_ever: A counter to generate unique group IDs.
 #
 # Member Functions:
@@ -30,7 +31,8 @@ class Group:
     """
     def __init__(self):
         self.members = {}  # Stores username -> status (S_ALONE, S_TALKING)
-        self.chat_grps = {}  # Stores group_id -> list_of_usernames
+        self.chat_grps = {}  # Stores group_id -> set_of_usernames
+        self.member_grp = {}  # Stores username -> group_id, only for users in a group
         self.grp_ever = 0  # Counter for unique group IDs
 
     def join(self, name):
@@ -40,7 +42,7 @@ class Group:
 
     def is_member(self, name):
         """Checks if a user is currently a member of the system."""
-        return name in self.members.keys()
+        return name in self.members
 
     def leave(self, name):
         """Removes a user from the system and any chat group they are in."""
@@ -59,38 +61,49 @@ class Group:
         Finds the group ID that a given user belongs to.
         Returns: (bool: found, int: group_key)
         """
-        found = False
-        group_key = 0 # Default to 0, indicating no specific group or S_ALONE.
-        for k in self.chat_grps.keys():
-            if name in self.chat_grps[k]:
-                found = True
-                group_key = k
-                break
-        return found, group_key
+        group_key = self.member_grp.get(name)
+        if group_key is None:
+            return False, 0 # 0 indicates no specific group or S_ALONE.
+        return True, group_key
 
     def connect(self, me, peer):
         """
         Connects user 'me' with user 'peer'.
         If 'peer' is already in a group, 'me' joins that group.
         Otherwise, a new group is created for 'me' and 'peer'.
+        Returns the users left alone because 'me' quit their group for
+        this one; they need to be told they were disconnected.
         """
+        orphans = []
         peer_in_group, group_key = self.find_group(peer)
+        me_in_group, my_key = self.find_group(me)
+        if me_in_group == True:
+            if peer_in_group == True and my_key == group_key:
+                return orphans # Already talking to each other.
+            # A user is in at most one group, so leave the current one first.
+            old_peers = self.chat_grps[my_key] - {me}
+            self.disconnect(me)
+            orphans = [g for g in old_peers if not self.find_group(g)[0]]
+            peer_in_group, group_key = self.find_group(peer)
         
         if peer_in_group == True:
             # Peer is already in a group, so 'me' joins it.
             # print(peer, "is talking already, connect!") # Debug print removed
-            self.chat_grps[group_key].append(me)
+            self.chat_grps[group_key].add(me)
+            self.member_grp[me] = group_key
             self.members[me] = S_TALKING
         else:
             # Peer is not in a group, create a new group for 'me' and 'peer'.
             # print(peer, "is idle as well") # Debug print removed
             self.grp_ever += 1 # Increment for a new unique group ID.
             group_key = self.grp_ever
-            self.chat_grps[group_key] = [me, peer] # Create new group with both users.
+            self.chat_grps[group_key] = {me, peer} # Create new group with both users.
+            self.member_grp[me] = group_key
+            self.member_grp[peer] = group_key
             self.members[me] = S_TALKING
             self.members[peer] = S_TALKING
         # print(self.list_me(me)) # Debug print removed
-        return
+        return orphans
 
     def disconnect(self, me):
         """
@@ -100,12 +113,14 @@ class Group:
         """
         in_group, group_key = self.find_group(me)
         if in_group == True:
-            self.chat_grps[group_key].remove(me)
+            self.chat_grps[group_key].discard(me)
+            del self.member_grp[me]
             self.members[me] = S_ALONE
             # If the group is now empty or has only one person, dissolve it.
             if len(self.chat_grps[group_key]) <= 1:
                 if len(self.chat_grps[group_key]) == 1: # One peer remaining
                     peer = self.chat_grps[group_key].pop()
+                    del self.member_grp[peer]
                     self.members[peer] = S_ALONE
                 del self.chat_grps[group_key] # Delete the group.
         return
@@ -150,7 +165,7 @@ class Group:
         Returns a list containing 'me' and other peers in 'me's current chat group.
         If 'me' is not in a group, returns a list containing only 'me'.
         """
-        if me in self.members.keys():
+        if me in self.members:
             my_list = [me] # Start with 'me'.
             in_group, group_key = self.find_group(me)
             if in_group == True:
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+# Write-ahead journal for chat history.
+#
+# Every line the server adds to users' histories (exchange, broadcast,
+# private_message) is appended here first as one JSON record:
+#
+#     {"text": "[10:15 AM] alice: hi", "to": {"alice": 41, "bob": 7}}
+#
+# where "to" gives, per user, the line number the text takes in that user's
+# history. Records are buffered in memory and a background thread commits
+# them with one write and one fsync per JOURNAL_COMMIT_INTERVAL seconds or
+# JOURNAL_COMMIT_BYTES bytes, whichever comes first (group commit), so the
+# event loop never waits on the disk and no message costs a syscall.
+#
+# On startup replay() appends to each history every journaled line it does
+# not have yet. A line is identified by (user, line number), so replaying
+# the same journal twice, or journals of several cluster workers, is safe.
+#==============================================================================
+
+import os
+import glob
+import json
+import time
+import threading
+import indexer
+from chat_utils import *
+
+class Journal:
+    def __init__(self, path, interval=JOURNAL_COMMIT_INTERVAL, max_bytes=JOURNAL_COMMIT_BYTES):
+        self.path = path
+        self.interval = interval # Longest a record waits before it is committed.
+        self.max_bytes = max_bytes # A batch this large is committed at once.
+        self.f = open(path, 'ab')
+        self.size = self.f.tell() # Bytes in the journal file, committed or not.
+        self.buf = [] # Encoded records not yet written.
+        self.buf_bytes = 0
+        self.cond = threading.Condition()
+        self.io_lock = threading.Lock() # Held while writing; rotate() takes it too.
+        self.closing = False
+        self.commits = 0
+        self.records = 0
+        self.thread = threading.Thread(target=self._run, name="journal", daemon=True)
+        self.thread.start()
+
+    def append(self, text, positions):
+        # Queues one history line; positions maps user name -> line number.
+        data = (json.dumps({"text": text, "to": positions}, ensure_ascii=False) + '\n').encode('utf-8')
+        with self.cond:
+            self.buf.append(data)
+            self.buf_bytes += len(data)
+            self.size += len(data)
+            if self.buf_bytes >= self.max_bytes:
+                self.cond.notify()
+
+    def _take(self):
+        # Swaps out the buffered records. Caller holds self.cond.
+        batch, self.buf, self.buf_bytes = self.buf, [], 0
+        return batch
+
+    def _write(self, batch):
+        # One write and one fsync for the whole batch.
+        with self.io_lock:
+            self.f.write(b''.join(batch))
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.commits += 1
+            self.records += len(batch)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                deadline = time.monotonic() + self.interval
+                while not self.closing and self.buf_bytes < self.max_bytes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = self._take()
+                closing = self.closing
+            if batch:
+                try:
+                    self._write(batch)
+                except OSError as e:
+                    print(f"[Journal] Commit to {self.path} failed: {e}")
+            if closing:
+                return
+
+    def commit(self):
+        # Writes and fsyncs everything appended so far, on the caller's thread.
+        with self.cond:
+            batch = self._take()
+        if batch:
+            self._write(batch)
+
+    def rotate(self):
+        # Commits what is buffered, renames the journal to a retired file and
+        # starts a new one. Returns the retired file's path: the caller
+        # deletes it once every line in it is in a history on disk. Until
+        # then a crash simply replays it too.
+        with self.io_lock, self.cond:
+            batch = self._take()
+            self.f.write(b''.join(batch))
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.f.close()
+            retired = f"{self.path}.{time.time_ns()}"
+            os.replace(self.path, retired)
+            self.f = open(self.path, 'ab')
+            self.size = 0
+        return retired
+
+    def close(self):
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.thread.join()
+        self.f.close()
+
+def read_records(path):
+    # Yields (text, positions) for every complete record in a journal file.
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break # Torn by the crash; it was never committed.
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            yield record["text"], record["to"]
+
+def _journal_order(path):
+    # Sort key: each stream's retired journals (<live path>.<time_ns>),
+    # oldest first, then its live journal.
+    base, _, suffix = path.rpartition('.')
+    if suffix.isdigit() and len(suffix) >= 16: # time_ns(), not a worker id.
+        return (base, 0, int(suffix))
+    return (path, 1, 0)
+
+def leftover_journals(path=JOURNAL_FILE):
+    # The journal at path plus any retired or per-worker journals next to
+    # it, in the order their records were written.
+    return sorted(glob.glob(glob.escape(path) + '*'), key=_journal_order)
+
+def replay(paths, history_path=lambda name: name + indexer.HIST_SUFFIX):
+    # Appends every journaled line missing from its user's history, makes
+    # the histories durable, then deletes the journals. Returns the number
+    # of lines recovered. Each line goes in at the line number it was
+    # journaled with; a user's lines past a gap are not replayed, as they
+    # would be renumbered.
+    journaled = {} # name -> {line number: text}
+    for path in paths:
+        for text, positions in read_records(path):
+            for name, n in positions.items():
+                journaled.setdefault(name, {}).setdefault(n, text)
+    histories = {}
+    recovered = 0
+    for name, lines in journaled.items():
+        history = histories[name] = indexer.SegmentedHistory.open(history_path(name))
+        for n in sorted(lines):
+            if n < len(history):
+                continue # Already there (saved at logout or by an earlier replay).
+            if n > len(history):
+                print(f"[Journal] {name}: lines {len(history)}-{n - 1} are missing, not replaying lines {n}-{max(lines)}.")
+                break
+            history.append([lines[n]])
+            recovered += 1
+    for history in histories.values():
+        history.flush()
+    for path in paths:
+        os.remove(path)
+    return recovered
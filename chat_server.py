@@ -1,65 +1,285 @@
 
 import time
 import socket
-import select
+import selectors
+import os
 import sys
+import itertools
+import threading
+import multiprocessing
+import collections
+import concurrent.futures
 import indexer
+import chat_journal
 import json
-import pickle as pkl
+import signal
 from chat_utils import *
 import chat_group as grp
 
+# Upper bound on the buffers handed to one sendmsg() call.
+try:
+    IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg') # Not available on Windows.
+
+class Connection:
+    # Per-socket state registered with the selector. `on_frame` is the
+    # handler each complete frame is dispatched to: login until the user is
+    # known, then the main message switchboard.
+    def __init__(self, sock, address, on_frame):
+        self.sock = sock
+        self.address = address
+        self.on_frame = on_frame
+        self.decoder = FrameDecoder() # Buffers partial frames between reads.
+        self.outbound = collections.deque() # Encoded frames (or their unsent tails) waiting for EVENT_WRITE.
+        self.out_bytes = 0 # Total size of self.outbound.
+        self.want_write = False # Registered for EVENT_WRITE because the socket buffer filled up.
+        self.evicted = False # Slow consumer, closed at the end of the current loop iteration.
+        self.closed = False
+
+class LatencyHistogram:
+    # Per-action call counter and latency histogram. Bucket i counts calls
+    # that took less than 2**i microseconds (and at least 2**(i-1)), so
+    # recording is O(1) and quantiles are accurate to a factor of two.
+    BUCKETS = 32
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0 # Calls that raised.
+        self.total_ns = 0
+        self.max_ns = 0
+        self.buckets = [0] * self.BUCKETS
+
+    def record(self, ns, error=False):
+        self.count += 1
+        self.errors += error
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+        self.buckets[min((ns // 1000).bit_length(), self.BUCKETS - 1)] += 1
+
+    def quantile(self, q):
+        # Upper bound, in microseconds, of the bucket holding the q-th quantile.
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return 2 ** i
+        return 0
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_us": round(self.total_ns / self.count / 1000, 1) if self.count else 0,
+            "p50_us": self.quantile(0.5),
+            "p99_us": self.quantile(0.99),
+            "p999_us": self.quantile(0.999),
+            "max_us": round(self.max_ns / 1000, 1),
+            "buckets": {f"<{2 ** i}us": n for i, n in enumerate(self.buckets) if n},
+        }
+
+class SonnetCorpus:
+    # A loaded poem corpus and the replies made from it: every "poem" reply
+    # framed in advance, and an LRU of other framed replies. A reload builds
+    # a whole new one and swaps it in with a single assignment; handlers
+    # read server.corpus once, so a request is answered from one version.
+    def __init__(self, path):
+        self.path = path
+        self.sources = self.stamp(path) # Taken first: an edit made while loading shows up as a change.
+        self.index = indexer.PIndex.open(path) # Mapped from path + '.snap' when that is current.
+        self.poem_frames = {p: encode_frame(json.dumps({"action":"poem", "results":text})) for p, text in self.index.poem_texts.items()}
+        self.reply_frames = collections.OrderedDict() # (action, request...) -> framed reply, least recently used first
+
+    @staticmethod
+    def stamp(path):
+        # Modification times of the files a corpus is built from.
+        stamps = []
+        for f in (path, indexer.PIndex.NUMERALS):
+            try:
+                stamps.append(os.stat(f).st_mtime_ns)
+            except OSError:
+                stamps.append(None)
+        return tuple(stamps)
+
 class Server:
     def __init__(self):
-        self.new_clients = [] #list of new sockets of which the user id is not known
+        self.conns = {} # dict mapping socket to its Connection state (logged in or not)
         self.logged_name2sock = {} #dictionary mapping username to socket
         self.logged_sock2name = {} # dict mapping socket to user name
-        self.all_sockets = []
+        self.selector = selectors.DefaultSelector() # epoll/kqueue where available, no FD_SETSIZE cap
+        self.out_high_water = OUT_HIGH_WATER # Per-connection outbound backlog limit in bytes.
+        self.out_overflow = OUT_OVERFLOW # 'disconnect' or 'drop' once the limit is hit.
+        self.evicted_socks = [] # Slow consumers waiting to be closed outside of any send loop.
+        self.pending_flush = {} # Connections with frames queued this iteration (dict used as an ordered set).
         self.group = grp.Group()
         self.user_profile_info = {} # To store PFP URLs and other info
         self.board = [] # Stores the current Tic-Tac-Toe game board.
 
+        # Action registry: every do_<action> method handles <action>; more can be
+        # added with register_action(). Each dispatch is timed into action_stats.
+        self.actions = {name[3:]: getattr(self, name) for name in dir(self) if name.startswith('do_')}
+        self.action_stats = collections.defaultdict(LatencyHistogram)
+        if hasattr(signal, 'SIGUSR1'): # kill -USR1 <pid> prints the table to the log.
+            try:
+                signal.signal(signal.SIGUSR1, lambda signum, frame: self.print_action_stats())
+            except ValueError: # Not the main thread.
+                pass
+
         # Tic-Tac-Toe specific attributes for stats
         self.game_stats = {}   # Stores player game statistics (wins, losses, streaks)
         self.stats_file = "tictactoe_stats.json" # File to store Tic-Tac-Toe game statistics.
         self._load_game_stats() # Load stats on server startup
 
         #start server
-        self.server=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.bind(SERVER)
-        self.server.listen(5)
-        self.all_sockets.append(self.server)
-        #initialize past chat indices
-        self.indices={}
+        self.listen()
+        #initialize past chat indices; loaded on first use, evicted under memory pressure
+        self.indices = indexer.IndexCache(self._open_index, self.evict_index, INDEX_CACHE_BYTES)
+        self.index_saver = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="index-save")
+        self.evicted_saves = {} # name -> (SegmentedHistory, future of its flush) for evicted indices
+        self.store = indexer.MessageStore() # Every chat line of this run, stored and tokenized once; indices hold ids into it.
+        self.journal_rotate_bytes = JOURNAL_ROTATE_BYTES
+        self.journal = self.open_journal() # Write-ahead log of history lines not yet saved to disk.
         # sonnet
         try:
-            self.sonnet = indexer.PIndex("AllSonnets.txt")
+            self.corpus = SonnetCorpus(POEM_FILE)
+            # The dictionary search corrections fall back on; built aside so startup does not wait for it.
+            threading.Thread(target=self.corpus.index.speller, name="sonnet-speller", daemon=True).start()
         except Exception as e:
             print(f"ERROR: Failed to initialize PIndex: {e}")
             import traceback
             traceback.print_exc()
             sys.exit(1) # Exit explicitly if PIndex fails
-    def new_client(self, sock):
-        # Registers a new client socket.
+        # Reloaded in the background on kill -HUP <pid>, or when its files change.
+        self.reloading = threading.Lock() # Held while a reload runs.
+        if hasattr(signal, 'SIGHUP'):
+            try:
+                signal.signal(signal.SIGHUP, lambda signum, frame: self.reload_poems())
+            except ValueError: # Not the main thread.
+                pass
+        if POEM_WATCH_INTERVAL:
+            threading.Thread(target=self.watch_poems, name="poem-watch", daemon=True).start()
+    def listen(self):
+        # Binds the listening socket and registers it with the selector.
+        self.server=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Rebind right after a restart despite TIME_WAIT.
+        self.server.bind(SERVER)
+        self.server.listen(socket.SOMAXCONN)
+        self.server.setblocking(0)
+        self.selector.register(self.server, selectors.EVENT_READ, None) # data=None marks the listening socket
+
+    def new_client(self, sock, address=None):
+        # Registers a new client socket. It stays in the login state until a valid login arrives.
         print('new client...')
         sock.setblocking(0)
-        self.new_clients.append(sock)
-        self.all_sockets.append(sock)
+        conn = Connection(sock, address, self.login)
+        self.conns[sock] = conn
+        self.selector.register(sock, selectors.EVENT_READ, conn)
 
-    def login(self, sock):
-        # Processes a login attempt from a new client.
-        try:
-            raw_msg = myrecv(sock) # Receive the login message.
-            if not raw_msg: # Client disconnected before sending login information.
-                print(f"Client {sock.getpeername()} disconnected before sending login info.")
-                # Clean up socket if client disconnected before login.
-                if sock in self.all_sockets:
-                    self.all_sockets.remove(sock)
-                if sock in self.new_clients:
-                    self.new_clients.remove(sock)
-                sock.close()
+    def drop_client(self, sock):
+        # Unregisters and closes a socket that is not (or no longer) logged in.
+        conn = self.conns.pop(sock, None)
+        if conn is not None:
+            conn.closed = True
+        if sock.fileno() != -1:
+            self.selector.unregister(sock)
+            sock.close()
+        if conn is not None: # Release buffered frames right away.
+            conn.outbound.clear()
+            conn.out_bytes = 0
+
+    def send_to(self, sock, msg):
+        # Frames msg and queues it for sock. Never blocks the event loop.
+        self.queue_frame(sock, encode_frame(msg))
+
+    def broadcast(self, socks, msg):
+        # Fan-out: the frame is encoded once and the same immutable bytes
+        # object is queued for every recipient.
+        frame = encode_frame(msg)
+        for sock in socks:
+            self.queue_frame(sock, frame)
+
+    def queue_frame(self, sock, data):
+        # Buffers an encoded frame for sock. Frames queued during one loop
+        # iteration are written together by flush_pending(), one sendmsg()
+        # per connection instead of one send() per frame.
+        conn = self.conns.get(sock)
+        if conn is None or conn.closed or conn.evicted:
+            return
+        # Only whole frames are refused; the head of the queue may be a frame that went out partially.
+        if conn.outbound and conn.out_bytes + len(data) > self.out_high_water:
+            if self.out_overflow == 'drop':
+                print(f"[Server Log] Outbound buffer full for {self.logged_sock2name.get(sock, conn.address)}, dropping frame.")
                 return
+            print(f"[Server Log] {self.logged_sock2name.get(sock, conn.address)} is not reading ({conn.out_bytes} bytes queued), disconnecting.")
+            self.evict(conn)
+            return
+        conn.outbound.append(data)
+        conn.out_bytes += len(data)
+        if not conn.want_write: # Otherwise EVENT_WRITE will tell us when there is room.
+            self.pending_flush[conn] = None
+
+    def flush_pending(self):
+        for conn in self.pending_flush:
+            if not conn.closed:
+                self.flush_client(conn)
+        self.pending_flush.clear()
+
+    def flush_client(self, conn):
+        # Drains the outbound queue while the socket accepts data, handing up
+        # to IOV_MAX queued frames to the kernel per call.
+        sock = conn.sock
+        while conn.outbound:
+            try:
+                if HAVE_SENDMSG:
+                    sent = sock.sendmsg(list(itertools.islice(conn.outbound, IOV_MAX)))
+                else:
+                    sent = sock.send(conn.outbound[0])
+            except BlockingIOError:
+                break
+            except OSError as e:
+                print(f"[Server Log] Send to {self.logged_sock2name.get(sock, conn.address)} failed: {e}.")
+                self.evict(conn)
+                return
+            conn.out_bytes -= sent
+            while sent: # Retire every buffer that went out completely.
+                head = conn.outbound[0]
+                if sent < len(head):
+                    conn.outbound[0] = memoryview(head)[sent:]
+                    break
+                sent -= len(head)
+                conn.outbound.popleft()
+        want_write = bool(conn.outbound)
+        if want_write != conn.want_write:
+            conn.want_write = want_write
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if want_write else selectors.EVENT_READ
+            self.selector.modify(sock, events, conn)
+
+    def evict(self, conn):
+        # Schedules a connection to be closed. Closing right away could mutate
+        # logged_name2sock while a broadcast is iterating over it.
+        if not conn.evicted:
+            conn.evicted = True
+            self.evicted_socks.append(conn.sock)
 
+    def close_evicted(self):
+        for sock in self.evicted_socks:
+            if sock in self.conns:
+                self.close_client(sock)
+        self.evicted_socks = []
+
+    def close_client(self, sock):
+        # Logs out a logged-in user, or just drops a socket that never logged in.
+        if sock in self.logged_sock2name:
+            self.logout(sock)
+        else:
+            self.drop_client(sock)
+
+    def login(self, sock, raw_msg):
+        # Processes a login attempt from a new client.
+        try:
             msg = json.loads(raw_msg)
             print("login:", msg)
             if len(msg) > 0:
@@ -69,58 +289,173 @@ class Server:
                     
                     if self.group.is_member(name) != True:
                         # If username is not taken, log in the user.
-                        self.new_clients.remove(sock)
+                        self.conns[sock].on_frame = self.handle_msg
                         # Map username to socket and vice-versa.
                         self.logged_name2sock[name] = sock
                         self.logged_sock2name[sock] = name
-                        # Load or create chat history index for the user.
-                        if name not in self.indices.keys():
-                            try:
-                                # Attempt to load existing chat history.
-                                self.indices[name]=pkl.load(open(name+'.idx','rb'))
-                            except IOError: # If chat history index doesn't exist, create a new one.
-                                self.indices[name] = indexer.Index(name)
+                        # The user's chat history index is loaded when first needed.
+                        self.indices.open(name)
                         print(name + ' logged in')
                         self.group.join(name)
                         # Initialize user profile information if it's their first login.
                         if name not in self.user_profile_info:
                             self.user_profile_info[name] = {"pfp_url": None}
-                        mysend(sock, json.dumps({"action":"login", "status":"ok"}))
+                        self.send_to(sock, json.dumps({"action":"login", "status":"ok"}))
                     else: # Handle duplicate login attempt.
-                        mysend(sock, json.dumps({"action":"login", "status":"duplicate"}))
+                        self.send_to(sock, json.dumps({"action":"login", "status":"duplicate"}))
                         print(name + ' duplicate login attempt')
                 else:
                     print ('wrong code received') # Incorrect action received from client.
-            else: # Handle unexpected client disconnection during login.
-                # This might be redundant if the initial `not raw_msg` check catches disconnection.
-                self.logout(sock)
+            else: # Empty login message, nothing to log in with.
+                self.drop_client(sock)
         except json.JSONDecodeError:
             peer_name_info = sock.getpeername() if sock.fileno() != -1 else "already closed socket"
             print(f"Login: Received malformed JSON from {peer_name_info}.")
-            if sock.fileno() != -1: # Check if socket is still open before attempting to close.
-                if sock in self.new_clients: self.new_clients.remove(sock)
-                if sock in self.all_sockets: self.all_sockets.remove(sock)
-                sock.close()
+            self.drop_client(sock)
             return # Stop further processing for this socket.
         except Exception as e: # Catch other potential errors during login.
             peer_name_info = sock.getpeername() if sock.fileno() != -1 else "already closed socket"
             print(f"Error during login for {peer_name_info}: {e}")
-            if sock.fileno() != -1:
-                if sock in self.new_clients: self.new_clients.remove(sock)
-                if sock in self.all_sockets: self.all_sockets.remove(sock)
-                sock.close()
+            self.drop_client(sock)
             return
 
     def logout(self, sock):
         # Handles user logout.
         name = self.logged_sock2name[sock]
-        pkl.dump(self.indices[name], open(name + '.idx','wb'))
-        del self.indices[name]
+        index = self.indices.close(name)
+        if index is not None: # Not resident means nothing unsaved.
+            self.save_index(name, index)
+        self.trim_store()
         del self.logged_name2sock[name]
         del self.logged_sock2name[sock]
-        self.all_sockets.remove(sock)
         self.group.leave(name)
-        sock.close()
+        self.drop_client(sock)
+
+    def _open_index(self, name):
+        # IndexCache loader: the user's history, with this session's lines
+        # going to the shared store.
+        index = self.load_index(name)
+        index.share_store(self.store)
+        return index
+
+    def load_index(self, name):
+        # Opens a user's chat history. Only the segment headers and the short
+        # tail are read here; segments load on the first search.
+        if os.path.exists(name + '.idx') and not os.path.exists(name + indexer.HIST_SUFFIX):
+            print(f"[Server Warning] {name}.idx is in the old pickle format and is not read; run migrate_idx.py.")
+        return indexer.Index(name, past=indexer.SegmentedHistory.open(name + indexer.HIST_SUFFIX))
+
+    def save_index(self, name, index):
+        # Appends this session's lines to the user's history; older lines
+        # are never rewritten.
+        index.checkpoint()
+        index.past.flush()
+
+    def evict_index(self, name, index):
+        # IndexCache eviction, which happens in the middle of whichever
+        # request went over the budget: the lines go to the history in
+        # memory here and the write, fsync included, to the index-save
+        # thread. Until it is done the lines are in the journal, and a
+        # rotation waits for it. Logging in again meanwhile gets the same
+        # history back from SegmentedHistory.open.
+        index.checkpoint()
+        history = index.past
+        self.evicted_saves = {n: save for n, save in self.evicted_saves.items() if not save[1].done()}
+        future = self.index_saver.submit(history.flush)
+        future.add_done_callback(lambda f: f.exception() and print(f"[Server Log] Error saving index for {name}: {f.exception()}"))
+        self.evicted_saves[name] = (history, future)
+
+    def open_journal(self):
+        # Recovers the lines of sessions a crash cut short, then starts a
+        # fresh journal.
+        leftovers = chat_journal.leftover_journals(JOURNAL_FILE)
+        if leftovers:
+            recovered = chat_journal.replay(leftovers)
+            if recovered:
+                print(f"[Server Log] Recovered {recovered} chat lines from {len(leftovers)} journal file(s).")
+        return chat_journal.Journal(JOURNAL_FILE)
+
+    def housekeeping(self):
+        # Runs after each batch of events.
+        evictions = self.indices.evictions
+        self.indices.enforce()
+        if self.indices.evictions != evictions: # Evicted sessions no longer pin the store.
+            self.trim_store()
+        self.rotate_journal()
+
+    def reload_poems(self):
+        # Builds the poem corpus afresh and swaps it in, all on a background
+        # thread, while requests go on being answered from the current one.
+        # Returns False if a reload is already running.
+        if not self.reloading.acquire(blocking=False):
+            return False
+        threading.Thread(target=self._reload_poems, name="poem-reload", daemon=True).start()
+        return True
+
+    def _reload_poems(self):
+        try:
+            start = time.perf_counter()
+            path = self.corpus.path
+            if SonnetCorpus.stamp(path) != self.corpus.sources:
+                # Indexing the text is CPU work: a separate process does it
+                # and leaves a snapshot, so this process only maps it in.
+                builder = multiprocessing.get_context('spawn').Process(target=indexer.PIndex.open, args=(path,), daemon=True)
+                builder.start()
+                builder.join()
+            corpus = SonnetCorpus(path)
+            corpus.index.speller()
+            self.corpus = corpus # The swap: one assignment.
+            print(f"[Server Log] Reloaded {path}: {len(corpus.index.poem_texts)} sonnets in {time.perf_counter() - start:.2f}s.")
+        except Exception as e:
+            print(f"[Server Log] Reloading the poems failed, still serving the old ones: {e}")
+        finally:
+            self.reloading.release()
+
+    def watch_poems(self):
+        # Reloads the poems once their files have changed and then stayed
+        # the same for one POEM_WATCH_INTERVAL (so a file being written is
+        # not picked up half done).
+        seen = self.corpus.sources
+        while True:
+            time.sleep(POEM_WATCH_INTERVAL)
+            stamp = SonnetCorpus.stamp(self.corpus.path)
+            if stamp != self.corpus.sources and stamp == seen and None not in stamp:
+                self.reload_poems()
+            seen = stamp
+
+    def rotate_journal(self):
+        # Once the journal is large, saves every logged-in user's session so
+        # far to their history and switches to a new journal file. The old
+        # file is deleted only after those histories are on disk.
+        if self.journal.size < self.journal_rotate_bytes:
+            return
+        histories = []
+        for index in self.indices.values():
+            index.checkpoint()
+            histories.append(index.past)
+        retired = self.journal.rotate()
+        self.finish_journal_rotation(histories, retired)
+        self.trim_store()
+
+    def finish_journal_rotation(self, histories, retired):
+        # Evicted histories still being written are flushed here too; flush()
+        # waits for a write in progress and then adds whatever it missed.
+        histories = histories + [history for history, future in self.evicted_saves.values()]
+        self.evicted_saves = {}
+        for history in histories:
+            history.flush()
+        os.remove(retired)
+        print(f"[Server Log] Journal rotated, {len(histories)} histories saved.")
+
+    def trim_store(self):
+        # Releases the oldest shared messages once no logged-in user's
+        # history refers to them. Only runs when at least half of the store
+        # can go, so the cost is amortized over the messages released.
+        first_ids = [index.first_msg_id() for index in self.indices.values()]
+        first_live = min([i for i in first_ids if i is not None], default=len(self.store))
+        if 2 * (first_live - self.store.base) >= self.store.live() > 0:
+            released = self.store.trim(first_live)
+            print(f"[Server Log] Released {released} chat lines from the shared store.")
 
     # --- Tic-Tac-Toe Statistics Helper Methods ---
     def _load_game_stats(self):
@@ -138,9 +473,13 @@ class Server:
 
     def _save_game_stats(self):
         # Saves Tic-Tac-Toe game statistics to a JSON file.
+        self._write_game_stats(json.dumps(self.game_stats, indent=4))
+
+    def _write_game_stats(self, stats_json):
+        # Writes an already serialized snapshot of the stats (the asyncio server runs this off the loop).
         try:
             with open(self.stats_file, 'w') as f:
-                json.dump(self.game_stats, f, indent=4)
+                f.write(stats_json)
             print(f"[GameServer] Tic-Tac-Toe stats saved to {self.stats_file}.")
         except IOError as e:
             print(f"[GameServer] Error saving Tic-Tac-Toe stats to '{self.stats_file}': {e}")
@@ -207,10 +546,39 @@ class Server:
         
         if announcement:
             print(f"[GameServer] Broadcasting game result: {announcement}")
-            for name, sock_to_send in self.logged_name2sock.items():
-                system_msg_payload = {"action": "exchange", "from": "[GameServer]", "message": announcement}
-                mysend(sock_to_send, json.dumps(system_msg_payload))
+            system_msg_payload = {"action": "exchange", "from": "[GameServer]", "message": announcement}
+            self.broadcast(self.logged_name2sock.values(), json.dumps(system_msg_payload))
         
+    def _fan_out_chat(self, from_name, names, msg, channel=None):
+        # Adds a chat line to the sender's and every recipient's history and
+        # delivers it to the recipients. `names` must not include the sender.
+        processed_msg = text_proc(msg["message"], from_name) # Process message text (e.g., add timestamp).
+        payload = {"action":"exchange", "from": msg["from"], "message": msg["message"]}
+        if channel is not None:
+            payload["channel"] = channel
+        msg_id = self.store.add(processed_msg) # Stored and tokenized once for everyone.
+        self.deliver_chat([from_name], processed_msg, None, msg_id)
+        self.deliver_chat(names, processed_msg, json.dumps(payload), msg_id)
+
+    def deliver_chat(self, names, processed_msg, payload, msg_id=None):
+        # Appends processed_msg (already in self.store as msg_id, or added
+        # here) to each user's history and, unless payload is None, sends it
+        # to all of them with a single encode. The line is journaled first so
+        # that a crash before logout does not lose it.
+        if msg_id is None:
+            msg_id = self.store.add(processed_msg)
+        positions = {}
+        for name in names:
+            if name in self.indices:
+                positions[name] = self.indices[name].total_msgs # Line number it gets in name's history.
+                self.indices[name].add_msg_id(msg_id)
+            else:
+                print(f"[Server Warning] No index found for {name}.")
+        if positions:
+            self.journal.append(processed_msg, positions)
+        if payload is not None:
+            self.broadcast([self.logged_name2sock[name] for name in names], payload)
+
     def check_winners(self):
         # Checks the Tic-Tac-Toe board for a win, tie, or if the game should continue.
         # This method directly uses `self.board`.
@@ -251,8 +619,8 @@ class Server:
 #==============================================================================
 # Main command switchboard for handling client messages.
 #==============================================================================
-    def handle_msg(self, from_sock):
-        # Reads and processes a message from a client socket.
+    def handle_msg(self, from_sock, msg_content):
+        # Processes one message (a complete frame) from a logged-in client.
         try:
             # Get client identifier for logging purposes.
             client_identifier = self.logged_sock2name.get(from_sock)
@@ -264,19 +632,7 @@ class Server:
                     # Further fallback if socket details are unavailable (e.g., socket closed).
                     client_identifier = f"Unknown/Pre-Login Socket ({from_sock.fileno()})"
 
-            print(f"[Server Log] Attempting to receive message from {client_identifier}...")
-            msg_content = myrecv(from_sock) # Receive message from the client.
-            print(f"[Server Log] Received from {client_identifier}: {len(msg_content) if msg_content is not None else 'None'} bytes")
-
-            if not msg_content: # Client disconnected gracefully.
-                print(f"[Server Log] Client {client_identifier} disconnected gracefully (received empty message). Logging out.")
-                if from_sock in self.logged_sock2name: # Logout user if they were logged in.
-                     self.logout(from_sock)
-                else: # Clean up if it was a new client that disconnected before full login.
-                    if from_sock in self.all_sockets: self.all_sockets.remove(from_sock)
-                    if from_sock in self.new_clients: self.new_clients.remove(from_sock)
-                    if from_sock.fileno() != -1: from_sock.close() # Ensure socket is closed.
-                return
+            print(f"[Server Log] Received from {client_identifier}: {len(msg_content)} chars")
 
             # Attempt to parse the message as JSON.
             try:
@@ -287,211 +643,7 @@ class Server:
                 # Do not process further if JSON is malformed.
                 return
 
-            # --- Main message handling logic based on 'action' ---
-            
-            # Handle 'connect' request: Establishes a chat connection between two users.
-            if msg["action"] == "connect":
-                to_name = msg["target"]
-                from_name = self.logged_sock2name[from_sock]
-                if to_name == from_name: # User trying to connect to themselves.
-                    msg_resp = json.dumps({"action":"connect", "status":"self"})
-                elif self.group.is_member(to_name): # Target user is online.
-                    to_sock = self.logged_name2sock[to_name]
-                    self.group.connect(from_name, to_name) # Update group state.
-                    the_guys = self.group.list_me(from_name)
-                    msg_resp = json.dumps({"action":"connect", "status":"success"})
-                    # Notify other members of the group about the new connection.
-                    for g in the_guys[1:]:
-                        to_sock_peer = self.logged_name2sock[g]
-                        mysend(to_sock_peer, json.dumps({"action":"connect", "status":"request", "from":from_name}))
-                else: # Target user is not online.
-                    msg_resp = json.dumps({"action":"connect", "status":"no-user"})
-                mysend(from_sock, msg_resp)
-            
-            # Handle 'exchange' request: Broadcasts a message to other connected users.
-            elif msg["action"] == "exchange":
-                from_name = self.logged_sock2name[from_sock]
-                # Process message text (e.g., add timestamp).
-                processed_msg = text_proc(msg["message"], from_name)
-                # Add message to sender's chat history index.
-                if from_name in self.indices:
-                    self.indices[from_name].add_msg_and_index(processed_msg)
-                else:
-                    print(f"[Server Warning] No index found for sender {from_name} during exchange.")
-
-                print(f"[Server] Broadcasting message from {from_name} to all users.")
-                # Send message to all other logged-in users.
-                for name, to_sock in self.logged_name2sock.items():
-                    if name != from_name: # Don't send message back to the sender.
-                        # Add message to recipient's chat history index.
-                        if name in self.indices:
-                             self.indices[name].add_msg_and_index(processed_msg)
-                        else:
-                             print(f"[Server Warning] No index found for recipient {name} during exchange.")
-                        mysend(to_sock, json.dumps({"action":"exchange", "from": msg["from"], "message": msg["message"]}))
-            
-            # Handle 'list' request: Sends a list of online users to the requester.
-            elif msg["action"] == "list":
-                user_list_data = []
-                for name in self.logged_name2sock.keys():
-                    pfp_url = self.user_profile_info.get(name, {}).get("pfp_url")
-                    user_list_data.append({"name": name, "pfp_url": pfp_url})
-                mysend(from_sock, json.dumps({"action":"list", "results": user_list_data}))
-            
-            # Handle 'poem' request: Retrieves and sends a specific sonnet.
-            elif msg["action"] == "poem":
-                poem_indx = int(msg["target"])
-                from_name = self.logged_sock2name[from_sock]
-                print(f"{from_name} asks for poem {poem_indx}")
-                try:
-                    poem = self.sonnet.get_poem(poem_indx)
-                    poem_text = '\n'.join(poem)
-                    print('Sending poem:\n', poem_text)
-                    mysend(from_sock, json.dumps({"action":"poem", "results":poem_text}))
-                except IndexError: # Requested poem index is out of range.
-                     mysend(from_sock, json.dumps({"action":"poem", "results":"Poem index out of range."}))
-                except Exception as e: # Other errors during poem retrieval.
-                     print(f"Error retrieving poem {poem_indx}: {e}")
-                     mysend(from_sock, json.dumps({"action":"poem", "results":"Error retrieving poem."}))
-            
-            # Handle 'time' request: Sends the current server time.
-            elif msg["action"] == "time":
-                ctime = time.strftime("%I:%M%p", time.localtime())
-                mysend(from_sock, json.dumps({"action":"time", "results":ctime}))
-            
-            # Handle 'private_message' request: Sends a message to a specific user.
-            elif msg["action"] == "private_message":
-                target_username = msg.get("to")
-                message_text = msg.get("message")
-                if not target_username or not message_text: # Validate request.
-                    status_payload = {"action": "private_message_status", "to": target_username or "N/A", "status": "error_bad_request", "detail": "Missing 'to' or 'message' field."}
-                    mysend(from_sock, json.dumps(status_payload))
-                else:
-                    sender_username = self.logged_sock2name[from_sock]
-                    if target_username == sender_username: # User trying to PM themselves.
-                        status_payload = {"action": "private_message_status", "to": target_username, "status": "error_self_message", "detail": "Cannot send private message to yourself."}
-                        mysend(from_sock, json.dumps(status_payload))
-                    elif target_username in self.logged_name2sock: # Target user is online.
-                        target_sock = self.logged_name2sock[target_username]
-                        payload_for_recipient = {"action": "incoming_private_message", "from": f"[PM from {sender_username}]", "message": message_text}
-                        mysend(target_sock, json.dumps(payload_for_recipient))
-                        # Confirm PM sent to the sender.
-                        status_payload_to_sender = {"action": "private_message_status", "to": target_username, "status": "sent", "detail": f"PM sent to {target_username}."}
-                        mysend(from_sock, json.dumps(status_payload_to_sender))
-                    else: # Target user is offline.
-                        status_payload = {"action": "private_message_status", "to": target_username, "status": "error_user_offline", "detail": f"User {target_username} is not online."}
-                        mysend(from_sock, json.dumps(status_payload))
-            
-            # Handle 'search' request: Searches user's chat history for a term.
-            elif msg["action"] == "search":
-                term = msg["target"]
-                from_name = self.logged_sock2name[from_sock]
-                print(f'Search request from {from_name} for "{term}"')
-                if from_name in self.indices: # Check if user has a chat history index.
-                    search_rslt_list = [x[-1] for x in self.indices[from_name].search(term)]
-                    search_rslt = '\n'.join(search_rslt_list)
-                    print(f'Server side search result: {search_rslt}')
-                    mysend(from_sock, json.dumps({"action":"search", "results":search_rslt}))
-                else: # User has no chat history index.
-                    print(f"[Server Warning] No index found for {from_name} during search.")
-                    mysend(from_sock, json.dumps({"action":"search", "results":"Search index not available."}))
-            
-            # Handle 'set_profile_pic' request: Updates user's profile picture URL.
-            elif msg["action"] == "set_profile_pic":
-                from_name = self.logged_sock2name[from_sock]
-                pfp_url = msg.get("url")
-                if pfp_url is not None: # Validate URL presence.
-                    if from_name in self.user_profile_info:
-                        self.user_profile_info[from_name]["pfp_url"] = pfp_url
-                        status_payload = {"action": "set_profile_pic_status", "status": "ok", "detail": "Profile picture updated."}
-                    else: # Should not happen if user is logged in, but handle defensively.
-                        self.user_profile_info[from_name] = {"pfp_url": pfp_url}
-                        status_payload = {"action": "set_profile_pic_status", "status": "ok", "detail": "Profile picture set."}
-                    print(f"User {from_name} set PFP URL to: {pfp_url}")
-                else: # URL missing in request.
-                    status_payload = {"action": "set_profile_pic_status", "status": "error_bad_request", "detail": "Missing 'url' field."}
-                mysend(from_sock, json.dumps(status_payload))
-            
-            # Handle 'start_ttt' request: Initiates a Tic-Tac-Toe game.
-            elif msg["action"] == "start_ttt":
-                self.board = [[0, 0, 0], [0, 0, 0], [0, 0, 0]] # Reset/Initialize board.
-                from_name = self.logged_sock2name[from_sock]
-                to_name = msg["target"]
-                if to_name == from_name: # User trying to play against themselves.
-                    mysend(from_sock, json.dumps({"action":"open_ttt", "status":"self"}))
-                else: # Valid opponent.
-                    print("Currently logged in:", list(self.logged_name2sock.keys()))
-                    print("Looking for:", to_name)
-                    if not hasattr(self, 'ttt_pairs'): # Initialize ttt_pairs if it doesn't exist.
-                        self.ttt_pairs = {}
-                    self.ttt_pairs[from_name] = to_name # Store player pair.
-                    self.ttt_pairs[to_name] = from_name
-                    to_sock = self.logged_name2sock[to_name]
-                    # Notify both players to open the TTT game window, assigning symbols.
-                    mysend(from_sock, json.dumps({"action":"open_ttt", "status":"ok", "from":from_name, "symbol":"X"}))
-                    mysend(to_sock, json.dumps({"action":"open_ttt", "status":"ok", "from":from_name, "symbol":"O"}))
-            
-            # Handle 'move' request: Processes a Tic-Tac-Toe game move.
-            elif msg["action"]=="move":
-                from_name = self.logged_sock2name[from_sock]
-                to_name = self.ttt_pairs[from_name]
-                to_sock = self.logged_name2sock[to_name]
-                row=int(msg["row"])
-                column=int(msg["column"])
-                # print(f"Server received move: {row},{column} from {from_name}") # Optional: less verbose log
-                if row not in range(3) or column not in range(3): # Validate move coordinates.
-                    print("Invalid move received: row/column out of range")
-                    return
-                
-                symbol_from_client = msg.get("from") # Symbol ('X' or 'O') sent by the client.
-                # print(f"Symbol in msg['from']: {symbol_from_client}") # Optional: less verbose log
-
-                self.board[row][column]=symbol_from_client # Update board state.
-                result=self.check_winners() # Check for win/tie/continue.
-                # print(f"check_winners result: {result}") # Optional: less verbose log
-                
-                if result[0] == "win": # Game won.
-                    winner_symbol = result[1]
-                    # Determine winner's name based on the winning symbol.
-                    actual_winner_name = from_name if symbol_from_client == winner_symbol else to_name
-                    # print(f"Game won by {actual_winner_name} with symbol {winner_symbol}") # Optional: less verbose log
-                    end_payload = {
-                        "action": "end", "status": "win",
-                        "winner": actual_winner_name, "winning_symbol": winner_symbol,
-                        "board": self.board
-                    }
-                    mysend(to_sock, json.dumps(end_payload))
-                    mysend(from_sock, json.dumps(end_payload))
-                    self._record_game_result(actual_winner_name,
-                                             to_name if actual_winner_name == from_name else from_name,
-                                             is_tie=False)
-                elif result[0] == "tie": # Game is a tie.
-                    # print(f"Game is a tie. Board: {self.board}") # Optional: less verbose log
-                    end_payload = {
-                        "action": "end", "status": "tie",
-                        "winner": None, "board": self.board
-                    }
-                    mysend(to_sock, json.dumps(end_payload))
-                    mysend(from_sock, json.dumps(end_payload))
-                    self._record_game_result(from_name, to_name, is_tie=True)
-                else: # Game continues.
-                    mysend(to_sock, json.dumps({"action":"update", "status":"your turn", "from":from_name, "turn": to_name, "row":msg["row"], "column":msg["column"]}))
-                    mysend(from_sock, json.dumps({"action":"update", "status":"opponent turn", "from":from_name, "turn": to_name, "row":msg["row"], "column":msg["column"]}))
-                
-            # Handle 'disconnect' request: Disconnects a user from their current chat group.
-            elif msg["action"] == "disconnect":
-                from_name = self.logged_sock2name[from_sock]
-                the_guys = self.group.list_me(from_name)
-                self.group.disconnect(from_name) # Update group state.
-                the_guys.remove(from_name)
-                if len(the_guys) == 1: # If one person remains in the group, notify them.
-                    g = the_guys.pop()
-                    to_sock = self.logged_name2sock[g]
-                    mysend(to_sock, json.dumps({"action":"disconnect"}))
-            
-            # Handle unknown actions.
-            else:
-                print(f"[Server Warning] Unknown action received from {client_identifier}: {msg.get('action')}")
+            self.dispatch(from_sock, msg)
 
         except ConnectionResetError: # Client connection was forcibly closed.
             client_identifier_on_error = self.logged_sock2name.get(from_sock)
@@ -505,14 +657,11 @@ class Server:
             if from_sock in self.logged_sock2name:
                 self.logout(from_sock)
             else: # Clean up if error occurred for a non-fully-logged-in client.
-                if from_sock in self.all_sockets: self.all_sockets.remove(from_sock)
-                if from_sock in self.new_clients: self.new_clients.remove(from_sock)
-                if from_sock.fileno() != -1:
-                    try:
-                        from_sock.close()
-                        print(f"[Server Log] Closed socket for {client_identifier_on_error} after ConnectionResetError.")
-                    except socket.error as close_err:
-                         print(f"[Server Log] Error closing socket for {client_identifier_on_error} after ConnectionResetError: {close_err}")
+                try:
+                    self.drop_client(from_sock)
+                    print(f"[Server Log] Closed socket for {client_identifier_on_error} after ConnectionResetError.")
+                except socket.error as close_err:
+                     print(f"[Server Log] Error closing socket for {client_identifier_on_error} after ConnectionResetError: {close_err}")
             return # Stop processing for this socket.
 
         except (socket.error, BrokenPipeError) as e: # Other socket-related errors.
@@ -527,60 +676,446 @@ class Server:
             if from_sock in self.logged_sock2name:
                 self.logout(from_sock)
             else: # Clean up if error occurred for a non-fully-logged-in client.
-                if from_sock in self.all_sockets: self.all_sockets.remove(from_sock)
-                if from_sock in self.new_clients: self.new_clients.remove(from_sock)
-                if from_sock.fileno() != -1:
-                    try:
-                        from_sock.close()
-                        print(f"[Server Log] Closed socket for {client_identifier_on_error} after {type(e).__name__}.")
-                    except socket.error as close_err:
-                         print(f"[Server Log] Error closing socket for {client_identifier_on_error} after {type(e).__name__}: {close_err}")
+                try:
+                    self.drop_client(from_sock)
+                    print(f"[Server Log] Closed socket for {client_identifier_on_error} after {type(e).__name__}.")
+                except socket.error as close_err:
+                     print(f"[Server Log] Error closing socket for {client_identifier_on_error} after {type(e).__name__}: {close_err}")
+            return
+
+    def register_action(self, action, handler):
+        # Plugs in a handler(from_sock, msg) for a new (or replaced) action.
+        self.actions[action] = handler
+
+    def dispatch(self, from_sock, msg):
+        # Runs the handler registered for msg's action and records how long it
+        # took. A handler that fails on a bad request is logged and answered
+        # with an "error" reply; it must not take the server down with it.
+        action = msg.get("action")
+        handler = self.actions.get(action)
+        if handler is None:
+            print(f"[Server Warning] Unknown action received from {self.logged_sock2name.get(from_sock)}: {action}")
+            return
+        stats = self.action_stats[action]
+        start = time.perf_counter_ns()
+        try:
+            handler(from_sock, msg)
+        except OSError: # The client's socket; handle_msg logs the user out.
+            stats.record(time.perf_counter_ns() - start, error=True)
+            raise
+        except Exception as e:
+            stats.record(time.perf_counter_ns() - start, error=True)
+            print(f"[Server Log] {action} from {self.logged_sock2name.get(from_sock)} failed: {type(e).__name__}: {e}")
+            # "results" is empty so clients waiting on a reply read it as nothing found.
+            self.send_to(from_sock, json.dumps({"action":"error", "request":action, "results":"", "detail":f"{type(e).__name__}: {e}"[:200]}))
+            return
+        stats.record(time.perf_counter_ns() - start)
+
+    def action_stats_snapshot(self):
+        return {action: stats.snapshot() for action, stats in sorted(self.action_stats.items())}
+
+    def print_action_stats(self):
+        print(f"[Server Stats] {'action':<18} {'count':>9} {'errors':>7} {'mean us':>9} {'p50 us':>8} {'p99 us':>8} {'p999 us':>8} {'max us':>10}")
+        for action, row in self.action_stats_snapshot().items():
+            print(f"[Server Stats] {action:<18} {row['count']:>9} {row['errors']:>7} {row['mean_us']:>9} {row['p50_us']:>8} {row['p99_us']:>8} {row['p999_us']:>8} {row['max_us']:>10}")
+        print(f"[Server Stats] index cache: " + ", ".join(f"{k} {v}" for k, v in self.indices.stats().items()))
+
+#==============================================================================
+# Action handlers, one do_<action> method per client action.
+#==============================================================================
+    def do_connect(self, from_sock, msg):
+        # Establishes a chat connection between two users.
+        to_name = msg["target"]
+        from_name = self.logged_sock2name[from_sock]
+        if to_name == from_name: # User trying to connect to themselves.
+            msg_resp = json.dumps({"action":"connect", "status":"self"})
+        elif self.group.is_member(to_name): # Target user is online.
+            to_sock = self.logged_name2sock[to_name]
+            orphans = self.group.connect(from_name, to_name) # Update group state.
+            for g in orphans: # Left alone in from_name's previous group, as in do_disconnect.
+                self.send_to(self.logged_name2sock[g], json.dumps({"action":"disconnect"}))
+            the_guys = self.group.list_me(from_name)
+            msg_resp = json.dumps({"action":"connect", "status":"success"})
+            # Notify other members of the group about the new connection.
+            for g in the_guys[1:]:
+                to_sock_peer = self.logged_name2sock[g]
+                self.send_to(to_sock_peer, json.dumps({"action":"connect", "status":"request", "from":from_name}))
+        else: # Target user is not online.
+            msg_resp = json.dumps({"action":"connect", "status":"no-user"})
+        self.send_to(from_sock, msg_resp)
+
+    def do_exchange(self, from_sock, msg):
+        # Sends a message to the other members of the sender's chat group.
+        from_name = self.logged_sock2name[from_sock]
+        # Only the sender's room sees (and indexes) the message, so the cost is O(group size).
+        the_guys = self.group.list_me(from_name)
+        print(f"[Server] Routing message from {from_name} to its group ({len(the_guys) - 1} peers).")
+        self._fan_out_chat(from_name, the_guys[1:], msg)
+
+    def do_broadcast(self, from_sock, msg):
+        # The explicit global channel, sent to every logged-in user.
+        from_name = self.logged_sock2name[from_sock]
+        print(f"[Server] Broadcasting message from {from_name} to all users.")
+        self._fan_out_chat(from_name, [name for name in self.logged_name2sock if name != from_name], msg, channel="all")
+
+    def do_list(self, from_sock, msg):
+        # Sends a list of online users to the requester.
+        user_list_data = []
+        for name in self.logged_name2sock.keys():
+            pfp_url = self.user_profile_info.get(name, {}).get("pfp_url")
+            user_list_data.append({"name": name, "pfp_url": pfp_url})
+        self.send_to(from_sock, json.dumps({"action":"list", "results": user_list_data}))
+
+    def do_poem(self, from_sock, msg):
+        # Sends a specific sonnet, framed in advance; unknown numbers get
+        # an empty result.
+        try:
+            poem_indx = int(msg.get("target"))
+        except (TypeError, ValueError):
+            poem_indx = None
+        from_name = self.logged_sock2name[from_sock]
+        print(f"{from_name} asks for poem {poem_indx}")
+        frame = self.corpus.poem_frames.get(poem_indx)
+        if frame is None:
+            frame = encode_frame(json.dumps({"action":"poem", "results":""}))
+        self.queue_frame(from_sock, frame)
+
+    def do_time(self, from_sock, msg):
+        # Sends the current server time.
+        ctime = time.strftime("%I:%M%p", time.localtime())
+        self.send_to(from_sock, json.dumps({"action":"time", "results":ctime}))
+
+    def do_private_message(self, from_sock, msg):
+        # Sends a message to a specific user.
+        target_username = msg.get("to")
+        message_text = msg.get("message")
+        if not target_username or not message_text: # Validate request.
+            status_payload = {"action": "private_message_status", "to": target_username or "N/A", "status": "error_bad_request", "detail": "Missing 'to' or 'message' field."}
+            self.send_to(from_sock, json.dumps(status_payload))
+        else:
+            sender_username = self.logged_sock2name[from_sock]
+            if target_username == sender_username: # User trying to PM themselves.
+                status_payload = {"action": "private_message_status", "to": target_username, "status": "error_self_message", "detail": "Cannot send private message to yourself."}
+                self.send_to(from_sock, json.dumps(status_payload))
+            elif target_username in self.logged_name2sock: # Target user is online.
+                target_sock = self.logged_name2sock[target_username]
+                payload_for_recipient = {"action": "incoming_private_message", "from": f"[PM from {sender_username}]", "message": message_text}
+                self.send_to(target_sock, json.dumps(payload_for_recipient))
+                # Both sides keep the PM in their searchable history.
+                self.deliver_chat([sender_username, target_username], text_proc(message_text, f"{sender_username} to {target_username}"), None)
+                # Confirm PM sent to the sender.
+                status_payload_to_sender = {"action": "private_message_status", "to": target_username, "status": "sent", "detail": f"PM sent to {target_username}."}
+                self.send_to(from_sock, json.dumps(status_payload_to_sender))
+            else: # Target user is offline.
+                status_payload = {"action": "private_message_status", "to": target_username, "status": "error_user_offline", "detail": f"User {target_username} is not online."}
+                self.send_to(from_sock, json.dumps(status_payload))
+
+    @staticmethod
+    def search_page(msg):
+        # (limit, offset) a search request asks for, within bounds.
+        try:
+            return min(max(int(msg.get("limit", SEARCH_LIMIT)), 0), SEARCH_MAX_LIMIT), max(int(msg.get("offset", 0)), 0)
+        except (TypeError, ValueError):
+            return SEARCH_LIMIT, 0
+
+    @staticmethod
+    def fit_frame(reply):
+        # Frames reply, keeping only as many of its "results" (a list, or
+        # lines joined by '\n') as fit in one frame; a reply cut short says
+        # so with "truncated": true. One that does not fit even without
+        # results becomes an "error" reply.
+        data = json.dumps(reply)
+        if len(data.encode()) <= MAX_FRAME:
+            return encode_frame(data)
+        results = reply["results"]
+        items = results.split('\n') if isinstance(results, str) else results
+        def cut(n):
+            kept = '\n'.join(items[:n]) if isinstance(results, str) else items[:n]
+            return json.dumps(dict(reply, results=kept, truncated=True))
+        lo, hi = 0, len(items) - 1 # The most results that fit, by bisection.
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if len(cut(mid).encode()) <= MAX_FRAME:
+                lo = mid
+            else:
+                hi = mid - 1
+        data = cut(lo)
+        if len(data.encode()) > MAX_FRAME:
+            data = json.dumps({"action":reply.get("action"), "results":"" if isinstance(results, str) else [], "error":"reply too large"})
+        return encode_frame(data)
+
+    def do_search(self, from_sock, msg):
+        # Searches user's chat history, best matches first. Optional "limit"
+        # and "offset" page through the ranking; "total" tells how many
+        # lines match in all. When nothing matches, misspelled words get
+        # "corrections" and the corrected query comes as "did_you_mean".
+        term = str(msg.get("target", ""))
+        from_name = self.logged_sock2name[from_sock]
+        limit, offset = self.search_page(msg)
+        print(f'Search request from {from_name} for "{term}" (limit {limit}, offset {offset})')
+        if from_name in self.indices: # Check if user has a chat history index.
+            index = self.indices[from_name]
+            try:
+                found, total = index.search_topk(term, limit, offset)
+            except ValueError as e: # Query too long or nested too deeply to parse.
+                self.send_to(from_sock, json.dumps({"action":"search", "results":"", "total":0, "offset":offset, "error":str(e)}))
+                return
+            search_rslt = '\n'.join(text for line, text, score in found)
+            print(f'Server side search result: {len(found)} of {total} lines')
+            reply = {"action":"search", "results":search_rslt, "total":total, "offset":offset}
+            if total == 0:
+                # The sonnets' speller only once the background build is done; never built here.
+                did_you_mean, corrections = index.suggest(term, self.corpus.index.speller(build=False))
+                if did_you_mean is not None:
+                    reply["did_you_mean"] = did_you_mean
+                    reply["corrections"] = corrections
+            self.queue_frame(from_sock, self.fit_frame(reply))
+        else: # User has no chat history index.
+            print(f"[Server Warning] No index found for {from_name} during search.")
+            self.send_to(from_sock, json.dumps({"action":"search", "results":"Search index not available."}))
+
+    def queue_sonnet_reply(self, sock, key, build):
+        # Sends the reply build(sonnets) makes for key, a tuple naming the
+        # action and its arguments. Replies about the sonnets stay valid
+        # until a reload, so the most recent ones are kept, framed, with
+        # the corpus they came from.
+        corpus = self.corpus
+        frame = corpus.reply_frames.get(key)
+        if frame is None:
+            frame = corpus.reply_frames[key] = self.fit_frame(build(corpus.index))
+            if len(corpus.reply_frames) > SONNET_REPLY_CACHE:
+                corpus.reply_frames.popitem(last=False)
+        else:
+            corpus.reply_frames.move_to_end(key)
+        self.queue_frame(sock, frame)
+
+    def do_sonnet_search(self, from_sock, msg):
+        # Searches the sonnets, best matching lines first, each with its
+        # sonnet number and line number in it. "limit" and "offset" page
+        # through the ranking as for search.
+        query = str(msg.get("target", ""))
+        limit, offset = self.search_page(msg)
+        def build(sonnets):
+            try:
+                found, total = sonnets.search_sonnets(query, limit, offset)
+            except ValueError as e: # Query too long or nested too deeply to parse.
+                return {"action":"sonnet_search", "target":query[:ECHO_LIMIT], "results":[], "total":0, "offset":offset, "error":str(e)}
+            results = [{"sonnet":p, "line":n, "text":text.strip(), "score":round(score, 3)} for p, n, text, score in found]
+            return {"action":"sonnet_search", "target":query[:ECHO_LIMIT], "results":results, "total":total, "offset":offset}
+        self.queue_sonnet_reply(from_sock, ("sonnet_search", query, limit, offset), build)
+
+    def do_concordance(self, from_sock, msg):
+        # Every occurrence of a word in the sonnets, in order, with "width"
+        # words of context on either side. Paged like search.
+        word = str(msg.get("target", ""))
+        limit, offset = self.search_page(msg)
+        try:
+            width = min(max(int(msg.get("width", CONCORDANCE_WIDTH)), 0), CONCORDANCE_MAX_WIDTH)
+        except (TypeError, ValueError):
+            width = CONCORDANCE_WIDTH
+        def build(sonnets):
+            found, total = sonnets.concordance(word, width, limit, offset)
+            results = [{"sonnet":p, "line":n, "left":left, "word":wd, "right":right} for p, n, left, wd, right in found]
+            return {"action":"concordance", "target":word[:ECHO_LIMIT], "width":width, "results":results, "total":total, "offset":offset}
+        self.queue_sonnet_reply(from_sock, ("concordance", word, width, limit, offset), build)
+
+    def do_rhyme(self, from_sock, msg):
+        # Sonnet lines whose last word rhymes with a word, closest first.
+        # Paged like search.
+        word = str(msg.get("target", ""))
+        limit, offset = self.search_page(msg)
+        def build(sonnets):
+            found, total = sonnets.rhymes(word, limit, offset)
+            results = [{"sonnet":p, "line":n, "text":text, "word":last} for p, n, text, last in found]
+            return {"action":"rhyme", "target":word[:ECHO_LIMIT], "results":results, "total":total, "offset":offset}
+        self.queue_sonnet_reply(from_sock, ("rhyme", word, limit, offset), build)
+
+    def do_complete(self, from_sock, msg):
+        # Suggests the words of the user's history that start with "prefix",
+        # most frequent first, e.g. for a search box.
+        prefix = str(msg.get("prefix", ""))
+        from_name = self.logged_sock2name[from_sock]
+        try:
+            limit = min(max(int(msg.get("limit", COMPLETE_LIMIT)), 0), COMPLETE_MAX_LIMIT)
+        except (TypeError, ValueError):
+            limit = COMPLETE_LIMIT
+        results = self.indices[from_name].complete(prefix, limit) if prefix and from_name in self.indices else []
+        self.send_to(from_sock, json.dumps({"action":"complete", "prefix":prefix[:ECHO_LIMIT], "results":results}))
+
+    def do_set_profile_pic(self, from_sock, msg):
+        # Updates user's profile picture URL.
+        from_name = self.logged_sock2name[from_sock]
+        pfp_url = msg.get("url")
+        if pfp_url is not None: # Validate URL presence.
+            if from_name in self.user_profile_info:
+                self.user_profile_info[from_name]["pfp_url"] = pfp_url
+                status_payload = {"action": "set_profile_pic_status", "status": "ok", "detail": "Profile picture updated."}
+            else: # Should not happen if user is logged in, but handle defensively.
+                self.user_profile_info[from_name] = {"pfp_url": pfp_url}
+                status_payload = {"action": "set_profile_pic_status", "status": "ok", "detail": "Profile picture set."}
+            print(f"User {from_name} set PFP URL to: {pfp_url}")
+        else: # URL missing in request.
+            status_payload = {"action": "set_profile_pic_status", "status": "error_bad_request", "detail": "Missing 'url' field."}
+        self.send_to(from_sock, json.dumps(status_payload))
+
+    def do_start_ttt(self, from_sock, msg):
+        # Initiates a Tic-Tac-Toe game.
+        self.board = [[0, 0, 0], [0, 0, 0], [0, 0, 0]] # Reset/Initialize board.
+        from_name = self.logged_sock2name[from_sock]
+        to_name = msg["target"]
+        if to_name == from_name: # User trying to play against themselves.
+            self.send_to(from_sock, json.dumps({"action":"open_ttt", "status":"self"}))
+        elif to_name not in self.logged_name2sock: # Opponent is not online (or just logged out).
+            self.send_to(from_sock, json.dumps({"action":"open_ttt", "status":"no-user", "reason":f"{to_name} is not online."}))
+        else: # Valid opponent.
+            print("Currently logged in:", list(self.logged_name2sock.keys()))
+            print("Looking for:", to_name)
+            if not hasattr(self, 'ttt_pairs'): # Initialize ttt_pairs if it doesn't exist.
+                self.ttt_pairs = {}
+            self.ttt_pairs[from_name] = to_name # Store player pair.
+            self.ttt_pairs[to_name] = from_name
+            to_sock = self.logged_name2sock[to_name]
+            # Notify both players to open the TTT game window, assigning symbols.
+            self.send_to(from_sock, json.dumps({"action":"open_ttt", "status":"ok", "from":from_name, "symbol":"X"}))
+            self.send_to(to_sock, json.dumps({"action":"open_ttt", "status":"ok", "from":from_name, "symbol":"O"}))
+
+    def do_move(self, from_sock, msg):
+        # Processes a Tic-Tac-Toe game move.
+        from_name = self.logged_sock2name[from_sock]
+        to_name = getattr(self, 'ttt_pairs', {}).get(from_name)
+        if to_name not in self.logged_name2sock: # No game, or the opponent has left.
+            print(f"[Server Warning] Move from {from_name} without an online opponent, ignoring.")
+            return
+        to_sock = self.logged_name2sock[to_name]
+        try:
+            row=int(msg["row"])
+            column=int(msg["column"])
+        except (KeyError, TypeError, ValueError):
+            row = column = None
+        # print(f"Server received move: {row},{column} from {from_name}") # Optional: less verbose log
+        if row not in range(3) or column not in range(3): # Validate move coordinates.
+            print("Invalid move received: row/column out of range")
             return
+        
+        symbol_from_client = msg.get("from") # Symbol ('X' or 'O') sent by the client.
+        # print(f"Symbol in msg['from']: {symbol_from_client}") # Optional: less verbose log
+
+        self.board[row][column]=symbol_from_client # Update board state.
+        result=self.check_winners() # Check for win/tie/continue.
+        # print(f"check_winners result: {result}") # Optional: less verbose log
+        
+        if result[0] == "win": # Game won.
+            winner_symbol = result[1]
+            # Determine winner's name based on the winning symbol.
+            actual_winner_name = from_name if symbol_from_client == winner_symbol else to_name
+            # print(f"Game won by {actual_winner_name} with symbol {winner_symbol}") # Optional: less verbose log
+            end_payload = {
+                "action": "end", "status": "win",
+                "winner": actual_winner_name, "winning_symbol": winner_symbol,
+                "board": self.board
+            }
+            self.send_to(to_sock, json.dumps(end_payload))
+            self.send_to(from_sock, json.dumps(end_payload))
+            self._record_game_result(actual_winner_name,
+                                     to_name if actual_winner_name == from_name else from_name,
+                                     is_tie=False)
+        elif result[0] == "tie": # Game is a tie.
+            # print(f"Game is a tie. Board: {self.board}") # Optional: less verbose log
+            end_payload = {
+                "action": "end", "status": "tie",
+                "winner": None, "board": self.board
+            }
+            self.send_to(to_sock, json.dumps(end_payload))
+            self.send_to(from_sock, json.dumps(end_payload))
+            self._record_game_result(from_name, to_name, is_tie=True)
+        else: # Game continues.
+            self.send_to(to_sock, json.dumps({"action":"update", "status":"your turn", "from":from_name, "turn": to_name, "row":msg["row"], "column":msg["column"]}))
+            self.send_to(from_sock, json.dumps({"action":"update", "status":"opponent turn", "from":from_name, "turn": to_name, "row":msg["row"], "column":msg["column"]}))
+
+    def do_server_stats(self, from_sock, msg):
+        # Per-action call counts and latency histograms, for operators.
+        self.send_to(from_sock, json.dumps({"action":"server_stats", "results": self.action_stats_snapshot(), "index_cache": self.indices.stats()}))
+
+    def do_disconnect(self, from_sock, msg):
+        # Disconnects a user from their current chat group.
+        from_name = self.logged_sock2name[from_sock]
+        the_guys = self.group.list_me(from_name)
+        self.group.disconnect(from_name) # Update group state.
+        the_guys.remove(from_name)
+        if len(the_guys) == 1: # If one person remains in the group, notify them.
+            g = the_guys.pop()
+            to_sock = self.logged_name2sock[g]
+            self.send_to(to_sock, json.dumps({"action":"disconnect"}))
 
 #==============================================================================
 # Main server loop.
 #==============================================================================
+    def accept(self):
+        # Accepts every pending connection on the (non-blocking) listening socket.
+        while True:
+            try:
+                sock, address = self.server.accept()
+            except BlockingIOError: # Backlog drained.
+                return
+            except Exception as e:
+                print(f'[Server Log] ERROR accepting connection: {e}')
+                return
+            print(f'[Server Log] Accepted connection from {address}')
+            self.new_client(sock, address) # Register the new client.
+
+    def read_client(self, conn):
+        # Pulls whatever bytes are ready off a client socket and hands each
+        # complete frame to the connection's handler. Partial frames stay
+        # buffered in the decoder until the rest arrives.
+        sock = conn.sock
+        try:
+            received = conn.decoder.recv_from(sock)
+        except BlockingIOError: # Spurious wakeup, nothing to read yet.
+            return
+        except OSError as e: # Includes ConnectionResetError.
+            print(f"[Server Log] Socket error for client {self.logged_sock2name.get(sock, conn.address)}: {e}. Logging out.")
+            self.close_client(sock)
+            return
+        if not received: # Client disconnected gracefully.
+            print(f"[Server Log] Client {self.logged_sock2name.get(sock, conn.address)} disconnected gracefully. Logging out.")
+            self.close_client(sock)
+            return
+        while not conn.closed:
+            try:
+                frame = conn.decoder.next_frame()
+            except ValueError: # Corrupt size prefix or invalid UTF-8, the stream can't be resynchronised.
+                print(f"[Server Log] Malformed frame from {self.logged_sock2name.get(sock, conn.address)}. Closing connection.")
+                self.close_client(sock)
+                return
+            if frame is None:
+                return
+            conn.on_frame(sock, frame)
+
     def run(self):
         print ('[Server Log] Starting server...')
-        loop_count = 0
-        while(1): # Loop indefinitely to handle client connections and messages.
-           loop_count += 1
-           print(f'[Server Log] ----- Loop {loop_count} Start -----')
-           print(f'[Server Log] Sockets to check: {len(self.all_sockets)}')
-           # Use select to monitor sockets for readability with a timeout.
-           read,write,error=select.select(self.all_sockets,[],[], 1.0)
-           print(f'[Server Log] select() returned {len(read)} readable sockets.')
-
-           # Process messages from already logged-in clients.
-           print('[Server Log] Checking logged clients..')
-           logged_clients_to_process = [logc for logc in list(self.logged_name2sock.values()) if logc in read]
-           print(f'[Server Log] Found {len(logged_clients_to_process)} logged clients with data.')
-           for logc in logged_clients_to_process:
-               print(f'[Server Log] Handling message from logged client: {self.logged_sock2name.get(logc, "Unknown")}')
-               self.handle_msg(logc)
-
-           # Process login attempts from new clients.
-           print('[Server Log] Checking new clients..')
-           new_clients_to_process = [newc for newc in self.new_clients[:] if newc in read] # Iterate over a copy for safe removal.
-           print(f'[Server Log] Found {len(new_clients_to_process)} new clients with data.')
-           for newc in new_clients_to_process:
-               print(f'[Server Log] Attempting login for new client: {newc.getpeername() if newc.fileno() != -1 else "Closed Socket"}')
-               self.login(newc)
-
-           # Accept new client connections.
-           print('[Server Log] Checking for new connections..')
-           if self.server in read :
-               print('[Server Log] Server socket is readable - accepting new connection...')
-               try:
-                   sock, address = self.server.accept()
-                   print(f'[Server Log] Accepted connection from {address}')
-                   self.new_client(sock) # Register the new client.
-               except Exception as e:
-                   print(f'[Server Log] ERROR accepting connection: {e}')
-           print(f'[Server Log] ----- Loop {loop_count} End -----')
+        try:
+            while(1): # Loop indefinitely to handle client connections and messages.
+               # Only sockets with pending data come back, so one iteration costs O(ready sockets).
+               events = self.selector.select(timeout=1.0)
+               for key, mask in events:
+                   conn = key.data
+                   if conn is None: # The listening socket.
+                       self.accept()
+                       continue
+                   if mask & selectors.EVENT_WRITE and not conn.closed:
+                       self.flush_client(conn)
+                   if mask & selectors.EVENT_READ and not (conn.closed or conn.evicted): # Skip sockets closed earlier in this batch.
+                       self.read_client(conn)
+               self.flush_pending()
+               self.close_evicted()
+               self.housekeeping()
+        finally:
+            self.journal.close() # Commits what is still buffered.
+            self.index_saver.shutdown(wait=True) # Let evicted histories finish writing.
 
 def main():
     server=Server()
     server.run()
 
-main()
+if __name__ == "__main__":
+    main()
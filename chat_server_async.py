@@ -0,0 +1,188 @@
+
+#==============================================================================
+# Asyncio server mode.
+#
+# Same wire protocol (5-digit size prefix + JSON) and the same handle_msg
+# action semantics as chat_server.Server, but every connection is served by
+# its own coroutine on an asyncio event loop (uvloop when installed) instead
+# of the hand-rolled selectors loop. Slow disk work (history appends, game
+# stats) runs in a thread pool so it never stalls the loop.
+#
+# Usage: python chat_server_async.py [--uvloop] [--idle-timeout SECONDS]
+#==============================================================================
+
+import asyncio
+import concurrent.futures
+import json
+import chat_server
+import indexer
+from chat_utils import *
+try:
+    import uvloop
+    UVLOOP_AVAILABLE = True
+except ImportError:
+    UVLOOP_AVAILABLE = False
+
+READ_SIZE = 65536 # Bytes requested per StreamReader.read().
+
+class AsyncConnection(chat_server.Connection):
+    # Connection state for a stream. Outgoing data goes straight to the
+    # transport, which does its own buffering, so the outbound deque of the
+    # base class stays unused.
+    def __init__(self, sock, address, on_frame, writer):
+        super().__init__(sock, address, on_frame)
+        self.writer = writer
+
+class AsyncServer(chat_server.Server):
+    def __init__(self, idle_timeout=None):
+        self.idle_timeout = idle_timeout # Seconds without any frame before a client is dropped; None disables.
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="chat-disk")
+        self.loop = None
+        self.pending_index_saves = {} # name -> SegmentedHistory whose new lines are still being written
+        super().__init__()
+
+    def listen(self):
+        # asyncio.start_server binds the listening socket in run().
+        pass
+
+    #==========================================================================
+    # Transport-backed replacements for the selector plumbing.
+    #==========================================================================
+    def queue_frame(self, sock, data):
+        conn = self.conns.get(sock)
+        if conn is None or conn.closed or conn.evicted:
+            return
+        backlog = conn.writer.transport.get_write_buffer_size()
+        if backlog and backlog + len(data) > self.out_high_water:
+            if self.out_overflow == 'drop':
+                print(f"[Server Log] Outbound buffer full for {self.logged_sock2name.get(sock, conn.address)}, dropping frame.")
+                return
+            print(f"[Server Log] {self.logged_sock2name.get(sock, conn.address)} is not reading ({backlog} bytes queued), disconnecting.")
+            self.evict(conn)
+            return
+        conn.writer.write(data)
+
+    def flush_pending(self):
+        # The transports write (and batch) on their own.
+        pass
+
+    def drop_client(self, sock):
+        conn = self.conns.pop(sock, None)
+        if conn is not None and not conn.closed:
+            conn.closed = True
+            conn.writer.close()
+
+    #==========================================================================
+    # Disk work moved off the loop.
+    #==========================================================================
+    def save_index(self, name, index):
+        # The session's lines are handed to the history here; only the file
+        # append runs in the executor.
+        index.checkpoint()
+        history = index.past
+        self.pending_index_saves[name] = history
+        future = self.loop.run_in_executor(self.executor, history.flush)
+        future.add_done_callback(lambda f: self._index_saved(name, history, f))
+
+    def evict_index(self, name, index):
+        # save_index already writes in the executor.
+        self.save_index(name, index)
+
+    def _index_saved(self, name, history, future):
+        if self.pending_index_saves.get(name) is history: # A newer save may have replaced it.
+            del self.pending_index_saves[name]
+        if future.exception() is not None:
+            print(f"[Server Log] Error saving index for {name}: {future.exception()}")
+
+    def load_index(self, name):
+        if name in self.pending_index_saves: # Logged out moments ago and the write is still in flight.
+            return indexer.Index(name, past=self.pending_index_saves[name])
+        return super().load_index(name)
+
+    def finish_journal_rotation(self, histories, retired):
+        # Sessions saved at logout whose write is still queued must be on
+        # disk before the old journal goes too.
+        histories = histories + list(self.pending_index_saves.values())
+        future = self.loop.run_in_executor(self.executor, super().finish_journal_rotation, histories, retired)
+        future.add_done_callback(lambda f: f.exception() and print(f"[Server Log] Journal rotation failed: {f.exception()}"))
+
+    def _save_game_stats(self):
+        stats_json = json.dumps(self.game_stats, indent=4) # Snapshot on the loop thread.
+        self.loop.run_in_executor(self.executor, self._write_game_stats, stats_json)
+
+    #==========================================================================
+    # One coroutine per connection.
+    #==========================================================================
+    async def handle_client(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        address = writer.get_extra_info('peername')
+        print(f'[Server Log] Accepted connection from {address}')
+        conn = AsyncConnection(sock, address, self.login, writer)
+        self.conns[sock] = conn
+        try:
+            while not conn.closed:
+                try:
+                    data = await asyncio.wait_for(reader.read(READ_SIZE), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    print(f"[Server Log] {self.logged_sock2name.get(sock, address)} idle for {self.idle_timeout}s, disconnecting.")
+                    break
+                except OSError as e: # Includes ConnectionResetError.
+                    print(f"[Server Log] Socket error for client {self.logged_sock2name.get(sock, address)}: {e}. Logging out.")
+                    break
+                if conn.closed: # Closed by another coroutine (e.g. evicted) while waiting.
+                    break
+                if not data:
+                    print(f"[Server Log] Client {self.logged_sock2name.get(sock, address)} disconnected gracefully. Logging out.")
+                    break
+                conn.decoder.feed(data)
+                while not conn.closed:
+                    try:
+                        frame = conn.decoder.next_frame()
+                    except ValueError:
+                        print(f"[Server Log] Malformed frame from {self.logged_sock2name.get(sock, address)}. Closing connection.")
+                        self.close_client(sock)
+                        break
+                    if frame is None:
+                        break
+                    conn.on_frame(sock, frame)
+                self.close_evicted()
+                self.housekeeping()
+                if not conn.closed:
+                    await writer.drain() # A client that floods requests waits for its own replies to go out.
+        except asyncio.CancelledError:
+            raise
+        except OSError: # drain() on a connection that went away.
+            pass
+        finally:
+            if not conn.closed and sock in self.conns:
+                self.close_client(sock)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle_client, *SERVER, backlog=socket.SOMAXCONN)
+        print(f'[Server Log] Starting asyncio server on {SERVER} ({type(self.loop).__module__})...')
+        async with server:
+            await server.serve_forever()
+
+    def run(self, use_uvloop=False):
+        if use_uvloop:
+            uvloop.install()
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.executor.shutdown(wait=True) # Let pending index/stats writes finish.
+            self.journal.close()
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='asyncio chat server')
+    parser.add_argument('--uvloop', action='store_true', help='use uvloop as the event loop (if installed)')
+    parser.add_argument('--idle-timeout', type=float, default=None, help='drop clients silent for this many seconds')
+    args = parser.parse_args()
+    if args.uvloop and not UVLOOP_AVAILABLE:
+        print("uvloop not found, falling back to the default asyncio loop.")
+    server = AsyncServer(idle_timeout=args.idle_timeout)
+    server.run(use_uvloop=args.uvloop and UVLOOP_AVAILABLE)
+
+if __name__ == "__main__":
+    main()
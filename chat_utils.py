@@ -17,9 +17,51 @@ S_LOGGEDIN  = 2
 S_CHATTING  = 3
 
 SIZE_SPEC = 5
+MAX_FRAME = 10 ** SIZE_SPEC - 1 # Largest payload, in bytes, the size prefix can announce.
 
 CHAT_WAIT = 0.2
 
+# Server-side outbound buffering. A client whose unsent backlog grows past
+# OUT_HIGH_WATER bytes is a slow consumer: 'disconnect' evicts it, 'drop'
+# discards further frames for it until the backlog drains.
+OUT_HIGH_WATER = 1024 * 1024
+OUT_OVERFLOW = 'disconnect'
+
+# Write-ahead journal of chat history (see chat_journal.py). Records are
+# fsynced in groups: at most every JOURNAL_COMMIT_INTERVAL seconds, sooner
+# once JOURNAL_COMMIT_BYTES are waiting. Past JOURNAL_ROTATE_BYTES the
+# online users' lines are saved to their histories and the journal restarts.
+JOURNAL_FILE = 'chat.journal'
+JOURNAL_COMMIT_INTERVAL = 0.05
+JOURNAL_COMMIT_BYTES = 256 * 1024
+JOURNAL_ROTATE_BYTES = 64 * 1024 * 1024
+
+# Memory the server lets logged-in users' chat histories use. Past it the
+# least recently used ones are saved and dropped until they are needed again.
+INDEX_CACHE_BYTES = 128 * 1024 * 1024
+
+# Search results are ranked; one reply carries at most SEARCH_LIMIT lines
+# unless the request asks for another "limit" (capped at SEARCH_MAX_LIMIT),
+# and never more than fit in one frame (the reply then says "truncated").
+SEARCH_LIMIT = 50
+SEARCH_MAX_LIMIT = 1000
+# Characters of the request's query a reply echoes back as "target" (or "prefix").
+ECHO_LIMIT = 200
+# Suggestions a "complete" reply carries by default (at most COMPLETE_MAX_LIMIT).
+COMPLETE_LIMIT = 10
+COMPLETE_MAX_LIMIT = 100
+# The poem corpus. The server reloads it in the background on SIGHUP, or
+# when it or roman.txt.pk changes (checked every POEM_WATCH_INTERVAL
+# seconds; 0 turns the check off).
+POEM_FILE = "AllSonnets.txt"
+POEM_WATCH_INTERVAL = 2.0
+# The sonnets only change on a reload, so the last SONNET_REPLY_CACHE
+# distinct "sonnet_search", "concordance" and "rhyme" replies are kept framed.
+SONNET_REPLY_CACHE = 512
+# Words of context on either side in a "concordance" reply, by default and at most.
+CONCORDANCE_WIDTH = 5
+CONCORDANCE_MAX_WIDTH = 20
+
 def print_state(state):
     print('**** State *****::::: ')
     if state == S_OFFLINE:
@@ -33,10 +75,15 @@ def print_state(state):
     else:
         print('Error: wrong state')
 
+def encode_frame(msg):
+    # Prepend the UTF-8 encoded message with its size in bytes, formatted to SIZE_SPEC digits.
+    data = str(msg).encode()
+    if len(data) > MAX_FRAME: # The prefix would be cut and the stream lose sync.
+        raise ValueError(f"message of {len(data)} bytes does not fit in a frame (at most {MAX_FRAME})")
+    return (('0' * SIZE_SPEC + str(len(data)))[-SIZE_SPEC:]).encode() + data
+
 def mysend(s, msg):
-    # Prepend message with its size, formatted to SIZE_SPEC digits.
-    msg = ('0' * SIZE_SPEC + str(len(msg)))[-SIZE_SPEC:] + str(msg)
-    msg = msg.encode()
+    msg = encode_frame(msg)
     total_sent = 0
     while total_sent < len(msg) :
         sent = s.send(msg[total_sent:])
@@ -46,24 +93,125 @@ def mysend(s, msg):
         total_sent += sent
 
 def myrecv(s):
-    # First, receive the size of the incoming message.
-    size = ''
+    # Blocking read of exactly one frame. Sizes are counted in bytes and the
+    # payload is only decoded once it is complete, so multi-byte characters
+    # split across reads survive.
+    size = b''
     while len(size) < SIZE_SPEC:
-        text = s.recv(SIZE_SPEC - len(size)).decode()
+        text = s.recv(SIZE_SPEC - len(size))
         if not text:
             print('disconnected')
             return('')
         size += text
     size = int(size)
-    # Then, receive the actual message content based on the determined size.
-    msg = ''
+    msg = b''
     while len(msg) < size:
-        text = s.recv(size-len(msg)).decode()
-        if text == b'': # Check for empty byte string indicating disconnection.
+        text = s.recv(size-len(msg))
+        if not text: # Empty byte string indicates disconnection.
             print('disconnected')
             break
         msg += text
-    return (msg)
+    return (msg.decode(errors='replace'))
+
+class FrameDecoder:
+    """
+    Incremental decoder for the size-prefixed frames written by mysend.
+
+    Bytes are read with recv_into into one reusable buffer and a frame is
+    only decoded once all of its bytes have arrived, so a half-sent message
+    never blocks a non-blocking caller. The same decoder must be used for
+    every read on a socket, since one recv may return several frames.
+    """
+    def __init__(self, bufsize=4096):
+        self.bufsize = bufsize
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.start = 0 # first byte not yet returned as part of a frame
+        self.end = 0   # one past the last byte received
+
+    def _make_room(self):
+        # Reuses the buffer in place: compacts unread bytes to the front and
+        # only grows when a single frame is larger than the buffer.
+        pending = self.end - self.start
+        if pending == 0:
+            self.start = self.end = 0
+            if len(self.buf) > self.bufsize: # Give back the space of an unusually large frame.
+                self.view.release()
+                self.buf = bytearray(self.bufsize)
+                self.view = memoryview(self.buf)
+            return
+        if self.end < len(self.buf):
+            return
+        if self.start > 0:
+            self.buf[:pending] = self.buf[self.start:self.end]
+            self.start, self.end = 0, pending
+        else:
+            self.view.release()
+            self.buf.extend(bytes(len(self.buf)))
+            self.view = memoryview(self.buf)
+
+    def recv_from(self, s):
+        # Reads whatever is available on s. Returns the number of bytes
+        # received, 0 if the peer closed the connection. A non-blocking socket
+        # with nothing ready raises BlockingIOError as usual.
+        self._make_room()
+        received = s.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def feed(self, data):
+        # Appends bytes obtained elsewhere (e.g. from an asyncio stream).
+        data = memoryview(data)
+        while len(data):
+            self._make_room()
+            n = min(len(data), len(self.buf) - self.end)
+            self.view[self.end:self.end + n] = data[:n]
+            self.end += n
+            data = data[n:]
+
+    def _frame_size(self):
+        # The size prefix at self.start. Only SIZE_SPEC ASCII digits are one:
+        # int() would also take "-0005" or " +03", and a negative size never
+        # moves self.start, so the same empty frame would come back forever.
+        prefix = bytes(self.view[self.start:self.start + SIZE_SPEC])
+        if not (prefix.isascii() and prefix.isdigit()):
+            raise ValueError(f"corrupt frame size prefix {prefix!r}")
+        return int(prefix)
+
+    def next_frame(self):
+        # Returns the next complete frame as a str, or None if it has not fully
+        # arrived yet. Raises ValueError on a corrupt size prefix.
+        if self.end - self.start < SIZE_SPEC:
+            return None
+        size = self._frame_size()
+        begin = self.start + SIZE_SPEC
+        if self.end - begin < size:
+            return None
+        self.start = begin + size
+        return str(self.view[begin:self.start], 'utf-8')
+
+    def frames(self):
+        # Yields every frame that is already complete.
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+    def has_frame(self):
+        if self.end - self.start < SIZE_SPEC:
+            return False
+        return self.end - self.start - SIZE_SPEC >= self._frame_size()
+
+    def recv_frame(self, s):
+        # Blocking counterpart of myrecv for clients: returns the next frame,
+        # or '' if the server disconnected.
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            if not self.recv_from(s):
+                print('disconnected')
+                return ''
 
 def text_proc(text, user):
     # Formats a chat message with a timestamp and username.
@@ -8,10 +8,15 @@ class ClientSM:
         self.me = ''
         self.out_msg = ''
         self.s = s
+        self.decoder = FrameDecoder() # Every read on self.s goes through this, frames can arrive back to back.
 
     def set_state(self, state):
         self.state = state
 
+    def recv(self):
+        # Blocks until the next complete frame arrives from the server.
+        return self.decoder.recv_frame(self.s)
+
     def get_state(self):
         return self.state
 
@@ -24,7 +29,7 @@ class ClientSM:
     def connect_to(self, peer):
         msg = json.dumps({"action":"connect", "target":peer})
         mysend(self.s, msg)
-        response = json.loads(myrecv(self.s))
+        response = json.loads(self.recv())
         if response["status"] == "success":
             self.peer = peer
             self.out_msg += 'You are connected with '+ self.peer + '\n'
@@ -86,7 +91,7 @@ class ClientSM:
                     
                     # Server expects the player's symbol in the "from" field for a "move" action.
                     mysend(self.s, json.dumps({"action": "move", "row": row, "column": column, "from": actual_symbol}))
-                    response = json.loads(myrecv(self.s)) # Expect a response from the server after the move.
+                    response = json.loads(self.recv()) # Expect a response from the server after the move.
                     if response["status"] == "opponent turn":
                         self.out_msg += "\n oppo nent turn "+ response.get("turn")
                     elif response["status"] == "your turn": # This case might occur if server logic changes.
@@ -109,12 +114,12 @@ class ClientSM:
                     processed_my_msg_as_command = True
                 elif my_msg == 'time': # Time command.
                     mysend(self.s, json.dumps({"action":"time"}))
-                    time_in = json.loads(myrecv(self.s))["results"]
+                    time_in = json.loads(self.recv())["results"]
                     self.out_msg += f"Current Time: {time_in}\n"
                     processed_my_msg_as_command = True
                 elif my_msg == 'who': # Who command (list online users).
                     mysend(self.s, json.dumps({"action":"list"}))
-                    response_json_str = myrecv(self.s)
+                    response_json_str = self.recv()
                     if response_json_str:
                         try:
                             response_data = json.loads(response_json_str)
@@ -132,7 +137,7 @@ class ClientSM:
                     target_player = my_msg[3:].strip()
                     if target_player:
                         mysend(self.s, json.dumps({"action": "start_ttt", "target": target_player}))
-                        response = json.loads(myrecv(self.s))
+                        response = json.loads(self.recv())
                         if response.get("status") == "ok":
                             self.out_msg += f"Tic Tac Toe request sent to {target_player}.\n"
                             if response["action"] == "open_ttt": # Server confirms game start.
@@ -154,7 +159,7 @@ class ClientSM:
                             pfp_url = parts[1].strip()
                             if pfp_url:
                                 mysend(self.s, json.dumps({"action": "set_profile_pic", "url": pfp_url}))
-                                response_json = myrecv(self.s)
+                                response_json = self.recv()
                                 if response_json:
                                     response = json.loads(response_json)
                                     if response.get("action") == "set_profile_pic_status":
@@ -171,14 +176,92 @@ class ClientSM:
                         self.out_msg += f"[PFP Error: {str(e)}]\n"
                     processed_my_msg_as_command = True
                     
+                elif my_msg.startswith("/all "): # Global channel, reaches every online user.
+                    text = my_msg[5:].strip()
+                    if text:
+                        mysend(self.s, json.dumps({"action":"broadcast", "from":"[" + self.me + "]", "message":text}))
+                        self.out_msg += f"[{self.me} to all] {text}\n" # Local echo
+                    else:
+                        self.out_msg += "Invalid broadcast format. Use: /all <message>\n"
+                    processed_my_msg_as_command = True
+
+                elif my_msg.startswith("/complete "): # Search suggestions, for the GUI's search box.
+                    mysend(self.s, json.dumps({"action":"complete", "prefix":my_msg[10:].strip()}))
+                    reply = json.loads(self.recv())
+                    # Prefix with "COMPLETIONS_STRUCT:" for the GUI to fill its suggestion list.
+                    self.out_msg = "COMPLETIONS_STRUCT:" + json.dumps({"prefix": reply.get("prefix", ""), "results": reply.get("results", [])})
+                    processed_my_msg_as_command = True
+
+                elif my_msg.startswith("/sonnets "): # Search the sonnets
+                    term = my_msg[9:].strip()
+                    mysend(self.s, json.dumps({"action":"sonnet_search", "target":term}))
+                    reply = json.loads(self.recv())
+                    results = reply.get("results", [])
+                    if reply.get("error"):
+                        self.out_msg += f"Search failed: {reply['error']}\n\n"
+                    elif results:
+                        for r in results:
+                            self.out_msg += f"Sonnet {r['sonnet']}, line {r['line']}: {r['text']}\n"
+                        if reply.get("total", len(results)) > len(results):
+                            self.out_msg += f"(best {len(results)} of {reply['total']} matches)\n"
+                        self.out_msg += '\n'
+                    else:
+                        self.out_msg += '\'' + term + '\'' + ' not found in the sonnets\n\n'
+                    processed_my_msg_as_command = True
+
+                elif my_msg.startswith("/concordance "): # Keyword in context over the sonnets
+                    parts = my_msg.split()
+                    if len(parts) in (2, 3) and (len(parts) == 2 or parts[2].isdigit()):
+                        request = {"action":"concordance", "target":parts[1]}
+                        if len(parts) == 3:
+                            request["width"] = int(parts[2])
+                        mysend(self.s, json.dumps(request))
+                        reply = json.loads(self.recv())
+                        results = reply.get("results", [])
+                        for r in results:
+                            gap = ' ' if r['right'][:1].isalnum() or r['right'][:1] == '/' else '' # No space before punctuation.
+                            self.out_msg += f"{r['sonnet']}.{r['line']}: {r['left']} [{r['word']}]{gap}{r['right']}\n"
+                        if reply.get("total", len(results)) > len(results):
+                            self.out_msg += f"(first {len(results)} of {reply['total']} occurrences)\n"
+                        if not results:
+                            self.out_msg += '\'' + parts[1] + '\'' + ' not found in the sonnets\n'
+                        self.out_msg += '\n'
+                    else:
+                        self.out_msg += "Invalid concordance command. Use: /concordance <word> [context words]\n"
+                    processed_my_msg_as_command = True
+
+                elif my_msg.startswith("/rhyme "): # Sonnet lines rhyming with a word
+                    word = my_msg[7:].strip()
+                    mysend(self.s, json.dumps({"action":"rhyme", "target":word}))
+                    reply = json.loads(self.recv())
+                    results = reply.get("results", [])
+                    for r in results:
+                        self.out_msg += f"Sonnet {r['sonnet']}, line {r['line']}: {r['text']}\n"
+                    if reply.get("total", len(results)) > len(results):
+                        self.out_msg += f"(first {len(results)} of {reply['total']} rhymes)\n"
+                    if not results:
+                        self.out_msg += 'No rhymes for \'' + word + '\' in the sonnets\n'
+                    self.out_msg += '\n'
+                    processed_my_msg_as_command = True
+
                 elif my_msg[0] == '?': # Search
                     term = my_msg[1:].strip()
                     mysend(self.s, json.dumps({"action":"search", "target":term}))
-                    search_rslt = json.loads(myrecv(self.s))["results"].strip()
-                    if (len(search_rslt)) > 0:
-                        self.out_msg += search_rslt + '\n\n'
+                    reply = json.loads(self.recv())
+                    search_rslt = reply["results"].strip()
+                    if reply.get("error"):
+                        self.out_msg += f"Search failed: {reply['error']}\n\n"
+                    elif (len(search_rslt)) > 0:
+                        self.out_msg += search_rslt + '\n'
+                        shown = search_rslt.count('\n') + 1
+                        if reply.get("total", shown) > shown: # Ranked; only the best matches are sent.
+                            self.out_msg += f"(best {shown} of {reply['total']} matches)\n"
+                        self.out_msg += '\n'
                     else:
-                        self.out_msg += '\'' + term + '\'' + ' not found\n\n'
+                        self.out_msg += '\'' + term + '\'' + ' not found\n'
+                        if reply.get("did_you_mean"):
+                            self.out_msg += f"Did you mean: {reply['did_you_mean']}?\n"
+                        self.out_msg += '\n'
                     processed_my_msg_as_command = True
                     
                 elif my_msg.startswith('p '): # Poem
@@ -187,7 +270,7 @@ class ClientSM:
                     if len(parts) == 2 and parts[0] == 'p' and parts[1].isdigit():
                         poem_idx_str = parts[1]
                         mysend(self.s, json.dumps({"action":"poem", "target":poem_idx_str}))
-                        poem = json.loads(myrecv(self.s))["results"]
+                        poem = json.loads(self.recv())["results"]
                         if (len(poem) > 0):
                             self.out_msg += f"Sonnet {poem_idx_str}:\n{poem}\n"
                         else:
@@ -240,7 +323,7 @@ class ClientSM:
                         if len(parts) == 2:
                             target_user, pm_text = parts[0], parts[1]
                             mysend(self.s, json.dumps({"action": "private_message", "to": target_user, "message": pm_text}))
-                            response_json = myrecv(self.s)
+                            response_json = self.recv()
                             if response_json:
                                 response = json.loads(response_json)
                                 if response.get("action") == "private_message_status":
@@ -1,15 +1,1342 @@
 # -*- coding: utf-8 -*-
 
+import os
+import re
+import sys
+import math
+import json
+import mmap
+import struct
 import pickle
+import threading
+import weakref
+import zlib
+import heapq
+from array import array
+from collections import OrderedDict, Counter
+from itertools import accumulate
+from bisect import bisect_left, bisect_right, insort
+try:
+    import fcntl
+except ImportError: # Not on Windows, where only one server process may use a history.
+    fcntl = None
+
+HIST_SUFFIX = '.hist' # A user's on-disk history is the directory name + HIST_SUFFIX.
+TAIL_MAX = 512 # Lines kept in a history's tail log before it is sealed into a segment.
+MERGE_FACTOR = 4 # This many segments of about the same size are merged into one.
+HIST_LOCK = 'lock' # File in a history directory whose lock says which processes have it open.
+STR_OVERHEAD = 49 # Bytes of a str object beyond its characters (ASCII), for memory estimates.
+BM25_K1 = 1.2 # How fast repeats of a term stop adding to a line's score.
+BM25_B = 0.75 # How much a line's length discounts its score (0: not at all, 1: fully).
+SPELL_DISTANCE = 2 # Spelling suggestions are at most this many edits away.
+SPELL_PREFIX = 7 # Characters of a term the spelling index files it under.
+
+STOPWORDS = frozenset("""a an and are as at be but by for from had has have he her his i if in into is it
+its me my no not of on or our she so that the their them then there they this to was we were what when
+which who will with you your""".split())
+
+def light_stem(word):
+    # A small English suffix stripper (plurals, -ed, -ing), in the spirit of
+    # the first step of Porter's algorithm: loves/loved/loving -> love,
+    # days -> day, flies -> fly, stopped -> stop.
+    if len(word) <= 3:
+        return word
+    if word.endswith('sses'):
+        word = word[:-2]
+    elif word.endswith('ies') and len(word) > 4:
+        word = word[:-3] + 'y'
+    elif word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        word = word[:-1]
+    for suffix in ('ing', 'ed'):
+        stem = word[:-len(suffix)]
+        if word.endswith(suffix) and len(stem) >= 3 and any(c in 'aeiouy' for c in stem):
+            if stem[-1] == stem[-2] and stem[-1] not in 'lsz':
+                stem = stem[:-1] # stopp -> stop
+            elif len(stem) <= 4 and stem[-1] not in 'aeiouwxy' and stem[-2] in 'aeiou' and stem[-3] not in 'aeiou':
+                stem += 'e' # lov -> love, hop -> hope
+            return stem
+    return word
+
+class Analyzer:
+    """
+    Turns a line into its index terms; the same Analyzer must be used to
+    index and to query. The pipeline:
+
+        chat prefix ("[09:24 PM] user1: ") removed, when strip_prefix
+        tokens: runs of letters/digits, apostrophes allowed inside a word
+        lowercase
+        possessive "'s" removed (summer's -> summer, love's -> love)
+        stopwords dropped (they still take up a position)
+        stemming, when stem is set (light_stem)
+
+    Everything depends on the whitespace-separated chunk alone, so results
+    are cached per distinct chunk; a line whose chunks are all cached costs
+    a str.split() and a map over the cache.
+    """
+    TOKEN = re.compile(r"\w+(?:['\u2019]\w+)*")
+
+    def __init__(self, lowercase=True, strip_prefix=True, stopwords=(), stem=False, cache_size=100000):
+        self.lowercase = lowercase
+        self.strip_prefix = strip_prefix
+        self.stopwords = frozenset(stopwords)
+        self.stem = stem
+        self.cache_size = cache_size
+        self.cache = {} # whitespace-separated chunk -> its single term
+        self.special = {} # chunk -> tuple of its terms (None where a token is dropped), when not exactly one
+        # Stored in segments so lines indexed with other settings are re-indexed
+        # on load. It must be the same in every process, hence crc32, not hash().
+        self.signature = (f"lower={int(lowercase)} prefix={int(strip_prefix)} stem={'light' if stem else 0} "
+                          f"stop={len(self.stopwords)}:{zlib.crc32(' '.join(sorted(self.stopwords)).encode('utf-8')):08x}")
+
+    def normalize(self, token):
+        if self.lowercase:
+            token = token.lower()
+        token = token.replace('\u2019', "'")
+        if token.endswith("'s"):
+            token = token[:-2]
+        if token in self.stopwords:
+            return None
+        if self.stem:
+            token = light_stem(token)
+        return token
+
+    def _chunk(self, chunk):
+        # Terms of one whitespace-separated chunk ("self-love," -> self,
+        # love), None for dropped tokens. A chunk giving exactly one term is
+        # cached as that str, anything else in self.special.
+        if len(self.cache) + len(self.special) >= self.cache_size:
+            self.cache.clear()
+            self.special.clear()
+        terms = tuple(self.normalize(token) for token in self.TOKEN.findall(chunk))
+        if len(terms) == 1 and terms[0] is not None:
+            self.cache[chunk] = terms[0]
+        else:
+            self.special[chunk] = terms
+        return terms
+
+    def _chunks(self, text):
+        # Whitespace-separated chunks, without the "[hh:mm AM] name: "
+        # prefix chat_utils.text_proc adds.
+        chunks = text.split()
+        if self.strip_prefix and len(chunks) > 2 and chunks[1] in ('AM]', 'PM]') and chunks[0].startswith('['):
+            for k in range(2, len(chunks)):
+                if chunks[k].endswith(':'):
+                    del chunks[:k + 1]
+                    break
+        return chunks
+
+    def _slow_positions(self, chunks):
+        out = []
+        pos = 0
+        for chunk in chunks:
+            term = self.cache.get(chunk)
+            if term is not None:
+                out.append((pos, term))
+                pos += 1
+                continue
+            terms = self.special.get(chunk)
+            for term in terms if terms is not None else self._chunk(chunk):
+                if term is not None:
+                    out.append((pos, term))
+                pos += 1
+        return out
+
+    def terms(self, text):
+        # Usually every chunk is a cached single term, and this is a split
+        # plus a C-level map over the cache.
+        chunks = self._chunks(text)
+        out = list(map(self.cache.get, chunks))
+        if not all(out): # A chunk not cached, or not exactly one term.
+            return [term for _, term in self._slow_positions(chunks)]
+        return out
+
+    def positions(self, text):
+        # (position, term) for each term of text; dropped tokens leave gaps.
+        chunks = self._chunks(text)
+        out = list(map(self.cache.get, chunks))
+        if not all(out): # A chunk not cached, or not exactly one term.
+            return self._slow_positions(chunks)
+        return list(enumerate(out))
+
+# Used for chat histories and the sonnets unless told otherwise.
+ANALYZER = Analyzer()
+
+#==============================================================================
+# Queries. Postings are positional: one sorted array per term whose entries
+# are line << POS_BITS | position of the term in the line. The same arrays
+# answer "which lines" (shift the position away), phrase adjacency (key + 1
+# in the next term's array) and membership tests (bisect for line <<
+# POS_BITS). Arrays of similar length are intersected as sets; a short one
+# against a long one by galloping through the long one.
+#==============================================================================
+POS_BITS = 12
+POS_MASK = (1 << POS_BITS) - 1 # Positions past this are stored as POS_MASK.
+GALLOP_RATIO = 16 # Gallop through an array this many times longer than the lines wanted from it.
+
+def _gallop(a, x, lo=0):
+    # First index i >= lo with a[i] >= x (a ascending). Steps double from
+    # lo before a bisect, so skipping k entries costs O(log k).
+    n = len(a)
+    if lo >= n or a[lo] >= x:
+        return lo
+    step = 1
+    while lo + step < n and a[lo + step] < x:
+        lo += step
+        step *= 2
+    return bisect_left(a, x, lo + 1, min(lo + step, n))
+
+def _docs(keys):
+    # Ascending distinct lines of a positional postings array.
+    out = []
+    last = -1
+    for k in keys:
+        line = k >> POS_BITS
+        if line != last:
+            out.append(line)
+            last = line
+    return out
+
+def _counts(keys):
+    # Line -> number of positions of a positional postings array, in line order.
+    return Counter([k >> POS_BITS for k in keys])
+
+def _lines(a, shift):
+    # The set of lines in a postings array (shift POS_BITS) or line list (0).
+    return {k >> shift for k in a} if shift else set(a)
+
+def _probe(wanted, a, shift):
+    # The lines of wanted (a set) also in a, galloping through a in order.
+    kept = set()
+    i = 0
+    for line in sorted(wanted):
+        i = _gallop(a, line << shift, i)
+        if i == len(a):
+            break
+        if a[i] >> shift == line:
+            kept.add(line)
+    return kept
+
+def _intersect(lists):
+    # Lines present in every (array, shift) of lists: postings arrays have
+    # shift POS_BITS, line lists 0. Starting from the shortest, an array
+    # much longer than the candidates left is galloped through; one of
+    # similar size is cheaper to intersect as a set.
+    lists = sorted(lists, key=lambda l: len(l[0]))
+    a, shift = lists[0]
+    if len(lists) == 1:
+        return _docs(a) if shift else list(a)
+    found = _lines(a, shift)
+    for a, shift in lists[1:]:
+        if not found:
+            break
+        if len(a) > GALLOP_RATIO * len(found):
+            found = _probe(found, a, shift)
+        else:
+            found &= _lines(a, shift)
+    return sorted(found)
+
+def _exclude(lines, lists):
+    # lines (ascending) minus the lines in any (array, shift) of lists.
+    for a, shift in lists:
+        if len(a) > GALLOP_RATIO * len(lines):
+            drop = _probe(lines, a, shift)
+        else:
+            drop = _lines(a, shift)
+        lines = [line for line in lines if line not in drop]
+    return lines
+
+def _phrase(terms, keys):
+    # Lines where the terms appear at their offsets from the first one.
+    # Each term's keys are moved to where the phrase would end (key +
+    # span - offset), so the phrase matches at the keys common to all
+    # terms; those are intersected as in _intersect, rarest term first.
+    span = max(offset for offset, term in terms)
+    lists = sorted(((keys(term), span - offset) for offset, term in terms), key=lambda l: len(l[0]))
+    a, lift = lists[0]
+    ends = {k + lift for k in a}
+    for a, lift in lists[1:]:
+        if not ends:
+            break
+        if len(a) > GALLOP_RATIO * len(ends):
+            kept = set()
+            i = 0
+            for end in sorted(ends):
+                i = _gallop(a, end - lift, i)
+                if i == len(a):
+                    break
+                if a[i] == end - lift:
+                    kept.add(end)
+            ends = kept
+        else:
+            ends &= {k + lift for k in a}
+    # An end whose position is below span started on the line before.
+    return _docs(sorted(end for end in ends if end & POS_MASK >= span))
+
+def _match(node, keys, universe):
+    # Ascending lines matching a parsed query. keys(term) gives a term's
+    # postings array; universe is the range of lines, for negations.
+    kind = node[0]
+    if kind == 'term':
+        return _docs(keys(node[1]))
+    if kind == 'phrase':
+        return _phrase(node[1], keys)
+    if kind == 'or':
+        found = set()
+        for child in node[1]:
+            found.update(_match(child, keys, universe))
+        return sorted(found)
+    children = node[1] if kind == 'and' else [node]
+    def arrays(nodes):
+        # Terms stay as their postings arrays; anything else becomes lines.
+        return [(keys(n[1]), POS_BITS) if n[0] == 'term' else (_match(n, keys, universe), 0) for n in nodes]
+    positive = arrays([c for c in children if c[0] != 'not'])
+    negative = arrays([c[1] for c in children if c[0] == 'not'])
+    lines = _intersect(positive) if positive else list(universe)
+    return _exclude(lines, negative)
+
+def _query_terms(node, out=None):
+    # The terms a line is rewarded for matching: those of the words and
+    # phrases of a parsed query that are not negated.
+    out = {} if out is None else out
+    kind = node[0]
+    if kind == 'term':
+        out[node[1]] = None
+    elif kind == 'phrase':
+        out.update(dict.fromkeys(term for offset, term in node[1]))
+    elif kind in ('and', 'or'):
+        for child in node[1]:
+            _query_terms(child, out)
+    return list(out)
+
+def bm25(tf, df, n, length, avg_length):
+    # Okapi BM25 weight of a term found tf times in a line of length terms,
+    # in a collection of n lines of which df contain it.
+    idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+    return idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length))
+
+QUERY_TOKEN = re.compile(r'"[^"]*"?|[()]|-|[^\s()"]+')
+WILDCARD = re.compile(r"[^\w'*?]") # Characters dropped from a wildcard pattern.
+MAX_EXPANSIONS = 256 # A wildcard stands for at most this many terms, the most frequent ones.
+MAX_QUERY_LENGTH = 1000 # Characters in a search query; parse_query refuses longer ones.
+MAX_QUERY_DEPTH = 20 # Parentheses a query may nest; each level is a recursion in parse_query and _match.
+WILDCARD_MIN_PREFIX = 2 # Letters a wildcard must start with; "*ing" or "a*" would scan every term.
+COMPLETE_MIN_PREFIX = 2 # Letters Index.complete needs before it suggests anything.
+EXPAND_LIMIT = 1024 # Terms a completion or wildcard looks at in each term dictionary, alphabetically first.
+
+def wildcard_regex(pattern):
+    # Compiled regex for a pattern where * is any run of characters and ?
+    # any one character, plus the literal prefix before the first of them.
+    prefix = re.split(r'[*?]', pattern, 1)[0]
+    body = ''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in pattern)
+    return re.compile(body + r'\Z'), prefix
+
+def parse_query(text, analyzer=None, expand=None):
+    """
+    Parses a search query into a tree of ('term', t), ('phrase', [(offset,
+    term), ...]), ('and', [...]), ('or', [...]) and ('not', node), or None
+    when nothing searchable is left. Syntax:
+
+        love death          both (AND is implied; "love AND death" too)
+        love OR beauty      either; AND binds tighter than OR
+        "summer's day"      the words next to each other, in order
+        -hate, NOT hate     lines without the word (or phrase, or group)
+        ( ... )             grouping
+        belov*, lo?e        any term matching (* any characters, ? one)
+
+    Words and phrases go through the analyzer as at indexing time; a word
+    that analyzes to several terms (self-love) is a phrase, one that
+    analyzes to none (a stopword) is ignored. A wildcard is lowercased
+    only and becomes ('or', [terms]) of the terms expand(pattern) gives;
+    without expand its * and ? are dropped like other punctuation.
+    Index.expand_pattern gives no terms for a wildcard that does not
+    start with WILDCARD_MIN_PREFIX letters, so "*" matches nothing.
+
+    Raises ValueError for a query longer than MAX_QUERY_LENGTH or with
+    parentheses nested deeper than MAX_QUERY_DEPTH. Repeated negations
+    cancel out in pairs rather than nest.
+    """
+    if len(text) > MAX_QUERY_LENGTH:
+        raise ValueError(f"query is longer than {MAX_QUERY_LENGTH} characters")
+    analyzer = analyzer if analyzer is not None else ANALYZER
+    tokens = QUERY_TOKEN.findall(text)
+    pos = 0
+    depth = 0
+
+    def words(chunk):
+        found = analyzer.positions(chunk)
+        if not found:
+            return None
+        if len(found) == 1:
+            return ('term', found[0][1])
+        return ('phrase', [(p - found[0][0], term) for p, term in found])
+
+    def primary():
+        nonlocal pos, depth
+        token = tokens[pos]
+        pos += 1
+        if token == '(':
+            depth += 1
+            if depth > MAX_QUERY_DEPTH:
+                raise ValueError(f"query nests parentheses more than {MAX_QUERY_DEPTH} deep")
+            node = expr()
+            depth -= 1
+            if pos < len(tokens) and tokens[pos] == ')':
+                pos += 1
+            return node
+        if token.startswith('"'):
+            return words(token.strip('"'))
+        if expand is not None and ('*' in token or '?' in token):
+            pattern = WILDCARD.sub('', token.lower() if analyzer.lowercase else token)
+            return ('or', [('term', term) for term in expand(pattern)])
+        return words(token)
+
+    def unary():
+        nonlocal pos
+        negations = 0
+        while tokens[pos] in ('-', 'NOT'):
+            pos += 1
+            negations += 1
+            if pos == len(tokens) or tokens[pos] in (')', 'OR'):
+                return None
+        node = primary()
+        return ('not', node) if node is not None and negations % 2 else node
+
+    def conjunction():
+        nonlocal pos
+        children = []
+        while pos < len(tokens) and tokens[pos] not in (')', 'OR'):
+            if tokens[pos] == 'AND':
+                pos += 1
+                continue
+            node = unary()
+            if node is not None:
+                children.append(node)
+        if not children:
+            return None
+        return children[0] if len(children) == 1 else ('and', children)
+
+    def expr():
+        nonlocal pos
+        children = [conjunction()]
+        while pos < len(tokens) and tokens[pos] == 'OR':
+            pos += 1
+            children.append(conjunction())
+        children = [c for c in children if c is not None]
+        if not children:
+            return None
+        return children[0] if len(children) == 1 else ('or', children)
+
+    parts = []
+    while pos < len(tokens): # A stray ")" ends expr() early; carry on after it.
+        part = expr()
+        if pos < len(tokens):
+            pos += 1
+        if part is not None:
+            parts.append(part)
+    if not parts:
+        return None
+    return parts[0] if len(parts) == 1 else ('and', parts)
+
+class SortedTerms:
+    """
+    A sorted set of terms for prefix lookups. New terms are insorted into
+    a small run that is merged into the main one once it grows past the
+    square root of its size, so adding a term moves O(sqrt n) pointers
+    (amortized) and a prefix lookup is two bisects per run.
+    """
+    def __init__(self, terms=()):
+        self.main = sorted(terms)
+        self.recent = []
+
+    def __len__(self):
+        return len(self.main) + len(self.recent)
+
+    def add(self, term):
+        # term must not be in the set yet.
+        insort(self.recent, term)
+        if len(self.recent) ** 2 > len(self.main):
+            self.main = list(heapq.merge(self.main, self.recent))
+            self.recent = []
+
+    def prefixed(self, prefix, limit=None):
+        # The terms starting with prefix, in order; only the first limit of
+        # them if given.
+        end = prefix + '\U0010ffff' # Above anything that starts with prefix.
+        runs = []
+        for run in (self.main, self.recent):
+            start = bisect_left(run, prefix)
+            stop = bisect_left(run, end, start)
+            runs.append(run[start:stop if limit is None else min(stop, start + limit)])
+        return list(heapq.merge(*runs))[:limit]
+
+def edit_distance(a, b, limit):
+    # Optimal string alignment distance between a and b (insertions,
+    # deletions, substitutions and swaps of adjacent characters), or
+    # limit + 1 once it is certain to exceed limit.
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before, row = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(row[j] + 1, current[j - 1] + 1, row[j - 1] + cost)
+            if cost and i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        before, row = row, current
+    return min(row[-1], limit + 1)
+
+class Speller:
+    """
+    "Did you mean" suggestions by symmetric deletion (as in SymSpell).
+    Each term is filed under every string its first SPELL_PREFIX
+    characters give with up to SPELL_DISTANCE of them deleted. A word
+    within that many edits of a term shares one of those deletions with
+    it, so a lookup only generates the word's own deletions, collects the
+    terms filed under them and measures those: its cost depends on the
+    word's length, not on the vocabulary.
+    """
+    def __init__(self, distance=SPELL_DISTANCE, prefix=SPELL_PREFIX):
+        self.distance = distance
+        self.prefix = prefix
+        self.counts = {} # term -> occurrences
+        self.deletes = {} # deletion -> terms filed under it
+
+    def __contains__(self, term):
+        return term in self.counts
+
+    def nbytes(self):
+        # Estimated memory held: dict entries plus the term lists.
+        return 100 * len(self.counts) + sum(120 + 8 * len(terms) for terms in self.deletes.values())
+
+    def _deletions(self, word):
+        found = frontier = {word[:self.prefix]}
+        for _ in range(self.distance):
+            frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+            found = found | frontier
+        return found
+
+    def add(self, term, count=1):
+        if term in self.counts:
+            self.counts[term] += count
+            return
+        self.counts[term] = count
+        for deletion in self._deletions(term):
+            terms = self.deletes.get(deletion)
+            if terms is None:
+                self.deletes[deletion] = [term]
+            else:
+                terms.append(term)
+
+    def lookup(self, word, n=3):
+        # Up to n known terms within self.distance edits of word, nearest
+        # first, then most frequent. Empty for a known word.
+        if word in self.counts:
+            return []
+        candidates = set()
+        for deletion in self._deletions(word):
+            candidates.update(self.deletes.get(deletion, ()))
+        scored = []
+        for term in candidates:
+            d = edit_distance(word, term, self.distance)
+            if d <= self.distance:
+                scored.append((d, -self.counts[term], term))
+        return [term for d, count, term in sorted(scored)[:n]]
+
+class MessageStore:
+    """
+    Append-only message log shared by every user's Index.
+
+    Each message is stored and tokenized once, under a sequential id. The
+    texts are packed as UTF-8 into one buffer with an offsets array, and
+    the postings map an interned word to an array('Q') of positional keys
+    (id << POS_BITS | position), ascending. Messages older than every live
+    reference can be released with trim().
+    """
+    def __init__(self, analyzer=None):
+        self.analyzer = analyzer if analyzer is not None else ANALYZER
+        self.base = 0 # id of the oldest message kept; grows when old messages are trimmed
+        self.buf = bytearray() # UTF-8 texts, back to back
+        self.offsets = array('Q', (0,)) # offsets[i]: start of message base+i, relative to the first byte ever stored
+        self.byte_base = 0 # offsets value of buf[0]
+        self.word_counts = array('I')
+        self.n_words = 0
+        self.postings = {} # word -> array('Q') of id << POS_BITS | position, ascending
+        self.terms = SortedTerms() # The words of postings, for prefix lookups.
+
+    def __len__(self):
+        return self.base + len(self.word_counts) # The next id to be assigned.
+
+    def live(self):
+        # Messages currently held.
+        return len(self.word_counts)
+
+    def add(self, text):
+        msg_id = self.base + len(self.word_counts)
+        self.buf += text.encode('utf-8')
+        self.offsets.append(self.byte_base + len(self.buf))
+        words = self.analyzer.positions(text)
+        self.word_counts.append(len(words))
+        self.n_words += len(words)
+        postings = self.postings
+        line = msg_id << POS_BITS
+        for pos, wd in words:
+            key = line | (pos if pos < POS_MASK else POS_MASK)
+            keys = postings.get(wd)
+            if keys is None:
+                wd = sys.intern(wd)
+                postings[wd] = array('Q', (key,))
+                self.terms.add(wd)
+            elif keys[-1] != key:
+                keys.append(key)
+        return msg_id
+
+    def get(self, msg_id):
+        i = msg_id - self.base
+        return self.buf[self.offsets[i] - self.byte_base:self.offsets[i + 1] - self.byte_base].decode('utf-8')
+
+    def word_count(self, msg_id):
+        return self.word_counts[msg_id - self.base]
+
+    def word_counts_of(self, ids):
+        # word_count() of each of ids.
+        base, counts = self.base, self.word_counts
+        return [counts[i - base] for i in ids]
+
+    def keys(self, term):
+        return self.postings.get(term, ())
+
+    def lookup(self, term):
+        # Ascending ids of the messages containing term.
+        return _docs(self.keys(term))
+
+    def term_counts(self, term):
+        # id -> occurrences of term, for the messages containing it.
+        return _counts(self.keys(term))
+
+    def expand(self, prefix, limit=None):
+        # term -> occurrences, for the terms starting with prefix (the first
+        # limit of them, if given).
+        postings = self.postings
+        return {term: len(postings[term]) for term in self.terms.prefixed(prefix, limit)}
+
+    def match(self, node):
+        # Ascending ids of the messages matching a parse_query() tree.
+        return _match(node, self.keys, range(self.base, len(self)))
+
+    def total_words(self):
+        return self.n_words
+
+    def append(self, texts):
+        for text in texts:
+            self.add(text)
+
+    def nbytes(self):
+        # Estimated memory held.
+        return (len(self.buf) + 8 * len(self.offsets) + 4 * len(self.word_counts) + sys.getsizeof(self.postings) +
+                8 * len(self.terms) + sum(64 + 8 * len(keys) for keys in self.postings.values())) # 64: array object header.
+
+    def trim(self, first_live):
+        # Forgets every message with an id below first_live.
+        drop = min(first_live, len(self)) - self.base
+        if drop <= 0:
+            return 0
+        self.base += drop
+        del self.buf[:self.offsets[drop] - self.byte_base]
+        self.byte_base = self.offsets[drop]
+        del self.offsets[:drop]
+        self.n_words -= sum(self.word_counts[:drop])
+        del self.word_counts[:drop]
+        n_terms = len(self.postings)
+        for wd in list(self.postings):
+            keys = self.postings[wd]
+            cut = bisect_left(keys, self.base << POS_BITS)
+            if cut == len(keys):
+                del self.postings[wd]
+            elif cut:
+                del keys[:cut]
+        if len(self.postings) < n_terms:
+            self.terms = SortedTerms(self.postings)
+        return drop
+
+def _le(arr):
+    # Segment files are little-endian whatever the host.
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+def _take_array(data, pos, count):
+    # The count little-endian uint32s at data[pos:], and the position after
+    # them. Out of a memoryview on a little-endian host this is a view, not
+    # a copy: mapped files are used in place.
+    end = pos + 4 * count
+    if isinstance(data, memoryview) and sys.byteorder == 'little':
+        return data[pos:end].cast('I'), end
+    arr = array('I')
+    arr.frombytes(data[pos:end])
+    return _le(arr), end
+
+def _packed(blobs):
+    # Offsets array('I') (one more than blobs) and blobs back to back.
+    offsets = array('I', [0])
+    for b in blobs:
+        offsets.append(offsets[-1] + len(b))
+    return offsets, b''.join(blobs)
+
+DELTA_CODES = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'} # Bytes per gap -> array typecode.
+
+def _encode_deltas(values, out):
+    # Appends ascending ints to out as their gaps (the first one from 0),
+    # all stored with the width the largest gap needs: one byte giving the
+    # width, then 1, 2, 4 or 8 bytes a gap. Frequent terms have small gaps,
+    # so their postings shrink the most.
+    gaps = [b - a for a, b in zip([0] + list(values), values)]
+    top = max(gaps, default=0)
+    width = 1 if top < 1 << 8 else 2 if top < 1 << 16 else 4 if top < 1 << 32 else 8
+    out.append(width)
+    out += _le(array(DELTA_CODES[width], gaps)).tobytes()
+
+def _decode_deltas(data, pos, end):
+    # Inverse of _encode_deltas for data[pos:end]; runs at C speed.
+    gaps = array(DELTA_CODES[data[pos]])
+    gaps.frombytes(data[pos + 1:end])
+    return array('Q', accumulate(_le(gaps)))
+
+class Segment:
+    """
+    An immutable, sealed run of history lines [first, end) in one file:
+
+        b'CHATSEG4', header '<IQIIIIH' (lines, terms indexed, text bytes,
+        postings bytes, distinct terms, term bytes, signature bytes), the
+        signature of the Analyzer that indexed it, line offsets
+        array('I'), term counts array('I'), UTF-8 texts, term offsets
+        array('I'), posting offsets array('I'), the sorted terms back to
+        back in UTF-8, and each term's positional postings (local line <<
+        POS_BITS | position) delta encoded (see _encode_deltas).
+
+    The term dictionary is searched by bisection over the packed terms, so
+    a loaded segment holds a handful of flat buffers and no per-term or
+    per-posting objects. Segments indexed by another Analyzer, or written
+    by older versions (whitespace tokens in b'CHATSEG1'/b'CHATSEG2', no
+    positions in b'CHATSEG3'), are re-indexed from their texts on load;
+    merges rewrite them.
+
+    Opening reads only the header; load() reads the rest on first use.
+    from_buffer() makes one over bytes already at hand instead, such as
+    the mapped part of a PIndex snapshot. A loaded segment has the read
+    interface of MessageStore, with local line numbers as ids.
+    """
+    MAGIC = b'CHATSEG4'
+    HEADER = struct.Struct('<IQIIIIH')
+    OLD_HEADERS = {b'CHATSEG1': struct.Struct('<IQIII'), b'CHATSEG2': struct.Struct('<IQIIII'), b'CHATSEG3': HEADER}
+
+    def __init__(self, path, first, n_lines, n_words, analyzer=None):
+        self.path = path
+        self.first = first
+        self.end = first + n_lines
+        self.n_words = n_words
+        self.analyzer = analyzer if analyzer is not None else ANALYZER
+        self.loaded = False
+        self.nbytes = 0 # Memory held once loaded (estimate).
+
+    @staticmethod
+    def file_name(first, end):
+        return f'seg-{first:012d}-{end:012d}.seg'
+
+    @classmethod
+    def open(cls, path, analyzer=None):
+        with open(path, 'rb') as f:
+            head = f.read(len(cls.MAGIC) + cls.HEADER.size)
+        header = cls.HEADER if head.startswith(cls.MAGIC) else cls.OLD_HEADERS.get(head[:len(cls.MAGIC)])
+        if header is None:
+            raise ValueError(f"{path} is not a history segment")
+        n_lines, n_words = header.unpack_from(head, len(cls.MAGIC))[:2]
+        first = int(os.path.basename(path).split('-')[1])
+        return cls(path, first, n_lines, n_words, analyzer)
+
+    @staticmethod
+    def _index_texts(texts, analyzer):
+        # Term counts per line and word -> ascending local positional keys.
+        word_counts = array('I')
+        local = {}
+        for i, t in enumerate(texts):
+            words = analyzer.positions(t)
+            word_counts.append(len(words))
+            line = i << POS_BITS
+            for pos, wd in words:
+                key = line | (pos if pos < POS_MASK else POS_MASK)
+                keys = local.get(wd)
+                if keys is None:
+                    local[wd] = [key]
+                elif keys[-1] != key:
+                    keys.append(key)
+        return word_counts, local
+
+    @staticmethod
+    def _pack_terms(local):
+        # local: word -> ascending local positional keys. Returns the term
+        # offsets, posting offsets, packed terms and packed postings.
+        term_offsets, post_offsets = array('I', (0,)), array('I', (0,))
+        terms, postings = bytearray(), bytearray()
+        for wd in sorted(local, key=lambda w: w.encode('utf-8')): # Byte order, as lookup() compares bytes.
+            terms += wd.encode('utf-8')
+            term_offsets.append(len(terms))
+            _encode_deltas(local[wd], postings)
+            post_offsets.append(len(postings))
+        return term_offsets, post_offsets, bytes(terms), bytes(postings)
+
+    @classmethod
+    def pack(cls, texts, analyzer=None):
+        # The bytes of a segment holding texts, and the terms they index.
+        analyzer = analyzer if analyzer is not None else ANALYZER
+        offsets, blob = _packed([t.encode('utf-8') for t in texts])
+        word_counts, local = cls._index_texts(texts, analyzer)
+        term_offsets, post_offsets, terms, postings = cls._pack_terms(local)
+        n_words = sum(word_counts)
+        signature = analyzer.signature.encode('utf-8')
+        parts = [cls.MAGIC, cls.HEADER.pack(len(texts), n_words, len(blob), len(postings), len(term_offsets) - 1, len(terms), len(signature)),
+                 signature, _le(offsets).tobytes(), _le(word_counts).tobytes(), blob,
+                 _le(term_offsets).tobytes(), _le(post_offsets).tobytes(), terms, postings]
+        return b''.join(parts), n_words
+
+    @classmethod
+    def write(cls, directory, first, texts, analyzer=None):
+        # Writes texts as the segment starting at line first and returns it, already loaded.
+        analyzer = analyzer if analyzer is not None else ANALYZER
+        data, n_words = cls.pack(texts, analyzer)
+        path = os.path.join(directory, cls.file_name(first, first + len(texts)))
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path) # Readers never see a half-written segment.
+        seg = cls(path, first, len(texts), n_words, analyzer)
+        seg._parse(data)
+        return seg
+
+    @classmethod
+    def from_buffer(cls, data, analyzer=None):
+        # A loaded segment (lines numbered from 0) over the bytes pack()
+        # made. Given a memoryview, e.g. of an mmap, its arrays are views
+        # into data rather than copies, so nothing is read until it is used.
+        magic = bytes(data[:len(cls.MAGIC)])
+        header = cls.HEADER if magic == cls.MAGIC else cls.OLD_HEADERS.get(magic)
+        if header is None:
+            raise ValueError("not a history segment")
+        n_lines, n_words = header.unpack_from(data, len(magic))[:2]
+        seg = cls(None, 0, n_lines, n_words, analyzer)
+        seg._parse(data)
+        return seg
+
+    def _set(self, offsets, word_counts, blob, term_offsets, post_offsets, terms, postings):
+        self.offsets = offsets
+        self.word_counts = word_counts
+        self.blob = blob
+        self.term_offsets = term_offsets
+        self.post_offsets = post_offsets
+        self.terms = terms
+        self.postings = postings
+        self.loaded = True
+        self.nbytes = (len(blob) + len(terms) + len(postings) +
+                       4 * (len(offsets) + len(word_counts) + len(term_offsets) + len(post_offsets)))
+
+    def load(self):
+        if self.loaded:
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        self._parse(data)
+
+    def _parse(self, data):
+        magic = bytes(data[:len(self.MAGIC)])
+        header = self.HEADER if magic == self.MAGIC else self.OLD_HEADERS[magic]
+        fields = header.unpack_from(data, len(magic))
+        pos = len(magic) + header.size
+        def take_array(count):
+            nonlocal pos
+            arr, pos = _take_array(data, pos, count)
+            return arr
+        def take_bytes(count):
+            nonlocal pos
+            pos += count
+            return data[pos - count:pos]
+        n_lines, blob_len = fields[0], fields[2]
+        signature = str(take_bytes(fields[6]), 'utf-8') if header is self.HEADER else None
+        offsets, word_counts = take_array(n_lines + 1), take_array(n_lines)
+        blob = take_bytes(blob_len)
+        if magic != self.MAGIC or signature != self.analyzer.signature:
+            # Indexed differently: only the texts are reused.
+            texts = [str(blob[offsets[i]:offsets[i + 1]], 'utf-8') for i in range(n_lines)]
+            word_counts, local = self._index_texts(texts, self.analyzer)
+            self.n_words = sum(word_counts)
+            self._set(offsets, word_counts, blob, *self._pack_terms(local))
+            return
+        _, _, _, postings_len, n_terms, terms_len, _ = fields
+        term_offsets, post_offsets = take_array(n_terms + 1), take_array(n_terms + 1)
+        terms = take_bytes(terms_len)
+        postings = take_bytes(postings_len)
+        self._set(offsets, word_counts, blob, term_offsets, post_offsets, terms, postings)
+
+    def __len__(self):
+        return self.end - self.first
+
+    def total_words(self):
+        return self.n_words
+
+    def word_count(self, i):
+        # Terms indexed in local line i.
+        return self.word_counts[i]
+
+    def word_counts_of(self, ids):
+        return [self.word_counts[i] for i in ids]
+
+    def term_counts(self, term):
+        # Local line -> occurrences of term in it.
+        return _counts(self.keys(term))
+
+    def get(self, i):
+        # Text of local line i.
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def texts(self):
+        return [self.get(i) for i in range(self.end - self.first)]
+
+    def term(self, t):
+        # The t-th term, in sorted order, as UTF-8 bytes.
+        return bytes(self.terms[self.term_offsets[t]:self.term_offsets[t + 1]])
+
+    def find_term(self, key):
+        # Index of the first term >= key (UTF-8 bytes).
+        lo, hi = 0, len(self.term_offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def expand(self, prefix, limit=None):
+        # term -> occurrences, for the terms starting with prefix (the first
+        # limit of them, if given). The counts come from the size of each
+        # term's postings, which are not decoded.
+        key = prefix.encode('utf-8')
+        start, end = self.find_term(key), self.find_term(key + b'\xff') # 0xff never occurs in UTF-8.
+        if limit is not None:
+            end = min(end, start + limit)
+        found = {}
+        for t in range(start, end):
+            pos = self.post_offsets[t]
+            found[self.term(t).decode('utf-8')] = (self.post_offsets[t + 1] - pos - 1) // self.postings[pos]
+        return found
+
+    def keys(self, term):
+        # Positional postings of term, with local line numbers.
+        key = term.encode('utf-8')
+        t = self.find_term(key)
+        if t == len(self.term_offsets) - 1 or self.term(t) != key:
+            return ()
+        return _decode_deltas(self.postings, self.post_offsets[t], self.post_offsets[t + 1])
+
+    def lookup(self, term):
+        # Local line numbers containing term.
+        return _docs(self.keys(term))
+
+    def match(self, node):
+        # Local line numbers matching a parse_query() tree.
+        return _match(node, self.keys, range(self.end - self.first))
+
+class SegmentedHistory:
+    """
+    A user's history on disk: a directory of immutable Segments plus a tail
+    log of the newest lines (one JSON [line, text] record per line).
+
+    New lines are only ever appended to the tail. Once the tail holds
+    TAIL_MAX lines it is sealed into a segment, and MERGE_FACTOR segments
+    of the same size class are merged into one by a background thread, so
+    a history of n lines has O(log n) segments.
+
+    Opening lists the directory, reads the segment headers and the (short)
+    tail; segment contents are read on the first get() or lookup(). It has
+    the read interface of MessageStore, with line numbers as ids.
+
+    Use SegmentedHistory.open(path) so that one directory is only ever
+    handled by one object (a background merge may still be running when
+    the user logs in again).
+
+    Across processes (chat_cluster workers) an open history holds a shared
+    lock on HIST_LOCK for as long as it lives. Merging and removing files
+    need it exclusively and are skipped while another process has the
+    history open, so no segment is deleted under a reader; the leftovers
+    are cleaned up by whichever opens the history next on its own.
+    """
+    _live = weakref.WeakValueDictionary() # path -> open SegmentedHistory
+    _live_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path, analyzer=None):
+        with cls._live_lock:
+            history = cls._live.get(path)
+            if history is None:
+                history = cls._live[path] = cls(path, analyzer)
+            return history
+
+    def __init__(self, path, analyzer=None):
+        self.path = path
+        self.analyzer = analyzer if analyzer is not None else ANALYZER
+        self.lock = threading.Lock() # Guards segments/tail; held briefly.
+        self.io_lock = threading.Lock() # Serializes flushes and merges.
+        self.merging = False
+        os.makedirs(path, exist_ok=True)
+        self.lock_file = open(os.path.join(path, HIST_LOCK), 'a+b') # Closing it (when collected) drops the lock.
+        if fcntl is not None:
+            fcntl.lockf(self.lock_file, fcntl.LOCK_SH) # Waits out another process's merge.
+        self.segments = self._open_segments()
+        end = self.segments[-1].end if self.segments else 0
+        self.tail_first = end # Line number of tail[0].
+        self.tail = [] # Tail lines, flushed or not.
+        self.flushed = 0 # How many of self.tail are already in the tail log.
+        self.tail_words = 0
+        self.tail_word_counts = array('I') # Terms in each tail line.
+        self.tail_postings = {} # term -> array('Q') of the tail's positional keys (line << POS_BITS | position)
+        self.tail_terms = SortedTerms() # The terms of tail_postings.
+        self._read_tail()
+
+    def _exclusive(self):
+        # Whether no other process has this history open. If so, the lock
+        # is now held exclusively (no other process can open it either)
+        # until _shared(). lockf, unlike flock, keeps the shared lock when
+        # this fails.
+        if fcntl is None:
+            return True
+        try:
+            fcntl.lockf(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+    def _shared(self):
+        if fcntl is not None:
+            fcntl.lockf(self.lock_file, fcntl.LOCK_SH)
+
+    def _open_segments(self):
+        # Non-overlapping segments covering the history. A crash after a
+        # merge was written but before its inputs were deleted leaves both;
+        # the merged segment wins. So does a merge by another process that
+        # could not delete its inputs because this history was open here.
+        alone = self._exclusive()
+        try:
+            found = []
+            for fname in os.listdir(self.path):
+                full = os.path.join(self.path, fname)
+                if fname.endswith('.tmp'):
+                    if alone:
+                        os.remove(full) # Interrupted write.
+                elif fname.startswith('seg-') and fname.endswith('.seg'):
+                    found.append(Segment.open(full, self.analyzer))
+            found.sort(key=lambda seg: (seg.first, -seg.end))
+            segments = []
+            for seg in found:
+                if segments and seg.first < segments[-1].end:
+                    if alone:
+                        os.remove(seg.path) # Covered by a merged segment.
+                    continue
+                segments.append(seg)
+            return segments
+        finally:
+            if alone:
+                self._shared()
+
+    def _tail_path(self):
+        return os.path.join(self.path, 'tail.log')
+
+    def _read_tail(self):
+        try:
+            with open(self._tail_path(), 'rb+') as f:
+                good = 0 # End of the last complete record.
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError
+                        n, text = json.loads(line)
+                    except ValueError: # Torn last record from a crash: cut it off.
+                        f.truncate(good)
+                        break
+                    good += len(line)
+                    if n < self.tail_first + len(self.tail):
+                        continue # Already sealed into a segment.
+                    self._index_tail_line(n, text)
+                    self.tail.append(text)
+        except FileNotFoundError:
+            pass
+        self.flushed = len(self.tail)
+
+    def _index_tail_line(self, n, text):
+        # Adds line n (about to join the tail) to the tail's postings.
+        words = self.analyzer.positions(text)
+        self.tail_words += len(words)
+        self.tail_word_counts.append(len(words))
+        line = n << POS_BITS
+        for pos, wd in words:
+            key = line | (pos if pos < POS_MASK else POS_MASK)
+            keys = self.tail_postings.get(wd)
+            if keys is None:
+                self.tail_postings[wd] = array('Q', (key,))
+                self.tail_terms.add(wd)
+            elif keys[-1] != key:
+                keys.append(key)
+
+    def __len__(self):
+        return self.tail_first + len(self.tail)
+
+    def total_words(self):
+        return sum(seg.n_words for seg in self.segments) + self.tail_words
+
+    def nbytes(self):
+        # Estimated memory held: loaded segments plus the tail lines.
+        with self.lock:
+            return (sum(seg.nbytes for seg in self.segments if seg.loaded) + sum(len(t) + STR_OVERHEAD for t in self.tail) +
+                    8 * len(self.tail_terms) + sum(64 + 8 * len(keys) for keys in self.tail_postings.values()))
+
+    def _segment_of(self, n):
+        # The segment holding line n (n must be below tail_first).
+        i = bisect_left([seg.end for seg in self.segments], n + 1)
+        seg = self.segments[i]
+        seg.load()
+        return seg
+
+    def get(self, n):
+        with self.lock:
+            if n >= self.tail_first:
+                return self.tail[n - self.tail_first]
+            seg = self._segment_of(n)
+            return seg.get(n - seg.first)
+
+    def word_count(self, n):
+        with self.lock:
+            if n >= self.tail_first:
+                return self.tail_word_counts[n - self.tail_first]
+            seg = self._segment_of(n)
+            return seg.word_counts[n - seg.first]
+
+    def lookup(self, term):
+        # Ascending line numbers of the lines containing term.
+        return self.match(('term', term))
+
+    def word_counts_of(self, lines):
+        # word_count() of each of lines (ascending), a segment at a time.
+        out = []
+        with self.lock:
+            i = 0
+            for seg in self.segments:
+                j = bisect_left(lines, seg.end, i)
+                if j > i:
+                    seg.load()
+                    first, counts = seg.first, seg.word_counts
+                    out += [counts[n - first] for n in lines[i:j]]
+                i = j
+            tail_first, counts = self.tail_first, self.tail_word_counts
+            out += [counts[n - tail_first] for n in lines[i:]]
+        return out
+
+    def expand(self, prefix, limit=None):
+        # term -> occurrences, for the terms starting with prefix; with a
+        # limit, only the first limit of them in each segment and the tail.
+        found = Counter()
+        with self.lock:
+            for seg in self.segments:
+                seg.load()
+                found.update(seg.expand(prefix, limit))
+            postings = self.tail_postings
+            found.update({term: len(postings[term]) for term in self.tail_terms.prefixed(prefix, limit)})
+        return found
+
+    def term_counts(self, term):
+        # Line number -> occurrences of term, for the lines containing it.
+        counts = {}
+        with self.lock:
+            for seg in self.segments:
+                seg.load()
+                first = seg.first
+                counts.update(Counter([first + (k >> POS_BITS) for k in seg.keys(term)]))
+            counts.update(_counts(self.tail_postings.get(term, ())))
+        return counts
+
+    def match(self, node):
+        # Ascending line numbers of the lines matching a parse_query() tree,
+        # evaluated segment by segment and then on the tail.
+        found = []
+        with self.lock:
+            for seg in self.segments:
+                seg.load()
+                first = seg.first
+                found += [first + i for i in seg.match(node)]
+            found += _match(node, lambda term: self.tail_postings.get(term, ()), range(self.tail_first, len(self)))
+        return found
+
+    def append(self, texts):
+        # Adds lines in memory; flush() writes them.
+        with self.lock:
+            for text in texts:
+                self._index_tail_line(len(self), text)
+                self.tail.append(text)
+
+    def flush(self):
+        # Appends unwritten lines to the tail log and seals a full tail.
+        # Blocking file I/O; AsyncServer runs it in its executor.
+        with self.io_lock:
+            with self.lock:
+                first = self.tail_first + self.flushed
+                records = self.tail[self.flushed:]
+            if records:
+                with open(self._tail_path(), 'a', encoding='utf-8') as f:
+                    f.write(''.join(json.dumps([first + i, t], ensure_ascii=False) + '\n' for i, t in enumerate(records)))
+                    f.flush()
+                    os.fsync(f.fileno()) # The journal may be emptied once this returns.
+                with self.lock:
+                    self.flushed += len(records)
+            if self.flushed >= TAIL_MAX:
+                self._seal()
+        self._maybe_merge()
+
+    def _seal(self):
+        # Turns the flushed part of the tail into a segment. Caller holds io_lock.
+        with self.lock:
+            first = self.tail_first
+            texts = self.tail[:self.flushed]
+        seg = Segment.write(self.path, first, texts, self.analyzer)
+        # Unflushed lines appended meanwhile stay in memory only; the tail
+        # log is restarted empty and they go to it on the next flush.
+        open(self._tail_path(), 'w').close()
+        with self.lock:
+            self.segments.append(seg)
+            del self.tail[:len(texts)]
+            self.tail_first = seg.end
+            self.flushed = 0
+            self.tail_words = 0
+            self.tail_word_counts = array('I')
+            self.tail_postings = {}
+            self.tail_terms = SortedTerms()
+            for i, text in enumerate(self.tail):
+                self._index_tail_line(self.tail_first + i, text)
+
+    def _merge_candidates(self):
+        # MERGE_FACTOR consecutive segments in the same size class, if any.
+        def size_class(seg):
+            n, c = (seg.end - seg.first) // TAIL_MAX, 0
+            while n >= MERGE_FACTOR:
+                n //= MERGE_FACTOR
+                c += 1
+            return c
+        with self.lock:
+            segs = list(self.segments)
+        for i in range(len(segs) - MERGE_FACTOR + 1):
+            run = segs[i:i + MERGE_FACTOR]
+            if len({size_class(seg) for seg in run}) == 1:
+                return run
+        return None
+
+    def _maybe_merge(self):
+        if self._merge_candidates() is None:
+            return
+        with self.lock:
+            if self.merging:
+                return
+            self.merging = True
+        threading.Thread(target=self._merge_loop, name=f"merge {self.path}", daemon=True).start()
+
+    def _merge_loop(self):
+        try:
+            while True:
+                run = self._merge_candidates()
+                if run is None or self.merge(run) is None:
+                    break
+        finally:
+            with self.lock:
+                self.merging = False
+
+    def merge(self, run):
+        # Replaces consecutive segments with one. Inputs are deleted only
+        # after the merged file is in place. Returns None, merging nothing,
+        # while another process has the history open and may still load
+        # the inputs; a flush after it is gone merges them.
+        texts = []
+        for seg in run:
+            seg.load()
+            texts.extend(seg.texts())
+        with self.io_lock:
+            if not self._exclusive():
+                return None
+            try:
+                merged = Segment.write(self.path, run[0].first, texts, self.analyzer)
+                with self.lock:
+                    i = self.segments.index(run[0])
+                    self.segments[i:i + len(run)] = [merged]
+                for seg in run:
+                    os.remove(seg.path)
+            finally:
+                self._shared()
+        return merged
 
 class Index:
-    def __init__(self, name):
+    """
+    One user's chat history: the lines from earlier sessions (past, a
+    SegmentedHistory on the server or a private MessageStore) followed by
+    the ids of the lines received this session, which live in a
+    MessageStore shared with every other logged-in user.
+    """
+    def __init__(self, name, store=None, past=None, analyzer=None):
         self.name = name
-        self.msgs = []
-        self.index = {}
-        self.total_msgs = 0
-        self.total_words = 0
-        
+        self.analyzer = analyzer if analyzer is not None else ANALYZER # Must be the one past and store index with.
+        self.past = past if past is not None else MessageStore(self.analyzer) # Earlier lines; ids double as line numbers.
+        self.store = store if store is not None else MessageStore(self.analyzer)
+        self.msg_ids = array('Q') # This session's lines, as ids into self.store (64-bit: the shared store's ids only grow).
+        self.session_bytes = 0 # Store memory this session's lines keep alive (estimate).
+        self.total_msgs = len(self.past)
+        self.total_words = self.past.total_words()
+        self.spell = None # Speller over this user's terms, made by speller() when first needed.
+        self.spell_lines = 0 # Lines the speller covers.
+        self.spell_lock = threading.Lock() # Serializes building and topping up the speller.
+
+    def __getstate__(self):
+        # Pickles as the plain list of lines so .idx files stay independent
+        # of the shared store.
+        return {'name': self.name, 'msgs': [self.get_msg(i) for i in range(self.total_msgs)]}
+
+    def __setstate__(self, state):
+        # Also reads .idx files pickled by the old Index, which kept its own
+        # msgs/index; only the lines are needed.
+        self.__init__(state['name'])
+        for m in state['msgs']:
+            self.past.add(m)
+        self.total_msgs = len(self.past)
+        self.total_words = self.past.total_words()
+
+    def share_store(self, store):
+        # Sends this session's lines to store (the server's shared log).
+        if self.msg_ids and store is not self.store:
+            raise ValueError("Index already has lines in another store")
+        self.store = store
+
+    def session_lines(self):
+        return [self.store.get(msg_id) for msg_id in self.msg_ids]
+
+    def checkpoint(self):
+        # Moves this session's lines into past (for a SegmentedHistory, to
+        # be written by its flush()) and drops the references into store.
+        self.past.append(self.session_lines())
+        self.msg_ids = array('Q')
+        self.session_bytes = 0
+
+    def nbytes(self):
+        # Estimated memory this index holds or keeps alive.
+        past = self.past.nbytes() if isinstance(self.past, SegmentedHistory) else 0
+        spell = self.spell.nbytes() if self.spell is not None else 0
+        return past + spell + self.session_bytes + self.msg_ids.itemsize * len(self.msg_ids)
+
     def get_total_words(self):
         return self.total_words
         
@@ -17,95 +1344,621 @@ class Index:
         return self.total_msgs
         
     def get_msg(self, n):
-        return self.msgs[n]
+        if n < len(self.past):
+            return self.past.get(n)
+        return self.store.get(self.msg_ids[n - len(self.past)])
         
-    def add_msg(self, m):
-        self.msgs.append(m)
+    def add_msg_id(self, msg_id):
+        # Appends a line that is already in self.store.
+        self.msg_ids.append(msg_id)
+        self.session_bytes += len(self.store.get(msg_id)) + STR_OVERHEAD
         self.total_msgs += 1
+        self.total_words += self.store.word_count(msg_id)
+
+    def add_msg(self, m):
+        self.add_msg_id(self.store.add(m))
         
     def add_msg_and_index(self, m):
+        # Messages are indexed when they enter the store.
         self.add_msg(m)
-        line_at = self.total_msgs - 1
-        self.indexing(m, line_at)
- 
-    def indexing(self, m, l):
-        words = m.split()
-        self.total_words += len(words)
-        for wd in words:
-            if wd not in self.index:
-                self.index[wd] = [l,]
-            else:
-                self.index[wd].append(l)
+
+    def first_msg_id(self):
+        # Oldest id in self.store this index still refers to, or None.
+        return self.msg_ids[0] if self.msg_ids else None
+
+    def _seen(self, ids):
+        # Positions in self.msg_ids of the ids (ascending) this user has seen.
+        # Both sides are sorted, so the smaller one is walked and looked up
+        # in the larger one with a bisect that only moves forward.
+        mine = self.msg_ids
+        found = []
+        if len(ids) <= len(mine):
+            lo = 0
+            for msg_id in ids:
+                lo = bisect_left(mine, msg_id, lo)
+                if lo == len(mine):
+                    break
+                if mine[lo] == msg_id:
+                    found.append(lo)
+        else:
+            lo = 0
+            for pos, msg_id in enumerate(mine):
+                lo = bisect_left(ids, msg_id, lo)
+                if lo == len(ids):
+                    break
+                if ids[lo] == msg_id:
+                    found.append(pos)
+        return found
                                      
-    def search(self, term):
-        msgs = []
-        if (term in self.index.keys()):
-            indices = self.index[term]
-            msgs = [(i, self.msgs[i]) for i in indices]
+    def expand(self, prefix, limit=None):
+        # term -> occurrences in this user's lines, for the terms starting
+        # with prefix. Terms of the shared store only count where the line
+        # is one of this user's. A limit bounds the terms looked at in each
+        # term dictionary (see EXPAND_LIMIT), the shared store's included.
+        found = Counter(self.past.expand(prefix, limit))
+        if len(self.msg_ids) == self.store.live(): # A store of our own (PIndex, tests): all of it counts.
+            found.update(self.store.expand(prefix, limit))
+        elif self.msg_ids:
+            for term in self.store.expand(prefix, limit):
+                shared = self.store.term_counts(term)
+                mine = sum(shared[self.msg_ids[pos]] for pos in self._seen(list(shared)))
+                if mine:
+                    found[term] += mine
+        return found
+
+    def complete(self, prefix, n=10):
+        # The n most frequent terms starting with prefix (lowercased if the
+        # analyzer lowercases), most frequent first, among the first
+        # EXPAND_LIMIT of each term dictionary. Nothing for a prefix shorter
+        # than COMPLETE_MIN_PREFIX, which would go through most of the terms.
+        if self.analyzer.lowercase:
+            prefix = prefix.lower()
+        prefix = prefix.replace('\u2019', "'")
+        if len(prefix) < COMPLETE_MIN_PREFIX:
+            return []
+        found = self.expand(prefix, EXPAND_LIMIT)
+        return heapq.nlargest(n, sorted(found), key=found.get)
+
+    def expand_pattern(self, pattern):
+        # Up to MAX_EXPANSIONS terms matching a wildcard pattern (see
+        # parse_query), the most frequent ones. Only terms under the literal
+        # prefix are looked at, so "belov*" is a range lookup; a pattern
+        # with a shorter prefix than WILDCARD_MIN_PREFIX ("*ing", "l?ve")
+        # would go through most of the terms and expands to none. At most
+        # EXPAND_LIMIT terms of each term dictionary are looked at.
+        regex, prefix = wildcard_regex(pattern)
+        if len(prefix) < WILDCARD_MIN_PREFIX:
+            return []
+        found = {term: n for term, n in self.expand(prefix, EXPAND_LIMIT).items() if regex.match(term)}
+        return heapq.nlargest(MAX_EXPANSIONS, sorted(found), key=found.get)
+
+    def speller(self, build=True):
+        # The Speller over this user's terms. Built from the term
+        # dictionaries on first use, then topped up with the lines added
+        # since. With build False it is only returned if it already covers
+        # every line, else None, so a caller never waits on a build running
+        # in another thread nor starts a second one.
+        if not build:
+            spell = self.spell
+            return spell if spell is not None and self.spell_lines == self.total_msgs else None
+        with self.spell_lock:
+            lines = self.total_msgs
+            if self.spell is None:
+                spell = Speller()
+                for term, n in self.expand('').items():
+                    spell.add(term, n)
+                self.spell_lines = lines
+                self.spell = spell # Published last and complete, for speller(build=False).
+            else:
+                for i in range(self.spell_lines, lines):
+                    for term in self.analyzer.terms(self.get_msg(i)):
+                        self.spell.add(term)
+                self.spell_lines = lines
+            return self.spell
+
+    def suggest(self, query, fallback=None, n=3):
+        """
+        Spelling corrections for the words of query that are not in this
+        user's history. Returns (the query with each such word replaced by
+        its best correction, or None if nothing was corrected, {word:
+        [corrections, best first]}). Corrections come from this user's
+        terms or, failing that, from the fallback Speller (the sonnets'),
+        whose words are never corrected. Operators and wildcard words are
+        left alone.
+        """
+        speller = self.speller()
+        corrections = {}
+
+        def correct(m):
+            word = m.group()
+            if word in ('AND', 'OR', 'NOT') or '*' in word or '?' in word:
+                return word
+            terms = self.analyzer.terms(word)
+            if len(terms) != 1 or terms[0] in speller or (fallback is not None and terms[0] in fallback):
+                return word # Known here, or a real word that just isn't in this history.
+            found = speller.lookup(terms[0], n)
+            if not found and fallback is not None:
+                found = fallback.lookup(terms[0], n)
+            if not found:
+                return word
+            corrections[word] = found
+            return found[0]
+
+        corrected = re.sub(r"[\w'\u2019*?]+", correct, query)
+        return (corrected if corrections else None), corrections
+
+    def search(self, query):
+        # (line number, text) of the lines matching query, in order. See
+        # parse_query for the syntax; words are analyzed as for indexing,
+        # so "Love," finds "love's". A query of only stopwords finds nothing.
+        node = parse_query(query, self.analyzer, self.expand_pattern)
+        if node is None:
+            return []
+        msgs = [(i, self.past.get(i)) for i in self.past.match(node)]
+        offset = len(self.past)
+        msgs += [(offset + pos, self.store.get(self.msg_ids[pos])) for pos in self._seen(self.store.match(node))]
         return msgs
 
+    def word_count(self, n):
+        # Terms in line n.
+        if n < len(self.past):
+            return self.past.word_count(n)
+        return self.store.word_count(self.msg_ids[n - len(self.past)])
+
+    def term_counts(self, term):
+        # Line number -> occurrences of term, over this user's lines; its
+        # length is the term's document frequency.
+        counts = self.past.term_counts(term)
+        shared = self.store.term_counts(term)
+        offset = len(self.past)
+        for pos in self._seen(list(shared)):
+            counts[offset + pos] = shared[self.msg_ids[pos]]
+        return counts
+
+    def keys(self, term):
+        # Positional postings of term (line number << POS_BITS | position)
+        # over this user's lines, ascending.
+        keys = list(self.past.keys(term))
+        shared = self.store.keys(term)
+        if shared:
+            ids = _docs(shared)
+            offset = len(self.past)
+            lines = {self.msg_ids[pos]: offset + pos for pos in self._seen(ids)}
+            keys += [lines[key >> POS_BITS] << POS_BITS | key & POS_MASK for key in shared if key >> POS_BITS in lines]
+        return keys
+
+    def search_topk(self, query, k, offset=0, keep=None):
+        """
+        The k lines best matching query, skipping the offset best, ranked by
+        BM25 over this user's history (ties: newer lines first). Returns
+        ([(line number, text, score), ...], number of lines matching). Only
+        the returned lines are read; the ranking keeps a heap of offset + k
+        entries. keep(line number), if given, says which matches count.
+        """
+        node = parse_query(query, self.analyzer, self.expand_pattern)
+        if node is None or k <= 0:
+            return [], 0
+        n = self.total_msgs
+        avg_length = max(self.total_words / max(n, 1), 1)
+        term_counts = [self.term_counts(term) for term in _query_terms(node)]
+        past_end = len(self.past)
+        hits = self.past.match(node)
+        session = self._seen(self.store.match(node))
+        if keep is not None:
+            hits = [line for line in hits if keep(line)]
+            session = [pos for pos in session if keep(past_end + pos)]
+        lengths = self.past.word_counts_of(hits)
+        hits += [past_end + pos for pos in session]
+        lengths += self.store.word_counts_of([self.msg_ids[pos] for pos in session])
+
+        def scored():
+            for line, length in zip(hits, lengths):
+                score = 0.0
+                for counts in term_counts:
+                    tf = counts.get(line)
+                    if tf:
+                        score += bm25(tf, len(counts), n, length, avg_length)
+                yield score, line
+
+        top = heapq.nlargest(offset + k, scored())[offset:]
+        return [(line, self.get_msg(line), score) for score, line in top], len(hits)
+
+class IndexCache:
+    """
+    The indices of the logged-in users, kept in memory within a byte budget.
+
+    open(name) registers a user without reading anything; the index is
+    loaded by load(name) on first access. enforce() hands the least
+    recently used indices to save(name, index) and drops them until the
+    resident ones fit the budget; they are loaded again when next used.
+    Membership (in, open, close) is about users, values() only covers the
+    resident indices.
+    """
+    def __init__(self, load, save, budget):
+        self.load = load
+        self.save = save
+        self.budget = budget # Bytes; the most recently used index always stays.
+        self.names = set() # Users with an index, resident or not.
+        self.resident = OrderedDict() # name -> Index, least recently used first
+        self.sizes = {} # name -> bytes as of the last enforce()
+        self.resident_bytes = 0
+        self.touched = set() # Resident names used since the last enforce().
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def open(self, name):
+        self.names.add(name)
+
+    def close(self, name):
+        # Forgets name; returns its resident index (to be saved) or None.
+        self.names.discard(name)
+        self.touched.discard(name)
+        self.resident_bytes -= self.sizes.pop(name, 0)
+        return self.resident.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, name):
+        index = self.resident.get(name)
+        if index is not None:
+            self.hits += 1
+            self.resident.move_to_end(name)
+        elif name in self.names:
+            self.misses += 1
+            index = self.resident[name] = self.load(name)
+        else:
+            raise KeyError(name)
+        self.touched.add(name)
+        return index
+
+    def values(self):
+        return list(self.resident.values())
+
+    def enforce(self):
+        # Re-measures the indices used since the last call, then evicts
+        # from the least recently used end while over budget.
+        for name in self.touched:
+            size = self.resident[name].nbytes()
+            self.resident_bytes += size - self.sizes.get(name, 0)
+            self.sizes[name] = size
+        self.touched.clear()
+        while self.resident_bytes > self.budget and len(self.resident) > 1:
+            name, index = self.resident.popitem(last=False)
+            self.resident_bytes -= self.sizes.pop(name, 0)
+            self.save(name, index)
+            self.evictions += 1
+
+    def stats(self):
+        return {"users": len(self.names), "resident": len(self.resident), "resident_bytes": self.resident_bytes,
+                "budget": self.budget, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+RHYME_VOWELS = frozenset('aeiou')
+
+def rhyme_key(word):
+    """
+    The ending of word that a rhyme has to share, going by spelling: from
+    its last vowel group to the end, once apostrophes are dropped, 'y'
+    (but a leading one) is read as 'i' and doubled letters as one. A
+    final silent 'e' takes in the vowel group before it. day, away -> ai;
+    thee, me -> e; love, prove -> ove; time, rhyme -> ime.
+    """
+    w = word.lower().replace("'", '').replace('\u2019', '')
+    if not w:
+        return ''
+    w = w[0] + w[1:].replace('y', 'i')
+    w = ''.join(c for i, c in enumerate(w) if i == 0 or c != w[i - 1])
+    i = len(w)
+    if i > 2 and w[-1] == 'e' and w[-2] not in RHYME_VOWELS and not RHYME_VOWELS.isdisjoint(w[:-2]):
+        i -= 1 # Silent e.
+    while i > 0 and w[i - 1] not in RHYME_VOWELS:
+        i -= 1
+    while i > 0 and w[i - 1] in RHYME_VOWELS:
+        i -= 1
+    return w[i:]
+
 class PIndex(Index):
-    def __init__(self, name):
+    """
+    The sonnets: every line of the corpus file, indexed, plus the place and
+    text of each sonnet (see build_poem_table).
+
+    Parsing and indexing the text is done once by write_snapshot(), which
+    saves it all in one file (corpus + SNAPSHOT_SUFFIX; roman2num.py is the
+    build step):
+
+        b'SONNETS2', header '<IIIIII' (numerals, numeral bytes, sonnets,
+        sonnet text bytes, rhyme lines, segment bytes), numbers
+        array('I'), numeral offsets array('I'), the numerals in ASCII,
+        sonnet numbers, heading lines, first and end body lines
+        array('I'), sonnet text offsets array('I'), the sonnet texts in
+        UTF-8, the rhyme index array('I'), then, 8-byte aligned, every
+        line of the corpus as a Segment (texts, terms and postings).
+
+    Besides the postings, two lookups are precomputed: the positional
+    postings already place every word for concordance(), and the rhyme
+    index lists the sonnet lines by the reversed rhyme_key() of their last
+    word, so rhymes() is a bisection.
+
+    load_snapshot() maps that file into memory: the line store and the
+    postings are used in place, so loading reads only the small tables
+    and does not grow with the corpus. open() uses the snapshot when it is
+    newer than its sources and falls back to the text otherwise.
+    """
+    SNAPSHOT_MAGIC = b'SONNETS2' # Bump when the layout changes; old snapshots are then rebuilt.
+    SNAPSHOT_HEADER = struct.Struct('<IIIIII')
+    SNAPSHOT_SUFFIX = '.snap'
+    NUMERALS = 'roman.txt.pk'
+
+    def __init__(self, name, int2roman=None):
         super().__init__(name)
+        if int2roman is None:
+            try:
+                with open(self.NUMERALS, 'rb') as roman_int_f:
+                    int2roman = pickle.load(roman_int_f)
+            except FileNotFoundError:
+                print(f"ERROR: {self.NUMERALS} not found. Please ensure it's in the correct location.")
+                raise
+            except pickle.PickleError as e:
+                print(f"ERROR: Could not load Roman numeral mapping from {self.NUMERALS}: {e}")
+                raise
+        self.int2roman = int2roman
+        self.load_poems()
+
+    @classmethod
+    def open(cls, name):
+        # The index of corpus name, from its snapshot when that is current.
+        # Otherwise the text is indexed and the snapshot (re)written for the
+        # next start.
+        path = name + cls.SNAPSHOT_SUFFIX
         try:
-            with open('roman.txt.pk', 'rb') as roman_int_f:
-                self.int2roman = pickle.load(roman_int_f)
+            built = os.path.getmtime(path)
+            if built >= max(os.path.getmtime(name), os.path.getmtime(cls.NUMERALS)):
+                return cls.load_snapshot(path, name)
+            print(f"[Server Log] {path} is older than {name} or {cls.NUMERALS}, rebuilding it.")
         except FileNotFoundError:
-            print("ERROR: roman.txt.pk not found. Please ensure it's in the correct location.")
-            raise
-        except pickle.PickleError as e:
-            print(f"ERROR: Could not load Roman numeral mapping from roman.txt.pk: {e}")
-            raise
-        self.load_poems()
-        
+            pass
+        except (OSError, ValueError, struct.error) as e:
+            print(f"[Server Log] Could not load {path} ({e}), rebuilding it.")
+        sonnets = cls(name)
+        try:
+            sonnets.write_snapshot(path)
+        except OSError as e:
+            print(f"[Server Log] Could not write {path}: {e}")
+        return sonnets
+
+    def write_snapshot(self, path):
+        # Saves the lines, postings, numerals and sonnet table for
+        # load_snapshot().
+        segment, _ = Segment.pack([self.get_msg(i) for i in range(self.total_msgs)], self.analyzer)
+        numbers = sorted(self.int2roman)
+        roman_offsets, romans = _packed([self.int2roman[p].encode('ascii') for p in numbers])
+        poems = sorted(self.poem_lines)
+        text_offsets, texts = _packed([self.poem_texts[p].encode('utf-8') for p in poems])
+        parts = [self.SNAPSHOT_MAGIC, self.SNAPSHOT_HEADER.pack(len(numbers), len(romans), len(poems), len(texts), len(self.rhyme_order), len(segment)),
+                 _le(array('I', numbers)).tobytes(), _le(roman_offsets).tobytes(), romans, _le(array('I', poems)).tobytes()]
+        for column in ([self.markers[self.int2roman[p] + '.'] for p in poems], [self.poem_lines[p][0] for p in poems],
+                       [self.poem_lines[p][1] for p in poems]):
+            parts.append(_le(array('I', column)).tobytes())
+        parts += [_le(text_offsets).tobytes(), texts, _le(array('I', self.rhyme_order)).tobytes()]
+        size = sum(len(part) for part in parts)
+        parts += [bytes(-size % 8), segment]
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(b''.join(parts))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path) # A server starting meanwhile never maps a half-written snapshot.
+
+    @classmethod
+    def load_snapshot(cls, path, name=None, analyzer=None):
+        # The PIndex saved in path by write_snapshot(), mapped rather than read.
+        with open(path, 'rb') as f:
+            data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) # Stays mapped while the views into it live.
+        if bytes(data[:len(cls.SNAPSHOT_MAGIC)]) != cls.SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a sonnet snapshot of this version")
+        n_numerals, romans_len, n_poems, texts_len, n_rhymes, segment_len = cls.SNAPSHOT_HEADER.unpack_from(data, len(cls.SNAPSHOT_MAGIC))
+        pos = len(cls.SNAPSHOT_MAGIC) + cls.SNAPSHOT_HEADER.size
+        tables = pos + 4 * (2 * n_numerals + 5 * n_poems + 2 + n_rhymes) + romans_len + texts_len
+        if tables + -tables % 8 + segment_len != len(data):
+            raise ValueError(f"{path} is truncated")
+        numbers, pos = _take_array(data, pos, n_numerals)
+        roman_offsets, pos = _take_array(data, pos, n_numerals + 1)
+        romans, pos = bytes(data[pos:pos + romans_len]).decode('ascii'), pos + romans_len
+        poems, pos = _take_array(data, pos, n_poems)
+        headings, pos = _take_array(data, pos, n_poems)
+        firsts, pos = _take_array(data, pos, n_poems)
+        ends, pos = _take_array(data, pos, n_poems)
+        text_offsets, pos = _take_array(data, pos, n_poems + 1)
+        texts, pos = data[pos:pos + texts_len], pos + texts_len
+        rhyme_order, pos = _take_array(data, pos, n_rhymes)
+        pos += -pos % 8
+        sonnets = cls.__new__(cls)
+        Index.__init__(sonnets, name if name is not None else path[:-len(cls.SNAPSHOT_SUFFIX)],
+                       past=Segment.from_buffer(data[pos:pos + segment_len], analyzer), analyzer=analyzer)
+        sonnets.int2roman = {numbers[i]: romans[roman_offsets[i]:roman_offsets[i + 1]] for i in range(n_numerals)}
+        sonnets.markers = {sonnets.int2roman[p] + '.': heading for p, heading in zip(poems, headings)}
+        sonnets.poem_lines = {p: (first, end) for p, first, end in zip(poems, firsts, ends)}
+        sonnets.poem_texts = {p: str(texts[text_offsets[i]:text_offsets[i + 1]], 'utf-8') for i, p in enumerate(poems)}
+        sonnets._order_poems()
+        sonnets.rhyme_order = rhyme_order
+        return sonnets
+
     def load_poems(self):
+        self.markers = {} # "XVIII." -> line number of that sonnet's heading
         try:
             with open(self.name, 'r', encoding='utf-8') as f:
                 lines = f.readlines()
+            numerals = {roman + '.' for roman in self.int2roman.values()}
             for l in lines:
-                self.add_msg_and_index(l.rstrip())
+                l = l.rstrip().rstrip('\x00') # The file ends in NUL padding.
+                if l in numerals:
+                    self.markers[l] = self.get_msg_size()
+                self.add_msg_and_index(l)
         except FileNotFoundError:
             print(f"ERROR: Poem file '{self.name}' not found.")
         except Exception as e:
             print(f"ERROR: An unexpected error occurred while loading poems from '{self.name}': {e}")
-    
-    def get_poem(self, p):
-        # Check if the requested sonnet number is valid
-        if p not in self.int2roman:
-            return []
+        self.build_poem_table()
 
-        p_str = self.int2roman[p] + '.'
-        
-        # Determine the marker for the next sonnet, if it exists
-        p_next_str = None
-        if (p + 1) in self.int2roman:
-            p_next_str = self.int2roman[p + 1] + '.'
-        temp = self.search(p_str)
-        if temp:
-            [(go_line, m)] = temp
-        else:
-            return []
-        # in case of wrong number
-        poem = []
-        end = self.get_msg_size()
+    def build_poem_table(self):
+        # Sonnets never change once loaded, so each one's place and text are
+        # worked out here, once: a poem request is then a dict lookup.
+        self.poem_lines = {} # sonnet number -> (first, end) line numbers of its body
+        self.poem_texts = {} # sonnet number -> its lines, joined, as sent to clients
+        end_of_text = self.get_msg_size()
+        for p, roman in self.int2roman.items():
+            heading = self.markers.get(roman + '.')
+            if heading is None:
+                continue
+            # A sonnet runs to the next one's heading, or to the end of the file.
+            following = self.int2roman.get(p + 1)
+            end = self.markers.get(following + '.', end_of_text) if following is not None else end_of_text
+            if end < heading:
+                end = end_of_text
+            first = heading + 1
+            while first < end and not self.get_msg(first).strip(): # Blank lines under the heading.
+                first += 1
+            self.poem_lines[p] = (first, end)
+            self.poem_texts[p] = '\n'.join(self._poem_body(first, end))
+        self._order_poems()
+        self.build_rhyme_index()
 
-        # Advance go_line past the Roman numeral marker itself.
-        # The initial go_line IS the marker line.
-        go_line += 1
-        
-        # Skip any blank lines immediately following the marker
-        while go_line < end and not self.get_msg(go_line).strip():
-            go_line += 1
-            
-        # Collect actual poem lines
-        while go_line < end:
-            this_line = self.get_msg(go_line)
-            # Stop if we hit the marker for the next sonnet
-            # Stop if we hit the marker for the next sonnet (and p_next_str is defined)
-            if p_next_str is not None and this_line == p_next_str:
-                break
-            # Add non-blank lines, stripping leading spaces
-            if this_line.strip():
-                poem.append(this_line.lstrip())
-            go_line += 1
-        return poem
+    def _order_poems(self):
+        # The sonnets by first body line, for place().
+        self.poem_order = sorted(self.poem_lines, key=lambda p: self.poem_lines[p])
+        self.poem_firsts = [self.poem_lines[p][0] for p in self.poem_order]
+
+    def place(self, line):
+        # (sonnet number, line number within it from 1) of corpus line
+        # line, or None for a line outside every sonnet (title, headings).
+        # Sonnet bodies have no blank lines but trailing ones, so the count
+        # matches the lines of poem_text().
+        i = bisect_right(self.poem_firsts, line) - 1
+        if i < 0:
+            return None
+        p = self.poem_order[i]
+        first, end = self.poem_lines[p]
+        return (p, line - first + 1) if line < end else None
+
+    def _last_word(self, line):
+        words = Analyzer.TOKEN.findall(self.get_msg(line))
+        return words[-1] if words else ''
+
+    def _rhyme_rkey(self, line):
+        return rhyme_key(self._last_word(line))[::-1]
+
+    def build_rhyme_index(self):
+        # The sonnet lines ending in a word, ordered by the reversed
+        # rhyme_key() of that word, then by the reversed word: the lines
+        # rhyming with each other are a run, the closest rhymes side by side.
+        ends = []
+        for first, end in self.poem_lines.values():
+            for line in range(first, end):
+                word = self._last_word(line).lower()
+                if word:
+                    ends.append((rhyme_key(word)[::-1], word[::-1], line))
+        self.rhyme_order = array('I', (line for _, _, line in sorted(ends)))
+
+    def rhymes(self, word, k, offset=0):
+        """
+        The k sonnet lines that rhyme with word (see rhyme_key), skipping
+        the offset first: lines ending in word itself are left out, and
+        those sharing the longest ending with it come first. Returns
+        ([(sonnet number, line number within it, text, last word), ...],
+        number of rhyming lines). The run of rhyming lines is found by
+        bisecting the rhyme index; only its lines are read.
+        """
+        word = word.strip().lower()
+        key = rhyme_key(word)[::-1]
+        if not key:
+            return [], 0
+        lo = bisect_left(self.rhyme_order, key, key=self._rhyme_rkey)
+        hi = bisect_right(self.rhyme_order, key, lo, key=self._rhyme_rkey)
+        found = []
+        for line in self.rhyme_order[lo:hi]:
+            last = self._last_word(line)
+            if last.lower() != word:
+                shared = len(os.path.commonprefix([last.lower()[::-1], word[::-1]]))
+                found.append((-shared, line, last))
+        found.sort()
+        return [self.place(line) + (self.get_msg(line).strip(), last) for _, line, last in found[offset:offset + k]], len(found)
+
+    def _spans(self, line):
+        # (start, end) of each token of line; a term's position is its index.
+        return [m.span() for m in Analyzer.TOKEN.finditer(self.get_msg(line))]
+
+    def _context(self, line, pos, width, first, end):
+        # (left, word, right): token pos of line and up to width tokens on
+        # either side, as they are written, taken from the lines [first,
+        # end) around it; a line break shows as ' / '.
+        text = self.get_msg(line)
+        spans = self._spans(line)
+        a, b = spans[pos]
+        start, stop = max(pos - width, 0), min(pos + width, len(spans) - 1)
+        # Whole lines are shown with their punctuation, cut ones at a word.
+        left = [text[spans[start][0] if start else 0:a].strip()]
+        right = [text[b:spans[stop][1] if stop < len(spans) - 1 else len(text)].strip()]
+        need, j = width - (pos - start), line - 1
+        while need > 0 and j >= first:
+            s, t = self._spans(j), self.get_msg(j)
+            if s:
+                k = max(len(s) - need, 0)
+                left.append(t[s[k][0] if k else 0:].strip())
+                need -= len(s) - k
+            j -= 1
+        need, j = width - (stop - pos), line + 1
+        while need > 0 and j < end:
+            s, t = self._spans(j), self.get_msg(j)
+            if s:
+                k = min(need, len(s))
+                right.append(t[:s[k - 1][1] if k < len(s) else len(t)].strip())
+                need -= k
+            j += 1
+        return ' / '.join(reversed(left)).strip(), text[a:b], ' / '.join(right).strip()
+
+    def concordance(self, word, width, k, offset=0):
+        """
+        Keyword in context: the occurrences of word in the sonnets, in
+        order, skipping the offset first and returning k, each with up to
+        width words on either side (within its sonnet). Returns ([(sonnet
+        number, line number within it, left context, word as written,
+        right context), ...], number of occurrences). The occurrences come
+        from the positional postings; only the lines shown are read.
+        """
+        terms = self.analyzer.terms(word)
+        if len(terms) != 1:
+            return [], 0
+        found = [key for key in self.keys(terms[0]) if self.place(key >> POS_BITS) is not None]
+        results = []
+        for key in found[offset:offset + k]:
+            line = key >> POS_BITS
+            p, n = self.place(line)
+            results.append((p, n) + self._context(line, key & POS_MASK, width, *self.poem_lines[p]))
+        return results, len(found)
+
+    def search_sonnets(self, query, k, offset=0):
+        """
+        The k sonnet lines best matching query, skipping the offset best,
+        ranked by BM25 as in search_topk(). Returns ([(sonnet number, line
+        number within it, text, score), ...], number of sonnet lines
+        matching).
+        """
+        found, total = self.search_topk(query, k, offset, keep=lambda line: self.place(line) is not None)
+        return [self.place(line) + (text, score) for line, text, score in found], total
+
+    def _poem_body(self, first, end):
+        # The non-blank lines in [first, end), without their indentation.
+        return [l.lstrip() for l in (self.get_msg(i) for i in range(first, end)) if l.strip()]
+
+    def get_poem(self, p):
+        # Lines of sonnet p, or [] if there is no such sonnet.
+        span = self.poem_lines.get(p)
+        return self._poem_body(*span) if span is not None else []
+
+    def poem_text(self, p):
+        # Sonnet p as one string, or '' if there is no such sonnet.
+        return self.poem_texts.get(p, '')
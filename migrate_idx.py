@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+# Converts chat histories from the old pickled <name>.idx files to the
+# segmented <name>.hist directories the server now reads.
+#
+# Each history becomes one sealed segment. A name that already has a .hist
+# directory with lines in it is skipped, so the tool can be re-run safely.
+# Pickles can run code when loaded: only migrate .idx files you trust.
+#
+# Usage: python migrate_idx.py [FILE.idx ...] [--remove]
+#   With no files, every *.idx in the current directory is migrated.
+#==============================================================================
+
+import argparse
+import glob
+import os
+import pickle
+import indexer
+
+def migrate(path, remove=False):
+    name = path[:-len('.idx')]
+    history = indexer.SegmentedHistory.open(name + indexer.HIST_SUFFIX)
+    if len(history):
+        print(f"{path}: {name + indexer.HIST_SUFFIX} already has {len(history)} lines, skipped")
+        return False
+    with open(path, 'rb') as f:
+        old = pickle.load(f) # An indexer.Index; legacy pickles load through Index.__setstate__.
+    lines = [old.get_msg(i) for i in range(old.get_msg_size())]
+    if lines:
+        indexer.Segment.write(history.path, 0, lines)
+    print(f"{path}: {len(lines)} lines -> {history.path}")
+    if remove:
+        os.remove(path)
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description='migrate pickled .idx chat histories to .hist segments')
+    parser.add_argument('files', nargs='*', help='.idx files (default: *.idx)')
+    parser.add_argument('--remove', action='store_true', help='delete each .idx file once migrated')
+    args = parser.parse_args()
+    files = args.files or sorted(glob.glob('*.idx'))
+    migrated = sum(migrate(path, args.remove) for path in files)
+    print(f"Migrated {migrated} of {len(files)} file(s).")
+
+if __name__ == "__main__":
+    main()
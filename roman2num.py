@@ -2,6 +2,7 @@
 
 import random
 import pickle
+import indexer
 
 class Roman2num:
     def __init__(self, fname):
@@ -27,6 +28,14 @@ class Roman2num:
         pickle.dump(self.int2roman, self.outf)
         pickle.dump(self.roman2int, self.outf)
         self.outf.close()
+
+    def write_snapshot(self, corpus):
+        # Indexes corpus against these numerals and saves lines, postings,
+        # numerals and sonnet offsets in the one file the server maps at
+        # startup (see indexer.PIndex.open).
+        sonnets = indexer.PIndex(corpus, self.int2roman)
+        sonnets.write_snapshot(corpus + indexer.PIndex.SNAPSHOT_SUFFIX)
+        return sonnets
         
 if __name__ == "__main__":
     r = Roman2num('roman.txt')
@@ -39,6 +48,8 @@ if __name__ == "__main__":
         print(x, s)
         
     r.write_table()
+    sonnets = r.write_snapshot('AllSonnets.txt')
+    print(f"AllSonnets.txt{indexer.PIndex.SNAPSHOT_SUFFIX}: {sonnets.get_msg_size()} lines, {len(sonnets.poem_lines)} sonnets")
     
 
                 